@@ -0,0 +1,68 @@
+"""
+Check that the fused scaled-dot-product attention matches the einops attention and time both on
+the configs/vit sizes.
+
+    python -m benchmarks.attention --configs configs/vit/vit_student.yaml configs/vit/simplevit_base.yaml
+
+The same weights are loaded into both implementations, so 'out err' and 'grad err' are the max
+absolute differences of the logits and of the input gradients in eval mode. 'saved' is the
+memory autograd holds for backward.
+"""
+import argparse
+import glob
+
+import torch
+import yaml
+
+import vit_pytorch
+from benchmarks.common import format_bytes, saved_tensor_bytes, timeit
+
+
+def build(config, impl, image_size, num_classes, depth=None):
+    args = dict(config['args'], image_size=image_size, num_classes=num_classes, attn_impl=impl)
+    if depth:
+        args['depth'] = depth
+    return getattr(vit_pytorch, config['type'])(**args)
+
+
+def forward_backward(model, data):
+    data = data.clone().requires_grad_()
+    out = model(data)
+    out.sum().backward()
+    return out.detach(), data.grad
+
+
+def main(args):
+    device = torch.device(args.device)
+    print('{:>22} {:>8} {:>12} {:>12} {:>10} {:>10}'.format('config', 'impl', 'fwd+bwd', 'saved', 'out err', 'grad err'))
+    for path in args.configs:
+        with open(path, 'r') as f:
+            config = yaml.load(f, Loader=yaml.FullLoader)['model']
+        torch.manual_seed(0)
+        reference = build(config, 'einops', args.image_size, args.num_classes, args.depth).to(device).eval()
+        fused = build(config, 'sdpa', args.image_size, args.num_classes, args.depth).to(device).eval()
+        fused.load_state_dict(reference.state_dict())
+        data = torch.randn(args.batch_size, 3, args.image_size, args.image_size, device=device)
+
+        out1, grad1 = forward_backward(reference, data)
+        out2, grad2 = forward_backward(fused, data)
+        out_err = (out1 - out2).abs().max().item()
+        grad_err = (grad1 - grad2).abs().max().item()
+        for impl, model in [('einops', reference), ('sdpa', fused)]:
+            elapsed = timeit(lambda: model(data).sum().backward(), warmup=1, iters=args.iters, device=device)
+            saved = saved_tensor_bytes(lambda: model(data))
+            print('{:>22} {:>8} {:>10.1f}ms {:>12} {:>10.1e} {:>10.1e}'.format(
+                path.split('/')[-1], impl, elapsed * 1e3, format_bytes(saved), out_err, grad_err))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--configs', type=str, nargs='+', default=sorted(glob.glob('configs/vit/*.yaml')),
+                        help='model configs to test')
+    parser.add_argument('--image-size', type=int, default=224, help='input resolution')
+    parser.add_argument('--num-classes', type=int, default=10, help='number of classes')
+    parser.add_argument('--batch-size', type=int, default=2, help='images per batch')
+    parser.add_argument('--depth', type=int, default=None, help='override the depth to keep large models fast')
+    parser.add_argument('--iters', type=int, default=5, help='timed iterations per measurement')
+    parser.add_argument('--device', type=str, default='cpu', help='device to run on')
+    main(parser.parse_args())
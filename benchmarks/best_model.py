@@ -0,0 +1,75 @@
+"""
+Cost of keeping the best weights: deepcopy of the state_dict on the training device, as the
+trainers used to do, against BestModelTracker's CPU shadow and on-disk file. Also compares
+evaluating a deepcopy of the model with evaluating the live model.
+
+    python -m benchmarks.best_model --config configs/kd/vkd.yaml --model teacher_model --device cuda
+
+'device' is the CUDA memory still held after the copy; 'host' the CPU memory of the copy.
+"""
+import argparse
+import copy
+import os
+import tempfile
+
+import torch
+
+from benchmarks.common import format_bytes, load_kd_models, timeit
+from utils.checkpoint import BestModelTracker
+
+
+def allocated(device):
+    if device.type != 'cuda':
+        return None
+    torch.cuda.synchronize(device)
+    return torch.cuda.memory_allocated(device)
+
+
+def main(args):
+    device = torch.device(args.device)
+    teacher, student = load_kd_models(args.config, args.image_size, args.num_classes)
+    model = (teacher if args.model == 'teacher_model' else student).to(device)
+    data = torch.randn(args.batch_size, 3, args.image_size, args.image_size, device=device)
+    nbytes = sum(t.numel() * t.element_size() for t in model.state_dict().values())
+
+    print('{:>14} {:>12} {:>12} {:>12}'.format('best weights', 'update', 'device', 'host'))
+    base = allocated(device)
+    weights = copy.deepcopy(model.state_dict())
+    held = None if base is None else allocated(device) - base
+    elapsed = timeit(lambda: copy.deepcopy(model.state_dict()), warmup=1, iters=args.iters, device=device)
+    print('{:>14} {:>10.1f}ms {:>12} {:>12}'.format(
+        'deepcopy', elapsed * 1e3, format_bytes(held), format_bytes(0 if device.type == 'cuda' else nbytes)))
+    del weights
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, path in [('cpu shadow', None), ('file', os.path.join(tmp, 'best.pt'))]:
+            base = allocated(device)
+            tracker = BestModelTracker(model, path, args.model)
+            held = None if base is None else allocated(device) - base
+
+            def update():
+                tracker.best = 0.0
+                tracker.update(1.0)
+
+            elapsed = timeit(update, warmup=1, iters=args.iters, device=device)
+            host = nbytes if path is None else 0
+            print('{:>14} {:>10.1f}ms {:>12} {:>12}'.format(name, elapsed * 1e3, format_bytes(held), format_bytes(host)))
+            tracker.restore()
+
+    model.eval()
+    with torch.no_grad():
+        copied = timeit(lambda: copy.deepcopy(model)(data), warmup=1, iters=args.iters, device=device)
+        live = timeit(lambda: model(data), warmup=1, iters=args.iters, device=device)
+    print('evaluation batch: deepcopy {:.1f}ms, live model {:.1f}ms'.format(copied * 1e3, live * 1e3))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='configs/kd/vkd.yaml', help='kd config with teacher and student')
+    parser.add_argument('--model', type=str, default='teacher_model', choices=['teacher_model', 'student_model'])
+    parser.add_argument('--image-size', type=int, default=64, help='input resolution')
+    parser.add_argument('--num-classes', type=int, default=10, help='number of classes')
+    parser.add_argument('--batch-size', type=int, default=16, help='evaluation batch size')
+    parser.add_argument('--iters', type=int, default=3, help='timed repetitions')
+    parser.add_argument('--device', type=str, default='cpu', help='device to run on')
+    main(parser.parse_args())
@@ -0,0 +1,61 @@
+"""
+Step time against activation memory of the Transformer checkpointing policies.
+
+    python -m benchmarks.checkpointing --config configs/kd/ckd.yaml --model teacher_model --image-size 64 --batch-size 8
+
+'saved' counts the tensors autograd keeps outside checkpointed regions (the block inputs a
+checkpoint holds on to are not included); 'peak' is the CUDA high-water mark of the step and
+is only shown on GPUs, where it is the number to size batches by.
+"""
+import argparse
+
+import torch
+import torch.nn.functional as F
+import yaml
+
+import vit_pytorch
+from benchmarks.common import format_bytes, peak_cuda_bytes, saved_tensor_bytes, timeit
+
+
+def parse_policy(policy):
+    if policy == 'none':
+        return None
+    return int(policy) if policy.isdigit() else policy
+
+
+def main(args):
+    device = torch.device(args.device)
+    with open(args.config, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)[args.model]
+    data = torch.randn(args.batch_size, 3, args.image_size, args.image_size, device=device)
+    label = torch.randint(args.num_classes, (args.batch_size,), device=device)
+
+    print('{:>8} {:>12} {:>12} {:>12}'.format('policy', 'step', 'saved', 'peak'))
+    for policy in args.policies:
+        torch.manual_seed(0)
+        model_args = dict(config['args'], image_size=args.image_size, num_classes=args.num_classes,
+                          checkpoint=parse_policy(policy))
+        model = getattr(vit_pytorch, config['type'])(**model_args).to(device).train()
+
+        def step():
+            model.zero_grad(set_to_none=True)
+            F.cross_entropy(model(data), label).backward()
+
+        elapsed = timeit(step, warmup=1, iters=args.iters, device=device)
+        saved = saved_tensor_bytes(lambda: model(data))
+        peak = peak_cuda_bytes(step, device)
+        print('{:>8} {:>10.1f}ms {:>12} {:>12}'.format(policy, elapsed * 1e3, format_bytes(saved), format_bytes(peak)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='configs/kd/ckd.yaml', help='config with the model')
+    parser.add_argument('--model', type=str, default='teacher_model', help='model block of the config, e.g. model')
+    parser.add_argument('--policies', type=str, nargs='+', default=['none', 'attn', '2', 'all'],
+                        help='checkpoint policies; a number k checkpoints every k-th block')
+    parser.add_argument('--image-size', type=int, default=64, help='input resolution')
+    parser.add_argument('--num-classes', type=int, default=10, help='number of classes')
+    parser.add_argument('--batch-size', type=int, default=8, help='images per batch')
+    parser.add_argument('--iters', type=int, default=3, help='timed iterations per measurement')
+    parser.add_argument('--device', type=str, default='cpu', help='device to run on')
+    main(parser.parse_args())
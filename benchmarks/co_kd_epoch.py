@@ -0,0 +1,56 @@
+"""
+Throughput of CoVanillaKD.train_model with the two-pass loop against the fused single pass.
+
+    python -m benchmarks.co_kd_epoch --config configs/kd/ckd.yaml --image-size 64 --samples 256
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+
+from benchmarks.common import load_kd_models, synthetic_loader
+from ckd.co_vanilla_kd import CoVanillaKD
+
+
+def run(args, fused):
+    torch.manual_seed(0)
+    teacher, student = load_kd_models(args.config, args.image_size, args.num_classes)
+    train_loader = synthetic_loader(args.samples, args.num_classes, args.batch_size, args.image_size)
+    val_loader = synthetic_loader(args.batch_size, args.num_classes, args.batch_size, args.image_size)
+    distiller = CoVanillaKD(teacher, student, train_loader, val_loader,
+                            torch.optim.Adam(teacher.parameters(), lr=3e-5),
+                            torch.optim.Adam(student.parameters(), lr=3e-5),
+                            device=args.device)
+    with tempfile.TemporaryDirectory() as save_dir:
+        start = time.perf_counter()
+        distiller.train_model(epochs=args.epochs, student_start=0, student_step=1,
+                              save_teacher_model=False, save_student_model=False,
+                              save_teacher_model_pth=os.path.join(save_dir, 'teacher.pt'),
+                              save_student_model_pth=os.path.join(save_dir, 'student.pt'),
+                              fused=fused)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return time.perf_counter() - start
+
+
+def main(args):
+    results = {}
+    for name, fused in [('two-pass', False), ('fused', True)]:
+        elapsed = run(args, fused)
+        results[name] = elapsed
+        print(f'{name:>10}: {elapsed:.2f}s, {args.samples * args.epochs / elapsed:.1f} samples/s')
+    print(f'speedup: {results["two-pass"] / results["fused"]:.2f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='configs/kd/ckd.yaml', help='kd config with teacher and student')
+    parser.add_argument('--image-size', type=int, default=64, help='input resolution')
+    parser.add_argument('--num-classes', type=int, default=10, help='number of classes')
+    parser.add_argument('--samples', type=int, default=256, help='training samples per epoch')
+    parser.add_argument('--batch-size', type=int, default=32, help='batch size')
+    parser.add_argument('--epochs', type=int, default=1, help='co-training epochs, all with the student active')
+    parser.add_argument('--device', type=str, default='cpu', help="'cpu' or 'cuda'")
+    main(parser.parse_args())
@@ -0,0 +1,101 @@
+import statistics
+import time
+
+import torch
+
+
+def synchronize(device=None):
+    if torch.cuda.is_available() and (device is None or torch.device(device).type == 'cuda'):
+        torch.cuda.synchronize()
+
+
+def timeit(fn, warmup=3, iters=10, device=None):
+    """
+    Median wall time of ``fn()`` in seconds after ``warmup`` untimed calls
+    """
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    times = []
+    for _ in range(iters):
+        start = time.perf_counter()
+        fn()
+        synchronize(device)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def saved_tensor_bytes(fn):
+    """
+    Bytes of distinct tensors autograd keeps for backward while running ``fn()``.
+    This is the activation memory a training step holds, measurable on CPU.
+    """
+    seen = {}
+
+    def pack(tensor):
+        key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape))
+        seen[key] = tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+    return sum(seen.values())
+
+
+def peak_cuda_bytes(fn, device):
+    """
+    Peak CUDA memory allocated while running ``fn()``, None on CPU
+    """
+    if torch.device(device).type != 'cuda':
+        return None
+    torch.cuda.reset_peak_memory_stats(device)
+    fn()
+    torch.cuda.synchronize(device)
+    return torch.cuda.max_memory_allocated(device)
+
+
+def format_bytes(num_bytes):
+    if num_bytes is None:
+        return '-'
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(num_bytes) < 1024:
+            return f'{num_bytes:.1f}{unit}'
+        num_bytes /= 1024
+    return f'{num_bytes:.1f}TB'
+
+
+def synthetic_loader(num_samples, num_classes, batch_size, image_size=224, transforms=None, num_workers=0):
+    """
+    Offline stand-in for the dataset loaders. Without ``transforms`` it serves ready-made
+    float tensors; with a ``transforms`` list from a dataset config it decodes 32x32 PIL
+    images through make_transforms like CIFAR does.
+    """
+    from torch.utils.data import DataLoader, TensorDataset
+    from torchvision.datasets import FakeData
+    from utils.dataset import make_transforms
+
+    if transforms is None:
+        generator = torch.Generator().manual_seed(0)
+        dataset = TensorDataset(
+            torch.randn(num_samples, 3, image_size, image_size, generator=generator),
+            torch.randint(num_classes, (num_samples,), generator=generator),
+        )
+    else:
+        dataset = FakeData(num_samples, (3, 32, 32), num_classes, transform=make_transforms(transforms))
+    return DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+
+
+def load_kd_models(path, image_size, num_classes):
+    """
+    Teacher and student from a configs/kd file, resized to ``image_size``
+    """
+    import yaml
+    import vit_pytorch
+
+    with open(path, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    models = []
+    for name in ['teacher_model', 'student_model']:
+        args = dict(config[name]['args'], image_size=image_size, num_classes=num_classes)
+        models.append(getattr(vit_pytorch, config[name]['type'])(**args))
+    return models
@@ -0,0 +1,80 @@
+"""
+Data-parallel scaling of a training step with DistributedDataParallel over gloo, with several
+CPU processes on one machine, so no GPU is needed.
+
+    python -m benchmarks.ddp_scaling --config configs/vit/vit_student.yaml --world-sizes 1 2 4 --image-size 64
+
+The global batch is fixed and split over the processes, each of which gets --threads intra-op
+threads. 'efficiency' is the throughput relative to linear scaling from one process.
+"""
+import argparse
+import os
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+import yaml
+
+import vit_pytorch
+from utils.distributed import wrap_ddp
+
+
+def worker(rank, world_size, args, results):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(args.port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    with open(args.config, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    model_args = dict(config['model']['args'], image_size=args.image_size, num_classes=10)
+    model = getattr(vit_pytorch, config['model']['type'])(**model_args)
+    model = wrap_ddp(model, torch.device('cpu'), config.get('distributed'))
+    optimizer = torch.optim.Adam(model.parameters(), lr=3e-5)
+
+    batch_size = args.batch_size // world_size
+    data = torch.randn(batch_size, 3, args.image_size, args.image_size)
+    label = torch.randint(10, (batch_size,))
+
+    def step():
+        optimizer.zero_grad()
+        F.cross_entropy(model(data), label).backward()
+        optimizer.step()
+
+    for _ in range(args.warmup):
+        step()
+    dist.barrier()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        step()
+    dist.barrier()
+    if rank == 0:
+        results[world_size] = args.steps * args.batch_size / (time.perf_counter() - start)
+    dist.destroy_process_group()
+
+
+def main(args):
+    results = mp.Manager().dict()
+    print('{:>6} {:>12} {:>12}'.format('procs', 'samples/s', 'efficiency'))
+    for world_size in args.world_sizes:
+        mp.spawn(worker, args=(world_size, args, results), nprocs=world_size)
+        baseline = results[args.world_sizes[0]] / args.world_sizes[0]
+        print('{:>6} {:>12.1f} {:>11.0%}'.format(
+            world_size, results[world_size], results[world_size] / (baseline * world_size)))
+        args.port += 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='configs/vit/vit_student.yaml', help='model config')
+    parser.add_argument('--world-sizes', type=int, nargs='+', default=[1, 2, 4], help='process counts to test')
+    parser.add_argument('--threads', type=int, default=1, help='intra-op threads per process')
+    parser.add_argument('--batch-size', type=int, default=32, help='global batch size')
+    parser.add_argument('--image-size', type=int, default=64, help='input resolution')
+    parser.add_argument('--steps', type=int, default=10, help='timed steps')
+    parser.add_argument('--warmup', type=int, default=2, help='untimed steps')
+    parser.add_argument('--port', type=int, default=29511, help='rendezvous port')
+    main(parser.parse_args())
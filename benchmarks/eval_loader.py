@@ -0,0 +1,58 @@
+"""
+Time one pass over an evaluation split through the DataLoader against the precomputed tensor
+loader, and report how far the precomputed (uint8) images are from the per-sample pipeline.
+
+    python -m benchmarks.eval_loader --data configs/dataset/cifar10.yaml --samples 2048
+
+Uses synthetic 32x32 images, so nothing is downloaded.
+"""
+import argparse
+import time
+
+import yaml
+from torch.utils.data import DataLoader
+from torchvision.datasets import FakeData
+
+from utils.dataset import PrecomputedDataset, TensorLoader, make_transforms
+
+
+def fake_data(samples, transform=None):
+    dataset = FakeData(samples, (3, 32, 32), 10, transform=transform, random_offset=0)
+    dataset.classes = list(range(10))
+    return dataset
+
+
+def epoch_time(loader):
+    start = time.perf_counter()
+    for data, target in loader:
+        pass
+    return time.perf_counter() - start
+
+
+def main(args):
+    with open(args.data, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)['dataset']
+    transforms_config = config['test']['transforms']
+
+    loader = DataLoader(fake_data(args.samples, make_transforms(transforms_config)), batch_size=args.batch_size,
+                        shuffle=False, num_workers=args.workers)
+    start = time.perf_counter()
+    precomputed = PrecomputedDataset(fake_data(args.samples), transforms_config, num_workers=args.workers)
+    build = time.perf_counter() - start
+    tensor_loader = TensorLoader(precomputed, args.batch_size)
+
+    error = max((a - b).abs().max().item() for (a, _), (b, _) in zip(loader, tensor_loader))
+    print('{:>12} {:>10}'.format('loader', 'epoch'))
+    for name, l in [('dataloader', loader), ('precomputed', tensor_loader)]:
+        print('{:>12} {:>9.3f}s'.format(name, min(epoch_time(l) for _ in range(args.repeats))))
+    print('build {:.3f}s, max abs error {:.2e}'.format(build, error))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, default='configs/dataset/cifar10.yaml', help='dataset config')
+    parser.add_argument('--samples', type=int, default=2048, help='synthetic samples')
+    parser.add_argument('--batch-size', type=int, default=128, help='batch size')
+    parser.add_argument('--workers', type=int, default=0, help='workers of the DataLoader')
+    parser.add_argument('--repeats', type=int, default=3, help='epochs timed per loader, best is reported')
+    main(parser.parse_args())
@@ -0,0 +1,60 @@
+"""
+KD step time and activation memory with the original teacher forward against FrozenTeacher.
+
+    python -m benchmarks.frozen_teacher --config configs/kd/vkd.yaml --image-size 64 --batch-size 16
+
+'saved' is the memory autograd holds for backward during the step, measured on any device;
+'peak' is the CUDA high-water mark and only shown on GPUs.
+"""
+import argparse
+import copy
+
+import torch
+
+from benchmarks.common import format_bytes, load_kd_models, peak_cuda_bytes, saved_tensor_bytes, timeit
+from kd.frozen_teacher import FrozenTeacher
+from kd.losses import DistillationLoss
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    teacher, student = load_kd_models(args.config, args.image_size, args.num_classes)
+    teacher, student = teacher.to(device), student.to(device)
+    optimizer = torch.optim.Adam(student.parameters(), lr=3e-5)
+    kd_loss = DistillationLoss(20.0, 0.5, 'mse')
+    data = torch.randn(args.batch_size, 3, args.image_size, args.image_size, device=device)
+    label = torch.randint(args.num_classes, (args.batch_size,), device=device)
+
+    original = copy.deepcopy(teacher).eval()
+    candidates = [('original', original)]
+    for dtype in args.dtypes:
+        candidates.append((f'frozen-{dtype}', FrozenTeacher(teacher, dtype, device).freeze()))
+
+    print('{:>14} {:>12} {:>12} {:>12}'.format('teacher', 'step', 'saved', 'peak'))
+    for name, teacher_fn in candidates:
+        def forward():
+            return kd_loss(student(data), teacher_fn(data), label)
+
+        def step():
+            loss = forward()
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+        elapsed = timeit(step, warmup=2, iters=args.iters, device=device)
+        saved = saved_tensor_bytes(forward)
+        peak = peak_cuda_bytes(step, device)
+        print('{:>14} {:>10.1f}ms {:>12} {:>12}'.format(name, elapsed * 1e3, format_bytes(saved), format_bytes(peak)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='configs/kd/vkd.yaml', help='kd config with teacher and student')
+    parser.add_argument('--image-size', type=int, default=64, help='input resolution')
+    parser.add_argument('--num-classes', type=int, default=10, help='number of classes')
+    parser.add_argument('--batch-size', type=int, default=16, help='batch size')
+    parser.add_argument('--dtypes', type=str, nargs='+', default=['fp32', 'bf16'], help='frozen teacher precisions')
+    parser.add_argument('--iters', type=int, default=5, help='timed steps per teacher')
+    parser.add_argument('--device', type=str, default='cpu', help='device to run on')
+    main(parser.parse_args())
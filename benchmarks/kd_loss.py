@@ -0,0 +1,78 @@
+"""
+Compare the fused distillation loss with the original softmax/MSE implementation.
+
+    python -m benchmarks.kd_loss --batch-size 256 --classes 10 100 1000
+"""
+import argparse
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from benchmarks.common import format_bytes, saved_tensor_bytes, timeit
+from kd.losses import DistillationLoss
+
+
+def original_kd_loss(y_pred_student, y_pred_teacher, y_true, temp, distil_weight):
+    # copy of VanillaKD.calculate_kd_loss before the fused loss
+    soft_teacher_out = F.softmax(y_pred_teacher / temp, dim=1)
+    soft_student_out = F.softmax(y_pred_student / temp, dim=1)
+    loss = (1 - distil_weight) * F.cross_entropy(y_pred_student, y_true)
+    loss += (distil_weight * temp * temp) * nn.MSELoss()(soft_teacher_out, soft_student_out)
+    return loss
+
+
+def reference_kl_loss(y_pred_student, y_pred_teacher, y_true, temp, distil_weight):
+    soft = F.kl_div(F.log_softmax(y_pred_student / temp, dim=1), F.softmax(y_pred_teacher / temp, dim=1),
+                    reduction='batchmean')
+    return (1 - distil_weight) * F.cross_entropy(y_pred_student, y_true) + distil_weight * temp * temp * soft
+
+
+def max_error(fn, reference, student, teacher, label):
+    s1 = student.clone().requires_grad_()
+    s2 = student.clone().requires_grad_()
+    loss1 = fn(s1, teacher, label)
+    loss2 = reference(s2, teacher, label)
+    loss1.backward()
+    loss2.backward()
+    return (loss1 - loss2).abs().item(), (s1.grad - s2.grad).abs().max().item()
+
+
+def main(args):
+    device = torch.device(args.device)
+    temp, weight = args.temp, args.distil_weight
+    print('{:>6} {:>10} {:>12} {:>12} {:>10} {:>10}'.format(
+        'C', 'loss', 'time/step', 'saved', 'loss err', 'grad err'))
+    for num_classes in args.classes:
+        student = torch.randn(args.batch_size, num_classes, device=device) * 3
+        teacher = torch.randn(args.batch_size, num_classes, device=device) * 3
+        label = torch.randint(num_classes, (args.batch_size,), device=device)
+        original = lambda s, t, y: original_kd_loss(s, t, y, temp, weight)
+        candidates = [
+            ('original', original, original),
+            ('fused-mse', DistillationLoss(temp, weight, 'mse'), original),
+            ('fused-kl', DistillationLoss(temp, weight, 'kl'), lambda s, t, y: reference_kl_loss(s, t, y, temp, weight)),
+        ]
+        for name, fn, reference in candidates:
+            leaf = student.clone().requires_grad_()
+
+            def step():
+                leaf.grad = None
+                fn(leaf, teacher, label).backward()
+
+            elapsed = timeit(step, iters=args.iters, device=device)
+            saved = saved_tensor_bytes(lambda: fn(leaf, teacher, label))
+            loss_err, grad_err = max_error(fn, reference, student, teacher, label)
+            print('{:>6} {:>10} {:>10.1f}us {:>12} {:>10.1e} {:>10.1e}'.format(
+                num_classes, name, elapsed * 1e6, format_bytes(saved), loss_err, grad_err))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=256, help='logits per batch')
+    parser.add_argument('--classes', type=int, nargs='+', default=[10, 100, 1000], help='number of classes to test')
+    parser.add_argument('--temp', type=float, default=20.0, help='distillation temperature')
+    parser.add_argument('--distil-weight', type=float, default=0.5, help='weight of the soft term')
+    parser.add_argument('--iters', type=int, default=50, help='timed iterations per measurement')
+    parser.add_argument('--device', type=str, default='cpu', help='device to run on')
+    main(parser.parse_args())
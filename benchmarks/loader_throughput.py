@@ -0,0 +1,57 @@
+"""
+Loader throughput of a dataset config's transforms applied per sample against the same
+random tail applied per batch.
+
+    python -m benchmarks.loader_throughput --data configs/dataset/cifar10.yaml --workers 0 4
+
+Uses synthetic 32x32 images, so nothing is downloaded. Entries already marked ``batch: True``
+stay batched; otherwise the random tail after the deterministic prefix is batched.
+"""
+import argparse
+import time
+
+import yaml
+from torch.utils.data import DataLoader
+from torchvision.datasets import FakeData
+
+from utils.batch_transforms import BatchCollate, make_batch_transforms, split_batch_transforms
+from utils.dataset import make_transforms, split_transforms
+
+
+def throughput(dataset, batch_size, workers, collate_fn=None):
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=workers, collate_fn=collate_fn)
+    start = time.perf_counter()
+    samples = 0
+    for data, _ in loader:
+        samples += len(data)
+    return samples / (time.perf_counter() - start)
+
+
+def main(args):
+    with open(args.data, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)['dataset']
+    transforms_config = config[args.split]['transforms']
+    sample_config, batch_config = split_batch_transforms(transforms_config)
+    if not batch_config:
+        sample_config, batch_config = split_transforms(transforms_config)
+    plain = [{k: v for k, v in t.items() if k != 'batch'} for t in transforms_config]
+
+    per_sample = FakeData(args.samples, (3, 32, 32), 10, transform=make_transforms(plain))
+    batched = FakeData(args.samples, (3, 32, 32), 10, transform=make_transforms(sample_config))
+    collate = BatchCollate(make_batch_transforms(batch_config))
+    print('batched transforms: {}'.format(collate.transform))
+    print('{:>8} {:>14} {:>14} {:>8}'.format('workers', 'per-sample/s', 'per-batch/s', 'speedup'))
+    for workers in args.workers:
+        a = throughput(per_sample, args.batch_size, workers)
+        b = throughput(batched, args.batch_size, workers, collate)
+        print('{:>8} {:>14.1f} {:>14.1f} {:>7.2f}x'.format(workers, a, b, b / a))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, default='configs/dataset/cifar10.yaml', help='dataset config')
+    parser.add_argument('--split', type=str, default='train', choices=['train', 'test'], help='transforms to use')
+    parser.add_argument('--samples', type=int, default=1024, help='synthetic samples per measurement')
+    parser.add_argument('--batch-size', type=int, default=32, help='batch size')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0], help='loader worker counts to test')
+    main(parser.parse_args())
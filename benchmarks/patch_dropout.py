@@ -0,0 +1,53 @@
+"""
+Training step time against the fraction of patch tokens kept by patch dropout.
+
+    python -m benchmarks.patch_dropout --config configs/kd/vkd.yaml --model student_model --image-size 64 --batch-size 16
+
+Evaluation is unaffected: patch dropout only runs in training mode.
+"""
+import argparse
+
+import torch
+import torch.nn.functional as F
+import yaml
+
+import vit_pytorch
+from benchmarks.common import timeit
+
+
+def main(args):
+    device = torch.device(args.device)
+    with open(args.config, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)[args.model]
+    data = torch.randn(args.batch_size, 3, args.image_size, args.image_size, device=device)
+    label = torch.randint(args.num_classes, (args.batch_size,), device=device)
+
+    print('{:>6} {:>12} {:>9}'.format('keep', 'step', 'speedup'))
+    baseline = None
+    for keep in args.keep:
+        torch.manual_seed(0)
+        model_args = dict(config['args'], image_size=args.image_size, num_classes=args.num_classes,
+                          patch_dropout=1 - keep)
+        model = getattr(vit_pytorch, config['type'])(**model_args).to(device).train()
+
+        def step():
+            model.zero_grad(set_to_none=True)
+            F.cross_entropy(model(data), label).backward()
+
+        elapsed = timeit(step, warmup=1, iters=args.iters, device=device)
+        baseline = baseline or elapsed
+        print('{:>6.2f} {:>10.1f}ms {:>8.2f}x'.format(keep, elapsed * 1e3, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='configs/kd/vkd.yaml', help='config with the model')
+    parser.add_argument('--model', type=str, default='student_model', help='model block of the config, e.g. model')
+    parser.add_argument('--keep', type=float, nargs='+', default=[1.0, 0.75, 0.5, 0.25],
+                        help='fractions of patch tokens kept; start with 1.0 for the baseline')
+    parser.add_argument('--image-size', type=int, default=64, help='input resolution')
+    parser.add_argument('--num-classes', type=int, default=10, help='number of classes')
+    parser.add_argument('--batch-size', type=int, default=16, help='images per batch')
+    parser.add_argument('--iters', type=int, default=3, help='timed iterations per measurement')
+    parser.add_argument('--device', type=str, default='cpu', help='device to run on')
+    main(parser.parse_args())
@@ -0,0 +1,62 @@
+"""
+Distilling from the fp32 teacher against its dynamic int8 copy on CPU: logit agreement of the
+two teachers and the end-to-end KD step throughput.
+
+    python -m benchmarks.quantized_teacher --config configs/kd/vkd.yaml --image-size 64 --batch-size 32
+"""
+import argparse
+
+import torch
+
+from benchmarks.common import load_kd_models, synthetic_loader, timeit
+from kd.frozen_teacher import FrozenTeacher
+from kd.losses import DistillationLoss
+from kd.quantize import compare_teachers, quantize_teacher
+
+
+def main(args):
+    torch.manual_seed(0)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    teacher, student = load_kd_models(args.config, args.image_size, args.num_classes)
+    teacher.eval()
+    quantized = quantize_teacher(teacher)
+    loader = synthetic_loader(args.num_samples, args.num_classes, args.batch_size, args.image_size)
+
+    results = compare_teachers(teacher, quantized, loader, args.temp)
+    print(', '.join('{}: {:.4f}'.format(k, v) for k, v in results.items()))
+
+    optimizer = torch.optim.Adam(student.parameters(), lr=3e-5)
+    kd_loss = DistillationLoss(args.temp, 0.5, 'mse')
+    data = torch.randn(args.batch_size, 3, args.image_size, args.image_size)
+    label = torch.randint(args.num_classes, (args.batch_size,))
+    candidates = [
+        ('fp32', FrozenTeacher(teacher, None, 'cpu').freeze()),
+        ('int8', FrozenTeacher(quantized, None, 'cpu', copy_model=False).freeze()),
+    ]
+
+    print('{:>8} {:>14} {:>14} {:>12}'.format('teacher', 'teacher fwd', 'kd step', 'img/s'))
+    for name, teacher_fn in candidates:
+        def step():
+            loss = kd_loss(student(data), teacher_fn(data), label)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+        forward = timeit(lambda: teacher_fn(data), warmup=2, iters=args.iters, device='cpu')
+        elapsed = timeit(step, warmup=2, iters=args.iters, device='cpu')
+        print('{:>8} {:>12.1f}ms {:>12.1f}ms {:>12.1f}'.format(
+            name, forward * 1e3, elapsed * 1e3, args.batch_size / elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='configs/kd/vkd.yaml', help='kd config with teacher and student')
+    parser.add_argument('--image-size', type=int, default=64, help='input resolution')
+    parser.add_argument('--num-classes', type=int, default=10, help='number of classes')
+    parser.add_argument('--batch-size', type=int, default=32, help='batch size')
+    parser.add_argument('--num-samples', type=int, default=256, help='samples used to compare the teachers')
+    parser.add_argument('--temp', type=float, default=20.0, help='distillation temperature')
+    parser.add_argument('--threads', type=int, default=0, help='intra-op threads, 0 keeps the default')
+    parser.add_argument('--iters', type=int, default=5, help='timed steps per teacher')
+    main(parser.parse_args())
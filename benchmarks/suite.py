@@ -0,0 +1,215 @@
+"""
+Offline CPU benchmark suite, written to JSON, with a comparison against a stored baseline.
+
+    python -m benchmarks.suite run --output bench.json
+    python -m benchmarks.suite run --only models kd --output bench.json
+    python -m benchmarks.suite compare baseline.json bench.json --tolerance 0.1
+
+Groups:
+    models      forward/backward latency of every configs/vit model at --image-size, rounded up
+                to a multiple of the model's patch size
+    loaders     train loader throughput of every configs/dataset transform pipeline on
+                synthetic 32x32 images
+    kd          VanillaKD student step and CoVanillaKD fused step throughput on the configs/kd models
+    checkpoint  save (atomic, blocking CheckpointWriter) and load time of the student checkpoint
+
+compare exits with status 1 if any result is worse than the baseline by more than the tolerance.
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import torch
+import yaml
+
+from benchmarks.common import load_kd_models, synthetic_loader, timeit
+
+GROUPS = ['models', 'loaders', 'kd', 'checkpoint']
+
+
+def result(name, value, unit, higher_is_better):
+    print('{:<48} {:>12.2f} {}'.format(name, value, unit))
+    return {'name': name, 'value': value, 'unit': unit, 'higher_is_better': higher_is_better}
+
+
+def bench_models(args):
+    import vit_pytorch
+
+    results = []
+    for path in sorted(glob.glob(os.path.join(args.configs, 'vit', '*.yaml'))):
+        with open(path, 'r') as f:
+            config = yaml.load(f, Loader=yaml.FullLoader)['model']
+        name = os.path.splitext(os.path.basename(path))[0]
+        patch_size = config['args']['patch_size']
+        image_size = -(-args.image_size // patch_size) * patch_size
+        if image_size != args.image_size:
+            print(f'{name}: image size {args.image_size} is not a multiple of patch size {patch_size}, using {image_size}')
+        model_args = dict(config['args'], image_size=image_size, num_classes=args.num_classes)
+        if args.depth:
+            model_args['depth'] = args.depth
+        model = getattr(vit_pytorch, config['type'])(**model_args).train()
+        data = torch.randn(args.batch_size, 3, image_size, image_size)
+        label = torch.randint(args.num_classes, (args.batch_size,))
+
+        def step():
+            model.zero_grad(set_to_none=True)
+            torch.nn.functional.cross_entropy(model(data), label).backward()
+
+        elapsed = timeit(step, warmup=1, iters=args.iters)
+        results.append(result(f'models/{name}/fwd_bwd', elapsed * 1e3, 'ms', False))
+    return results
+
+
+def bench_loaders(args):
+    from utils.batch_transforms import BatchCollate, make_batch_transforms, split_batch_transforms
+
+    results = []
+    for path in sorted(glob.glob(os.path.join(args.configs, 'dataset', '*.yaml'))):
+        with open(path, 'r') as f:
+            transforms_config = yaml.load(f, Loader=yaml.FullLoader)['dataset']['train']['transforms']
+        sample_config, batch_config = split_batch_transforms(transforms_config)
+        loader = synthetic_loader(args.samples, args.num_classes, args.batch_size, transforms=sample_config,
+                                  num_workers=args.workers)
+        if batch_config:
+            loader.collate_fn = BatchCollate(make_batch_transforms(batch_config))
+        start = time.perf_counter()
+        samples = sum(len(data) for data, _ in loader)
+        name = os.path.splitext(os.path.basename(path))[0]
+        results.append(result(f'loaders/{name}/train', samples / (time.perf_counter() - start), 'samples/s', True))
+    return results
+
+
+def make_distiller(cls, config_path, args):
+    with open(config_path, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    teacher, student = load_kd_models(config_path, args.image_size, args.num_classes)
+    loader = synthetic_loader(args.batch_size, args.num_classes, args.batch_size, args.image_size)
+    kd_args = dict(config['kd_model']['args'], device='cpu', log=False, async_checkpoint=False)
+    return cls(teacher, student, loader, loader, torch.optim.Adam(teacher.parameters(), lr=3e-5),
+               torch.optim.Adam(student.parameters(), lr=3e-5), **kd_args)
+
+
+def bench_kd(args):
+    from ckd.co_vanilla_kd import CoVanillaKD
+    from kd.vanilla_kd import VanillaKD
+
+    data = torch.randn(args.batch_size, 3, args.image_size, args.image_size)
+    label = torch.randint(args.num_classes, (args.batch_size,))
+    results = []
+
+    vkd = make_distiller(VanillaKD, os.path.join(args.configs, 'kd', 'vkd.yaml'), args)
+    vkd.teacher.freeze()
+    vkd.student_model.train()
+    elapsed = timeit(lambda: vkd._student_step(data, label, lambda s: vkd._soft_targets(data[s], None, len(label))),
+                     warmup=1, iters=args.iters)
+    results.append(result('kd/vanilla_kd/student_step', args.batch_size / elapsed, 'samples/s', True))
+
+    ckd = make_distiller(CoVanillaKD, os.path.join(args.configs, 'kd', 'ckd.yaml'), args)
+    ckd.teacher_model.train()
+    ckd.student_model.train()
+
+    def fused_step():
+        out, _ = ckd._teacher_step(data, label)
+        ckd._student_step(data, label, lambda s: out[s])
+
+    elapsed = timeit(fused_step, warmup=1, iters=args.iters)
+    results.append(result('kd/co_vanilla_kd/fused_step', args.batch_size / elapsed, 'samples/s', True))
+    return results
+
+
+def bench_checkpoint(args):
+    from utils.checkpoint import CheckpointWriter
+
+    _, student = load_kd_models(os.path.join(args.configs, 'kd', 'vkd.yaml'), args.image_size, args.num_classes)
+    optimizer = torch.optim.Adam(student.parameters(), lr=3e-5)
+    student(torch.randn(2, 3, args.image_size, args.image_size)).sum().backward()
+    optimizer.step()
+    state = {'model': student.state_dict(), 'optimizer': optimizer.state_dict()}
+    writer = CheckpointWriter(blocking=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'epoch_1.pth')
+        save = timeit(lambda: writer.save(state, path, latest=os.path.join(tmp, 'epoch_latest.pth')),
+                      warmup=1, iters=args.iters)
+        load = timeit(lambda: torch.load(path, map_location='cpu'), warmup=1, iters=args.iters)
+    writer.close()
+    return [result('checkpoint/save', save * 1e3, 'ms', False), result('checkpoint/load', load * 1e3, 'ms', False)]
+
+
+def run(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    benches = {'models': bench_models, 'loaders': bench_loaders, 'kd': bench_kd, 'checkpoint': bench_checkpoint}
+    results = []
+    for group in args.only or GROUPS:
+        results.extend(benches[group](args))
+    report = {
+        'meta': {
+            'torch': torch.__version__,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'threads': torch.get_num_threads(),
+            'args': {k: v for k, v in vars(args).items() if k != 'func'},
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Wrote {len(results)} results to {args.output}')
+
+
+def compare(args):
+    with open(args.baseline, 'r') as f:
+        baseline = {r['name']: r for r in json.load(f)['results']}
+    with open(args.current, 'r') as f:
+        current = json.load(f)['results']
+    regressions = 0
+    print('{:<48} {:>12} {:>12} {:>8}'.format('benchmark', 'baseline', 'current', 'change'))
+    for r in current:
+        base = baseline.get(r['name'])
+        if base is None:
+            print('{:<48} {:>12} {:>12.2f} {:>8}'.format(r['name'], '-', r['value'], 'new'))
+            continue
+        change = r['value'] / base['value'] - 1 if base['value'] else 0.0
+        worse = -change if r['higher_is_better'] else change
+        flag = ''
+        if worse > args.tolerance:
+            flag = '  REGRESSION'
+            regressions += 1
+        print('{:<48} {:>12.2f} {:>12.2f} {:>+7.1%}{}'.format(r['name'], base['value'], r['value'], change, flag))
+    print(f'{regressions} regression(s) beyond {args.tolerance:.0%}')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='run the benchmarks and write the results as JSON')
+    run_parser.add_argument('--output', type=str, default='bench.json', help='JSON file receiving the results')
+    run_parser.add_argument('--only', type=str, nargs='+', choices=GROUPS, default=None, help='groups to run')
+    run_parser.add_argument('--configs', type=str, default='configs', help='configs directory')
+    run_parser.add_argument('--image-size', type=int, default=64, help='input resolution')
+    run_parser.add_argument('--num-classes', type=int, default=10, help='number of classes')
+    run_parser.add_argument('--batch-size', type=int, default=8, help='batch size')
+    run_parser.add_argument('--samples', type=int, default=512, help='synthetic samples per loader measurement')
+    run_parser.add_argument('--workers', type=int, default=0, help='loader workers')
+    run_parser.add_argument('--threads', type=int, default=0, help='intra-op threads, 0 keeps the default')
+    run_parser.add_argument('--iters', type=int, default=3, help='timed repetitions')
+    run_parser.add_argument('--depth', type=int, default=None, help='override the depth of the models group')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser('compare', help='flag regressions against a baseline')
+    compare_parser.add_argument('baseline', type=str, help='baseline JSON from run')
+    compare_parser.add_argument('current', type=str, help='current JSON from run')
+    compare_parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative slowdown')
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
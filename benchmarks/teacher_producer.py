@@ -0,0 +1,66 @@
+"""
+Student epoch time with the teacher run inline against the background teacher producer.
+
+    python -m benchmarks.teacher_producer --config configs/kd/vkd.yaml --image-size 64 --teacher-cores 0-3 --student-cores 4-7
+
+'student wait' is the time the student loop blocked on the queue and 'teacher wait' the time the
+producer blocked on a full queue; whichever is larger names the side that is not the bottleneck.
+"""
+import argparse
+import time
+
+import torch
+
+from benchmarks.common import load_kd_models, synthetic_loader
+from kd.frozen_teacher import FrozenTeacher
+from kd.losses import DistillationLoss
+from kd.target_producer import TeacherTargetProducer, configure_threads, parse_cores, set_affinity
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    teacher, student = load_kd_models(args.config, args.image_size, args.num_classes)
+    teacher = FrozenTeacher(teacher.to(device), args.teacher_dtype, device).freeze()
+    student = student.to(device)
+    optimizer = torch.optim.Adam(student.parameters(), lr=3e-5)
+    kd_loss = DistillationLoss(20.0, 0.5, 'mse')
+    loader = synthetic_loader(args.batches * args.batch_size, args.num_classes, args.batch_size, args.image_size)
+
+    def step(data, label, teacher_out):
+        optimizer.zero_grad()
+        kd_loss(student(data), teacher_out, label).backward()
+        optimizer.step()
+
+    start = time.perf_counter()
+    for data, label in loader:
+        data, label = data.to(device), label.to(device)
+        step(data, label, teacher(data))
+    inline = time.perf_counter() - start
+
+    print('{:>8} {:>10} {:>14} {:>14}'.format('depth', 'epoch', 'student wait', 'teacher wait'))
+    print('{:>8} {:>9.2f}s {:>14} {:>14}'.format('inline', inline, '-', '-'))
+    configure_threads(parse_cores(args.teacher_cores), parse_cores(args.student_cores))
+    set_affinity(parse_cores(args.student_cores))
+    for depth in args.depths:
+        producer = TeacherTargetProducer(loader, teacher, device, depth, args.teacher_cores)
+        start = time.perf_counter()
+        for (data, label), teacher_out in producer:
+            step(data, label, teacher_out)
+        elapsed = time.perf_counter() - start
+        print('{:>8} {:>9.2f}s {:>13.2f}s {:>13.2f}s'.format(depth, elapsed, producer.student_wait, producer.teacher_wait))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='configs/kd/vkd.yaml', help='kd config with both models')
+    parser.add_argument('--image-size', type=int, default=64, help='input resolution')
+    parser.add_argument('--num-classes', type=int, default=10, help='number of classes')
+    parser.add_argument('--batch-size', type=int, default=16, help='images per batch')
+    parser.add_argument('--batches', type=int, default=20, help='batches per epoch')
+    parser.add_argument('--depths', type=int, nargs='+', default=[1, 2, 4], help='queue depths to test')
+    parser.add_argument('--teacher-cores', type=str, default=None, help='cores of the producer thread, e.g. 0-3')
+    parser.add_argument('--student-cores', type=str, default=None, help='cores of the student thread, e.g. 4-7')
+    parser.add_argument('--teacher-dtype', type=str, default=None, help='teacher precision')
+    parser.add_argument('--device', type=str, default='cpu', help='device to run on')
+    main(parser.parse_args())
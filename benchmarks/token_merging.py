@@ -0,0 +1,116 @@
+"""
+Frozen teacher speedup from token merging against the teacher's top-1 agreement with the
+unmerged teacher and the accuracy of a student distilled from it, for each merge count r.
+
+    python -m benchmarks.token_merging --config configs/kd/vkd.yaml --image-size 64 --r 0 2 4 8
+    python -m benchmarks.token_merging --data configs/dataset/cifar10.yaml --image-size 32 \
+        --teacher save/teacher.pth --steps 200 --r 0 4 8 12
+
+Without --data the images are synthetic, so agreement and timings are meaningful but the
+student accuracy is not (it is measured on the training images). Every student starts from the same weights and sees the same batches.
+"""
+import argparse
+import copy
+import itertools
+
+import torch
+import yaml
+from torch.utils.data import DataLoader
+
+from benchmarks.common import load_kd_models, synthetic_loader, timeit
+from kd.frozen_teacher import FrozenTeacher
+from kd.losses import DistillationLoss
+
+
+@torch.inference_mode()
+def predictions(model, loader, max_batches):
+    preds, labels = [], []
+    for data, label in itertools.islice(loader, max_batches):
+        preds.append(model(data).argmax(dim=1))
+        labels.append(label)
+    return torch.cat(preds), torch.cat(labels)
+
+
+def final_tokens(model, data, r):
+    # tokens left after the last layer, with the cls token of ViT never merged
+    protected = int(hasattr(model, 'cls_token'))
+    with torch.inference_mode():
+        tokens = model.to_patch_embedding(data[:1]).shape[1] + protected
+    for _ in range(len(model.transformer.layers)):
+        tokens -= max(min(r, (tokens - protected) // 2), 0)
+    return tokens
+
+
+def distill(student, teacher, loader, steps, temp):
+    student.train()
+    optimizer = torch.optim.Adam(student.parameters(), lr=3e-4)
+    kd_loss = DistillationLoss(temp, 0.5, 'kl')
+    torch.manual_seed(0)
+    batches = itertools.islice(itertools.cycle(loader), steps)
+    for data, label in batches:
+        loss = kd_loss(student(data), teacher(data), label)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    return student.eval()
+
+
+def main(args):
+    torch.manual_seed(0)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    teacher, student = load_kd_models(args.config, args.image_size, args.num_classes)
+    if args.teacher is not None:
+        teacher.load_state_dict(torch.load(args.teacher, map_location='cpu')['model'])
+    teacher = FrozenTeacher(teacher, None, 'cpu').freeze()
+
+    if args.data is None:
+        train_loader = synthetic_loader(args.num_samples, args.num_classes, args.batch_size, args.image_size)
+        # unshuffled, so every r is compared on the same batches
+        test_loader = DataLoader(train_loader.dataset, batch_size=args.batch_size)
+    else:
+        from utils.dataset import make_dataloaders
+
+        with open(args.data, 'r') as f:
+            data_config = yaml.load(f, Loader=yaml.FullLoader)['dataset']
+        train_loader, test_loader = make_dataloaders(data_config, args.batch_size)
+    num_batches = max(args.num_samples // args.batch_size, 1)
+    data = next(iter(test_loader))[0]
+
+    print('{:>4} {:>7} {:>13} {:>9} {:>10} {:>10} {:>9}'.format(
+        'r', 'tokens', 'teacher fwd', 'speedup', 'agreement', 'teacher', 'student'))
+    baseline, reference = None, None
+    for r in args.r:
+        teacher.model.transformer.token_merge_r = r
+        tokens = final_tokens(teacher.model, data, r)
+        elapsed = timeit(lambda: teacher(data), warmup=1, iters=args.iters, device='cpu')
+        preds, labels = predictions(teacher, test_loader, num_batches)
+        if reference is None:
+            baseline, reference = elapsed, preds
+        student_accuracy = None
+        if args.steps:
+            distilled = distill(copy.deepcopy(student), teacher, train_loader, args.steps, args.temp)
+            student_preds, student_labels = predictions(distilled, test_loader, num_batches)
+            student_accuracy = (student_preds == student_labels).float().mean().item()
+        print('{:>4} {:>7} {:>11.1f}ms {:>8.2f}x {:>10.4f} {:>10.4f} {:>9}'.format(
+            r, tokens, elapsed * 1e3, baseline / elapsed, (preds == reference).float().mean().item(),
+            (preds == labels).float().mean().item(),
+            '-' if student_accuracy is None else '{:.4f}'.format(student_accuracy)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='configs/kd/vkd.yaml', help='kd config with teacher and student')
+    parser.add_argument('--data', type=str, default=None, help='dataset config; synthetic images when omitted')
+    parser.add_argument('--teacher', type=str, default=None, help='teacher checkpoint; random weights when omitted')
+    parser.add_argument('--r', type=int, nargs='+', default=[0, 2, 4, 8],
+                        help='tokens merged per layer; start with 0 for the baseline')
+    parser.add_argument('--image-size', type=int, default=64, help='input resolution')
+    parser.add_argument('--num-classes', type=int, default=10, help='number of classes')
+    parser.add_argument('--batch-size', type=int, default=32, help='batch size')
+    parser.add_argument('--num-samples', type=int, default=256, help='samples used for agreement and accuracy')
+    parser.add_argument('--steps', type=int, default=20, help='distillation steps per student, 0 to skip')
+    parser.add_argument('--temp', type=float, default=20.0, help='distillation temperature')
+    parser.add_argument('--threads', type=int, default=0, help='intra-op threads, 0 keeps the default')
+    parser.add_argument('--iters', type=int, default=5, help='timed teacher forwards per r')
+    main(parser.parse_args())
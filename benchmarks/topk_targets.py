@@ -0,0 +1,85 @@
+"""
+Report how much top-k / low-bit teacher targets deviate from full logits.
+
+    python -m benchmarks.topk_targets --cache cache/cifar100-teacher --temp 20 --k 1 5 10 20 --bits 32 16 8
+    python -m benchmarks.topk_targets --num-classes 1000 --samples 4096 --temp 20
+
+With --cache the full logits come from a dense teacher cache written by
+cache_teacher.py, otherwise synthetic logits are used.
+
+'grad err' is the mean L1 distance between the stored and full soft targets. The KL soft loss
+has gradient (q - t) / T with respect to the student logits whatever the student q is, so this is
+exactly how far every distillation gradient moves, times T. Top-1 agreement is 1 by construction
+whenever k >= 1, as the argmax is always kept.
+"""
+import argparse
+import json
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from kd.teacher_cache import SparseSoftTargets, TeacherCache, decode_values, encode_topk
+
+
+def load_logits(args):
+    if args.cache:
+        cache = TeacherCache(args.cache)
+        if cache.format != 'dense':
+            raise ValueError('--cache must point to a dense teacher cache')
+        return torch.from_numpy(np.asarray(cache.arrays['logits'][0, :args.samples])).float()
+    generator = torch.Generator().manual_seed(0)
+    labels = torch.randint(args.num_classes, (args.samples,), generator=generator)
+    logits = torch.randn(args.samples, args.num_classes, generator=generator) * 2
+    logits[torch.arange(args.samples), labels] += 6
+    return logits
+
+
+def report(logits, temp, k, bits):
+    num_samples, num_classes = logits.shape
+    full = F.softmax(logits / temp, dim=1)
+    indices, values, scale, residual = encode_topk(logits, k, temp, bits)
+    targets = SparseSoftTargets(indices, decode_values(values, scale), residual, num_classes).to_dense()
+
+    pred = targets.argmax(dim=1)
+    stored = indices.numel() * (2 if num_classes <= 32767 else 4) + values.numel() * values.element_size()
+    stored += residual.numel() * 4 + (scale.numel() * 4 if scale is not None else 0)
+    return {
+        'k': k,
+        'bits': bits,
+        'bytes_per_sample': stored / num_samples,
+        'compression': num_classes * 4 * num_samples / stored,
+        'top1_agreement': (pred == logits.argmax(dim=1)).float().mean().item(),
+        'grad_error': (targets - full).abs().sum(dim=1).mean().item(),
+        'kl': F.kl_div(targets.clamp(min=1e-12).log(), full, reduction='batchmean').item(),
+    }
+
+
+def main(args):
+    logits = load_logits(args)
+    results = []
+    print('{:>6} {:>5} {:>12} {:>8} {:>10} {:>10} {:>10}'.format(
+        'k', 'bits', 'bytes/sample', 'ratio', 'agreement', 'grad err', 'KL'))
+    for k in args.k:
+        if k > logits.size(1):
+            continue
+        for bits in args.bits:
+            result = report(logits, args.temp, k, bits)
+            results.append(result)
+            print('{k:>6} {bits:>5} {bytes_per_sample:>12.1f} {compression:>8.1f} {top1_agreement:>10.4f} '
+                  '{grad_error:>10.4f} {kl:>10.2e}'.format(**result))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cache', type=str, default=None, help='dense teacher cache to read full logits from')
+    parser.add_argument('--num-classes', type=int, default=1000, help='classes of the synthetic logits')
+    parser.add_argument('--samples', type=int, default=4096, help='number of samples to evaluate')
+    parser.add_argument('--temp', type=float, default=20.0, help='distillation temperature')
+    parser.add_argument('--k', type=int, nargs='+', default=[1, 5, 10, 20, 50], help='top-k sizes to evaluate')
+    parser.add_argument('--bits', type=int, nargs='+', default=[32, 16, 8], help='bit widths to evaluate')
+    parser.add_argument('--output', type=str, default=None, help='optional JSON file for the results')
+    main(parser.parse_args())
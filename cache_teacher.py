@@ -0,0 +1,71 @@
+import argparse
+import os.path
+
+import torch
+import yaml
+from tqdm import tqdm
+
+from kd.teacher_cache import TeacherCache, fingerprint_model, fingerprint_transform
+from utils import parse
+from utils.dataset import make_dataloaders
+from utils.model import make_model
+
+
+def main(config, gpus, output, num_augs, seed, format='dense', k=None, bits=32):
+    train_loader, _ = make_dataloaders(config['dataset'], config['batch_size'], indexed=True)
+    dataset = train_loader.dataset
+    n_classes = len(dataset.classes)
+    config['teacher_model']['args']['num_classes'] = n_classes
+
+    os.makedirs(output, exist_ok=True)
+    with open(os.path.join(output, 'config.yaml'), 'w') as f:
+        yaml.dump(config, f)
+
+    device = torch.device(f'cuda:{gpus[0]}') if torch.cuda.is_available() else 'cpu'
+    state = torch.load(config['teacher_model_path'], map_location='cpu')
+    teacher_model = make_model(config['teacher_model'], gpus, state, device, os.path.join(output, 'log.txt'), 'teacher')
+    teacher_model.eval()
+
+    cache = TeacherCache.create(output, len(dataset), n_classes, num_augs, seed,
+                                fingerprint_model(teacher_model), fingerprint_transform(dataset),
+                                format=format, k=k, bits=bits, temp=config['kd_model']['args']['temp'])
+    dataset.seed = seed
+    with torch.no_grad():
+        for aug in range(num_augs):
+            dataset.aug = aug
+            for data, label, index in tqdm(train_loader, desc=f'Augmentation {aug}'):
+                logits = teacher_model(data.to(device))
+                cache.write(aug, index, logits, label)
+    cache.finalize()
+    print(f'Teacher cache written to {output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='configs/kd/vkd.yaml', help='path to the configuration file')
+    parser.add_argument('--data', type=str, default='configs/dataset/cifar10.yaml', help='path to the dataset configuration file')
+    parser.add_argument('--set', type=str, nargs='+', default=[], help='override configuration file')
+    parser.add_argument('--gpus', type=str, default='0', help='gpus to use')
+    parser.add_argument('--output', type=str, default=None, help='cache directory, defaults to kd_model.args.teacher_cache')
+    parser.add_argument('--num-augs', type=int, default=1, help='number of cached augmentations per sample')
+    parser.add_argument('--seed', type=int, default=0, help='base seed of the cached augmentations')
+    parser.add_argument('--format', type=str, default='dense', choices=['dense', 'topk'], help='storage format of the teacher outputs')
+    parser.add_argument('--k', type=int, default=None, help='classes kept per sample in the topk format')
+    parser.add_argument('--bits', type=int, default=32, choices=[32, 16, 8], help='bits per stored value')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        kd_config = yaml.load(f, Loader=yaml.FullLoader)
+
+    with open(args.data, 'r') as f:
+        data_config = yaml.load(f, Loader=yaml.FullLoader)
+
+    config = {**kd_config, **data_config}
+    config = parse(config, args.set)
+    output = args.output or config['kd_model']['args'].get('teacher_cache')
+    if not output:
+        parser.error('no cache directory given, set --output or kd_model.args.teacher_cache')
+    if not config['teacher_model_path']:
+        parser.error('teacher_model_path must point to the teacher checkpoint')
+    main(config, list(map(int, args.gpus.split(','))), output, args.num_augs, args.seed,
+         args.format, args.k, args.bits)
@@ -1,10 +1,17 @@
 import os
-from copy import deepcopy
 
 import matplotlib.pyplot as plt
 import torch
 import torch.nn as nn
-import wandb
+
+from kd.frozen_teacher import FrozenTeacher
+from utils import logger
+from utils.checkpoint import BestModelTracker, CheckpointWriter
+from utils.distributed import get_rank, is_main_process, micro_batches, no_sync, set_epoch, unwrap_ddp, unwrap_model
+from utils.metrics import MetricAccumulator
+from utils.precision import PrecisionPolicy, to_fp32
+from utils.profiler import StepProfiler
+
 
 class CoBaseClass:
     """
@@ -22,6 +29,24 @@ class CoBaseClass:
     :param device (str): Device used for training; 'cpu' for cpu and 'cuda' for gpu
     :param log (bool): True if logging required
     :param logdir (str): Directory for storing logs
+    :param teacher_dtype (str): None/'fp32', 'fp16' or 'bf16' autocast precision of the teacher
+        forward that produces the student's soft targets
+    :param log_interval (int): Print running loss and accuracy every log_interval steps; 0 to only
+        report at the end of each epoch
+    :param teacher_precision (str): None/'fp32', 'fp16' or 'bf16' precision of teacher training
+    :param student_precision (str): None/'fp32', 'fp16' or 'bf16' precision of the student
+        forward/backward; the distillation loss is always computed in fp32
+    :param teacher_accum_steps (int): Micro-batches each batch is split into for the teacher,
+        both when it is trained and when it produces soft targets
+    :param student_accum_steps (int): Micro-batches each batch is split into for the student;
+        gradients are accumulated and the optimizer steps once per batch
+    :param async_checkpoint (bool): Write the final checkpoints on a background thread, see
+        utils.checkpoint.CheckpointWriter
+    :param best_weights_dir (str): Keep the best weights in files in this directory instead of a
+        CPU copy, see utils.checkpoint.BestModelTracker
+    :param profiler (utils.profiler.StepProfiler): Per-phase step timers; disabled by default
+    :param log_path (str): Log file of the run, e.g. the experiment's log.txt, receiving the
+        checkpoint stall times
     """
 
     def __init__(
@@ -38,6 +63,16 @@ class CoBaseClass:
         device="cpu",
         log=False,
         logdir="./Experiments",
+        teacher_dtype=None,
+        log_interval=0,
+        teacher_precision=None,
+        student_precision=None,
+        teacher_accum_steps=1,
+        student_accum_steps=1,
+        async_checkpoint=True,
+        best_weights_dir=None,
+        profiler=None,
+        log_path=None,
     ):
 
         self.train_loader = train_loader
@@ -48,6 +83,12 @@ class CoBaseClass:
         self.distil_weight = distil_weight
         self.log = log
         self.logdir = logdir
+        self.log_interval = log_interval
+        self.teacher_accum_steps = teacher_accum_steps
+        self.student_accum_steps = student_accum_steps
+        self.checkpointer = CheckpointWriter(blocking=not async_checkpoint, log_path=log_path)
+        self.best_weights_dir = best_weights_dir
+        self.profiler = profiler if profiler is not None else StepProfiler()
 
         if device == "cpu":
             self.device = torch.device("cpu")
@@ -62,12 +103,22 @@ class CoBaseClass:
 
         if teacher_model:
             self.teacher_model = teacher_model.to(self.device)
+            self.teacher = FrozenTeacher(unwrap_ddp(self.teacher_model), teacher_dtype, self.device, cast_weights=False)
         else:
             print("Warning!!! Teacher is NONE.")
 
         self.student_model = student_model.to(self.device)
         self.loss_fn = loss_fn.to(self.device)
         self.ce_fn = nn.CrossEntropyLoss().to(self.device)
+        self.teacher_precision = PrecisionPolicy(teacher_precision, self.device, "teacher")
+        self.student_precision = PrecisionPolicy(student_precision, self.device, "student")
+
+    def _best_model_tracker(self, model, name):
+        path = None
+        if self.best_weights_dir is not None:
+            os.makedirs(self.best_weights_dir, exist_ok=True)
+            path = os.path.join(self.best_weights_dir, f"best_{name}_rank{get_rank()}.pt")
+        return BestModelTracker(model, path, name)
 
     def train_model(
         self,
@@ -78,23 +129,25 @@ class CoBaseClass:
         save_student_model=True,
         save_teacher_model_pth="./models/teacher.pt",
         save_student_model_pth="./models/student.pt",
+        fused=False,
     ):
         """
         Function that will be training the teacher
 
         :param epochs (int): Number of epochs you want to train the teacher
-        :param plot_losses (bool): True if you want to plot the losses
+        :param student_start (int): First epoch in which the student is distilled
+        :param student_step (int): Distill the student every student_step epochs after student_start
         :param save_model (bool): True if you want to save the teacher model
         :param save_model_pth (str): Path where you want to store the teacher model
+        :param fused (bool): In student epochs, train teacher and student from a single pass over
+            each batch, reusing the teacher's training forward as the student's soft target
         """
         self.teacher_model.train()
         loss_arr_teacher = []
         loss_arr_student = []
         length_of_dataset = len(self.train_loader.dataset)
-        best_acc_teacher = 0.0
-        best_acc_student = 0.0
-        self.best_teacher_model_weights = deepcopy(self.teacher_model.state_dict())
-        self.best_student_model_weights = deepcopy(self.student_model.state_dict())
+        self.best_teacher = self._best_model_tracker(self.teacher_model, "teacher")
+        self.best_student = self._best_model_tracker(self.student_model, "student")
         
         save_teacher_dir = os.path.dirname(save_teacher_model_pth)
         save_student_dir = os.path.dirname(save_student_model_pth)
@@ -104,44 +157,40 @@ class CoBaseClass:
             os.makedirs(save_student_dir)
 
         for ep in range(epochs):
-            print("Training Teacher... ")
-            epoch_loss = 0.0
-            correct = 0
-            i = 0
-
-            for (data, label) in self.train_loader:
-                i += 1
-                # print("The", str(i), "th iteration with label:", label)
-                data = data.to(self.device)
-                label = label.to(self.device)
-                out = self.teacher_model(data)
-
-                if isinstance(out, tuple):
-                    out = out[0]
-
-                pred = out.argmax(dim=1, keepdim=True)
-                correct += pred.eq(label.view_as(pred)).sum().item()
+            set_epoch(self.train_loader, ep)
+            student_epoch = ep >= student_start and (ep - student_start) % student_step == 0
+            if fused and student_epoch:
+                print("Training Teacher and Students... ")
+                epoch_loss, correct, student_epoch_loss, student_correct = self._train_fused_epoch()
+            else:
+                print("Training Teacher... ")
+                self.teacher_model.train()
+                metrics = MetricAccumulator(self.device, self.log_interval)
+                i = 0
 
-                loss = self.ce_fn(out, label)
+                for (data, label) in self.profiler.iterate(self.train_loader):
+                    i += 1
+                    # print("The", str(i), "th iteration with label:", label)
+                    with self.profiler.phase("h2d"):
+                        data = data.to(self.device)
+                        label = label.to(self.device)
+                    out, loss = self._teacher_step(data, label)
 
-                self.optimizer_teacher.zero_grad()
-                loss.backward()
-                self.optimizer_teacher.step()
+                    if metrics.update(out, label, loss):
+                        print("Teacher Step: {}, Loss: {}, Accuracy: {}".format(metrics.steps, *metrics.running()))
+                    self.profiler.step()
 
-                epoch_loss += loss.item()
+                epoch_loss, correct = metrics.compute()
+                self.profiler.report("teacher", self.log)
 
             epoch_acc = correct / length_of_dataset
 
             epoch_val_acc = self.evaluate(teacher=True)
 
-            if epoch_val_acc > best_acc_teacher:
-                best_acc_teacher = epoch_val_acc
-                self.best_teacher_model_weights = deepcopy(
-                    self.teacher_model.state_dict()
-                )
+            self.best_teacher.update(epoch_val_acc)
 
             if self.log:
-                wandb.log({"teacher_train_loss": epoch_loss, "teacher_train_acc": epoch_acc, "teacher_test_acc": epoch_val_acc, "teacher_epoch": ep})
+                logger.log({"teacher_train_loss": epoch_loss, "teacher_train_acc": epoch_acc, "teacher_test_acc": epoch_val_acc, "teacher_epoch": ep})
 
             loss_arr_teacher.append(epoch_loss)
             print(
@@ -149,66 +198,154 @@ class CoBaseClass:
                     ep + 1, epoch_loss, epoch_acc
                 )
             )
-            if ep>=student_start and (ep-student_start)%student_step==0:
-                print("Training students...")
-                self.teacher_model.eval()
-                self.student_model.train()
-                student_epoch_loss = 0.0 
-                student_correct = 0 
-                i = 0 
-                for (data, label) in self.train_loader:
-                    i += 1
-                    # print("The", str(i), "th iteration with label:", label)
-                    data = data.to(self.device)
-                    label = label.to(self.device)
-
-                    student_out = self.student_model(data)
-                    teacher_out = self.teacher_model(data)
-
-                    loss = self.calculate_kd_loss(student_out, teacher_out, label)
-
-                    if isinstance(student_out, tuple):
-                        student_out = student_out[0]
-
-                    pred = student_out.argmax(dim=1, keepdim=True)
-                    student_correct += pred.eq(label.view_as(pred)).sum().item()
-
-                    self.optimizer_student.zero_grad()
-                    loss.backward()
-                    self.optimizer_student.step()
-
-                    student_epoch_loss += loss.item()
+            if student_epoch:
+                if not fused:
+                    print("Training students...")
+                    self.teacher_model.eval()
+                    self.student_model.train()
+                    student_metrics = MetricAccumulator(self.device, self.log_interval)
+                    i = 0 
+                    for (data, label) in self.profiler.iterate(self.train_loader):
+                        i += 1
+                        # print("The", str(i), "th iteration with label:", label)
+                        with self.profiler.phase("h2d"):
+                            data = data.to(self.device)
+                            label = label.to(self.device)
+                        teacher_size = -(-len(label) // self.teacher_accum_steps)
+
+                        student_out, loss = self._student_step(
+                            data, label, lambda s: torch.cat([self.teacher(chunk) for chunk in data[s].split(teacher_size)])
+                        )
+
+                        if student_metrics.update(student_out, label, loss):
+                            print("Student Step: {}, Loss: {}, Accuracy: {}".format(student_metrics.steps, *student_metrics.running()))
+                        self.profiler.step()
+
+                    student_epoch_loss, student_correct = student_metrics.compute()
+                    self.profiler.report("student", self.log)
 
                 epoch_acc = student_correct / length_of_dataset
 
                 _, epoch_val_acc = self._evaluate_model(self.student_model, verbose=True)
 
-                if epoch_val_acc > best_acc_student:
-                    best_acc_student = epoch_val_acc
-                    self.best_student_model_weights = deepcopy(
-                        self.student_model.state_dict()
-                    )
+                self.best_student.update(epoch_val_acc)
 
                 if self.log:
-                    wandb.log({"student_train_loss": epoch_loss, "student_train_acc": epoch_acc, "student_test_acc": epoch_val_acc, "student_epoch": ep})
+                    logger.log({"student_train_loss": student_epoch_loss, "student_train_acc": epoch_acc, "student_test_acc": epoch_val_acc, "student_epoch": ep})
 
-                loss_arr_student.append(epoch_loss)
+                loss_arr_student.append(student_epoch_loss)
                 print(
                     "Student Epoch: {}, Loss: {}, Accuracy: {}".format(
-                        ep + 1, epoch_loss, epoch_acc
+                        ep + 1, student_epoch_loss, epoch_acc
                     )
                 )
             
-        self.teacher_model.load_state_dict(self.best_teacher_model_weights)
-        self.student_model.load_state_dict(self.best_student_model_weights)
-        if save_teacher_model:
-            torch.save(self.teacher_model.state_dict(), save_teacher_model_pth)
-        if save_student_model:
-            torch.save(self.student_model.state_dict(), save_student_model_pth)
+        self.best_teacher.restore()
+        self.best_student.restore()
+        if save_teacher_model and is_main_process():
+            self.checkpointer.save(
+                {"model": unwrap_model(self.teacher_model).state_dict(), "scaler": self.teacher_precision.state_dict()},
+                save_teacher_model_pth,
+            )
+        if save_student_model and is_main_process():
+            self.checkpointer.save(
+                {"model": unwrap_model(self.student_model).state_dict(), "scaler": self.student_precision.state_dict()},
+                save_student_model_pth,
+            )
         # if plot_losses:
         #     plt.plot(loss_arr_teacher)
         #     plt.plot(loss_arr_student)
 
+    def _train_fused_epoch(self):
+        """
+        One pass over train_loader that updates the teacher with CE and distills the student
+        from the teacher's detached training-mode output on the same batch.
+        For internal use only.
+        """
+        self.teacher_model.train()
+        self.student_model.train()
+        teacher_metrics = MetricAccumulator(self.device, self.log_interval)
+        student_metrics = MetricAccumulator(self.device, self.log_interval)
+
+        for (data, label) in self.profiler.iterate(self.train_loader):
+            with self.profiler.phase("h2d"):
+                data = data.to(self.device)
+                label = label.to(self.device)
+
+            out, loss = self._teacher_step(data, label)
+
+            if teacher_metrics.update(out, label, loss):
+                print("Teacher Step: {}, Loss: {}, Accuracy: {}".format(teacher_metrics.steps, *teacher_metrics.running()))
+
+            student_out, loss = self._student_step(data, label, lambda s: out[s])
+
+            if student_metrics.update(student_out, label, loss):
+                print("Student Step: {}, Loss: {}, Accuracy: {}".format(student_metrics.steps, *student_metrics.running()))
+            self.profiler.step()
+
+        self.profiler.report("fused", self.log)
+        return teacher_metrics.compute() + student_metrics.compute()
+
+    def _teacher_step(self, data, label):
+        """
+        One optimizer step of the teacher on a batch, with the gradients accumulated over
+        teacher_accum_steps micro-batches. Returns the detached fp32 logits and the batch loss.
+        For internal use only.
+        """
+        slices = micro_batches(len(label), self.teacher_accum_steps)
+        outs, batch_loss = [], 0.0
+        self.optimizer_teacher.zero_grad()
+        for j, s in enumerate(slices):
+            with no_sync(self.teacher_model, j < len(slices) - 1):
+                with self.profiler.phase("teacher_forward"), self.teacher_precision.autocast():
+                    out = self.teacher_model(data[s])
+
+                if isinstance(out, tuple):
+                    out = out[0]
+                out = out.float()
+
+                with self.profiler.phase("teacher_loss"):
+                    loss = self.ce_fn(out, label[s]) * ((s.stop - s.start) / len(label))
+                with self.profiler.phase("teacher_backward"):
+                    self.teacher_precision.backward(loss)
+            outs.append(out.detach())
+            batch_loss += loss.detach()
+        with self.profiler.phase("teacher_optimizer"):
+            self.teacher_precision.optimizer_step(self.optimizer_teacher)
+        return torch.cat(outs), batch_loss
+
+    def _student_step(self, data, label, soft_targets):
+        """
+        One optimizer step of the student on a batch, with the gradients accumulated over
+        student_accum_steps micro-batches. soft_targets(s) gives the teacher outputs of the
+        micro-batch data[s], so only one micro-batch of them is alive at a time. Returns the
+        detached fp32 logits and the batch loss. For internal use only.
+        """
+        slices = micro_batches(len(label), self.student_accum_steps)
+        outs, batch_loss = [], 0.0
+        self.optimizer_student.zero_grad()
+        for j, s in enumerate(slices):
+            with no_sync(self.student_model, j < len(slices) - 1):
+                with self.profiler.phase("teacher"):
+                    teacher_out = soft_targets(s)
+                with self.profiler.phase("student_forward"), self.student_precision.autocast():
+                    student_out = self.student_model(data[s])
+
+                with self.profiler.phase("loss"):
+                    loss = self.calculate_kd_loss(to_fp32(student_out), teacher_out, label[s])
+                    loss = loss * ((s.stop - s.start) / len(label))
+
+                if isinstance(student_out, tuple):
+                    student_out = student_out[0]
+
+                with self.profiler.phase("backward"):
+                    self.student_precision.backward(loss)
+            outs.append(student_out.detach().float())
+            batch_loss += loss.detach()
+        with self.profiler.phase("optimizer"):
+            self.student_precision.optimizer_step(self.optimizer_student)
+        return torch.cat(outs), batch_loss
+
     def calculate_kd_loss(self, y_pred_student, y_pred_teacher, y_true):
         """
         Custom loss function to calculate the KD loss for various implementations
@@ -222,15 +359,17 @@ class CoBaseClass:
 
     def _evaluate_model(self, model, verbose=True):
         """
-        Evaluate the given model's accuaracy over val set.
-        For internal use only.
+        Evaluate the given model's accuaracy over val set, in eval mode; the model's
+        training mode is restored afterwards. For internal use only.
 
         :param model (nn.Module): Model to be used for evaluation
         :param verbose (bool): Display Accuracy
         """
+        model = unwrap_ddp(model)
+        training = model.training
         model.eval()
         length_of_dataset = len(self.val_loader.dataset)
-        correct = 0
+        metrics = MetricAccumulator(self.device)
         outputs = []
         # print("in eval model:")
         with torch.no_grad():
@@ -246,9 +385,10 @@ class CoBaseClass:
                     output = output[0]
                 outputs.append(output)
 
-                pred = output.argmax(dim=1, keepdim=True)
-                correct += pred.eq(target.view_as(pred)).sum().item()
+                metrics.update(output, target)
 
+        model.train(training)
+        _, correct = metrics.compute()
         accuracy = correct / length_of_dataset
 
         if verbose:
@@ -262,10 +402,7 @@ class CoBaseClass:
 
         :param teacher (bool): True if you want accuracy of the teacher network
         """
-        if teacher:
-            model = deepcopy(self.teacher_model).to(self.device)
-        else:
-            model = deepcopy(self.student_model).to(self.device)
+        model = self.teacher_model if teacher else self.student_model
         _, accuracy = self._evaluate_model(model)
 
         return accuracy
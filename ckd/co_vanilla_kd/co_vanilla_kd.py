@@ -2,6 +2,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from ckd import CoBaseClass
+from kd.losses import DistillationLoss, resolve_soft_loss
 
 
 class CoVanillaKD(CoBaseClass):
@@ -21,6 +22,18 @@ class CoVanillaKD(CoBaseClass):
     :param device (str): Device used for training; 'cpu' for cpu and 'cuda' for gpu
     :param log (bool): True if logging required
     :param logdir (str): Directory for storing logs
+    :param soft_loss (str): 'kl' or 'mse' to use the fused distillation loss; by default a
+        mean-reduced nn.MSELoss loss_fn is fused as 'mse' and other loss_fns are left unfused
+    :param teacher_dtype (str): None/'fp32', 'fp16' or 'bf16' precision of the teacher forward
+    :param log_interval (int): Print running loss and accuracy every log_interval steps
+    :param teacher_precision (str): None/'fp32', 'fp16' or 'bf16' precision of teacher training
+    :param student_precision (str): None/'fp32', 'fp16' or 'bf16' precision of student training
+    :param teacher_accum_steps (int): Micro-batches per batch for the teacher
+    :param student_accum_steps (int): Micro-batches per batch for the student
+    :param async_checkpoint (bool): Write the final checkpoints on a background thread
+    :param best_weights_dir (str): Keep the best weights in this directory instead of CPU memory
+    :param profiler (utils.profiler.StepProfiler): Per-phase step timers
+    :param log_path (str): Log file receiving the checkpoint stall times
     """
 
     def __init__(
@@ -37,6 +50,17 @@ class CoVanillaKD(CoBaseClass):
         device="cuda",
         log=False,
         logdir="./Experiments",
+        soft_loss=None,
+        teacher_dtype=None,
+        log_interval=0,
+        teacher_precision=None,
+        student_precision=None,
+        teacher_accum_steps=1,
+        student_accum_steps=1,
+        async_checkpoint=True,
+        best_weights_dir=None,
+        profiler=None,
+        log_path=None,
     ):
         super(CoVanillaKD, self).__init__(
             teacher_model,
@@ -51,7 +75,21 @@ class CoVanillaKD(CoBaseClass):
             device,
             log,
             logdir,
+            teacher_dtype=teacher_dtype,
+            log_interval=log_interval,
+            teacher_precision=teacher_precision,
+            student_precision=student_precision,
+            teacher_accum_steps=teacher_accum_steps,
+            student_accum_steps=student_accum_steps,
+            async_checkpoint=async_checkpoint,
+            best_weights_dir=best_weights_dir,
+            profiler=profiler,
+            log_path=log_path,
         )
+        self.soft_loss = resolve_soft_loss(soft_loss, loss_fn)
+        self.kd_loss = None
+        if self.soft_loss is not None:
+            self.kd_loss = DistillationLoss(temp, distil_weight, self.soft_loss)
 
     def calculate_kd_loss(self, y_pred_student, y_pred_teacher, y_true):
         """
@@ -62,6 +100,9 @@ class CoVanillaKD(CoBaseClass):
         :param y_true (torch.FloatTensor): Original label
         """
 
+        if self.kd_loss is not None:
+            return self.kd_loss(y_pred_student, y_pred_teacher, y_true)
+
         soft_teacher_out = F.softmax(y_pred_teacher / self.temp, dim=1)
         soft_student_out = F.softmax(y_pred_student / self.temp, dim=1)
 
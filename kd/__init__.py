@@ -1 +1,2 @@
-from .base_class import BaseClass
\ No newline at end of file
+from .base_class import BaseClass
+from .teacher_cache import SparseSoftTargets, TeacherCache
@@ -1,10 +1,20 @@
 import os
-from copy import deepcopy
 
 import matplotlib.pyplot as plt
 import torch
 import torch.nn as nn
-import wandb
+
+from utils import logger
+from utils.checkpoint import BestModelTracker, CheckpointWriter
+from utils.distributed import get_rank, is_main_process, micro_batches, no_sync, set_epoch, unwrap_ddp, unwrap_model
+from utils.metrics import MetricAccumulator
+from utils.precision import PrecisionPolicy, to_fp32
+from utils.profiler import StepProfiler
+from .frozen_teacher import FrozenTeacher
+from .quantize import compare_teachers, quantize_teacher
+from .target_producer import TeacherTargetProducer, configure_threads, parse_cores, set_affinity
+from .teacher_cache import TeacherCache
+
 
 class BaseClass:
     """
@@ -22,6 +32,31 @@ class BaseClass:
     :param device (str): Device used for training; 'cpu' for cpu and 'cuda' for gpu
     :param log (bool): True if logging required
     :param logdir (str): Directory for storing logs
+    :param teacher_cache (str): Directory of a precomputed teacher cache; if given, the student
+        is distilled from cached logits instead of running the teacher
+    :param teacher_dtype (str): None/'fp32', 'fp16' or 'bf16' precision of the frozen teacher
+    :param log_interval (int): Print running loss and accuracy every log_interval steps; 0 to only
+        report at the end of each epoch
+    :param teacher_precision (str): None/'fp32', 'fp16' or 'bf16' precision of teacher training
+    :param student_precision (str): None/'fp32', 'fp16' or 'bf16' precision of the student
+        forward/backward; the distillation loss is always computed in fp32
+    :param teacher_accum_steps (int): Micro-batches each batch is split into for the teacher,
+        both when it is trained and when it produces soft targets
+    :param student_accum_steps (int): Micro-batches each batch is split into for the student;
+        gradients are accumulated and the optimizer steps once per batch
+    :param producer_depth (int): Run the frozen teacher in a background thread up to this many
+        batches ahead of the student; 0 to run it inline
+    :param teacher_cores (list or str): CPU cores the teacher producer thread is pinned to, best
+        effort, e.g. '0-7'
+    :param student_cores (list or str): CPU cores the student (main) thread is pinned to, best
+        effort, e.g. '8-15'
+    :param async_checkpoint (bool): Write the final checkpoints on a background thread, see
+        utils.checkpoint.CheckpointWriter
+    :param best_weights_dir (str): Keep the best weights in files in this directory instead of a
+        CPU copy, see utils.checkpoint.BestModelTracker
+    :param profiler (utils.profiler.StepProfiler): Per-phase step timers; disabled by default
+    :param log_path (str): Log file of the run, e.g. the experiment's log.txt, receiving the
+        checkpoint stall times
     """
 
     def __init__(
@@ -38,6 +73,20 @@ class BaseClass:
         device="cpu",
         log=False,
         logdir="./Experiments",
+        teacher_cache=None,
+        teacher_dtype=None,
+        log_interval=0,
+        teacher_precision=None,
+        student_precision=None,
+        teacher_accum_steps=1,
+        student_accum_steps=1,
+        producer_depth=0,
+        teacher_cores=None,
+        student_cores=None,
+        async_checkpoint=True,
+        best_weights_dir=None,
+        profiler=None,
+        log_path=None,
     ):
 
         self.train_loader = train_loader
@@ -48,6 +97,15 @@ class BaseClass:
         self.distil_weight = distil_weight
         self.log = log
         self.logdir = logdir
+        self.log_interval = log_interval
+        self.teacher_accum_steps = teacher_accum_steps
+        self.student_accum_steps = student_accum_steps
+        self.producer_depth = producer_depth
+        self.teacher_cores = teacher_cores
+        self.student_cores = student_cores
+        self.checkpointer = CheckpointWriter(blocking=not async_checkpoint, log_path=log_path)
+        self.best_weights_dir = best_weights_dir
+        self.profiler = profiler if profiler is not None else StepProfiler()
 
         if device == "cpu":
             self.device = torch.device("cpu")
@@ -62,17 +120,117 @@ class BaseClass:
 
         if teacher_model:
             self.teacher_model = teacher_model.to(self.device)
+            self.teacher = FrozenTeacher(unwrap_ddp(self.teacher_model), teacher_dtype, self.device)
         else:
             print("Warning!!! Teacher is NONE.")
 
         self.student_model = student_model.to(self.device)
         self.loss_fn = loss_fn.to(self.device)
         self.ce_fn = nn.CrossEntropyLoss().to(self.device)
+        self.teacher_precision = PrecisionPolicy(teacher_precision, self.device, "teacher")
+        self.student_precision = PrecisionPolicy(student_precision, self.device, "student")
+        self.teacher_cache = TeacherCache(teacher_cache) if teacher_cache else None
+
+    def load_teacher(self, load_model_pth, quantize=False, report=True):
+        """
+        Load the teacher weights, optionally distilling from a dynamically quantized int8 copy
 
-    def load_teacher(self, load_model_pth):
+        :param load_model_pth (str): Checkpoint of the teacher
+        :param quantize (bool): Distill from an int8 copy of the teacher; CPU only
+        :param report (bool): Compare the int8 and fp32 teacher logits on the validation set
+        """
         print("Loading Teacher")
-        self.teacher_model.load_state_dict(torch.load(load_model_pth)['model'])
+        unwrap_model(self.teacher_model).load_state_dict(torch.load(load_model_pth, map_location="cpu")['model'])
         self.teacher_model.to(self.device)
+        if not quantize:
+            return
+        if self.device.type != "cpu":
+            print("The int8 teacher only runs on CPU. Distilling from the fp32 teacher.")
+            return
+        print("Quantizing Teacher")
+        quantized = quantize_teacher(unwrap_model(self.teacher_model))
+        self.teacher = FrozenTeacher(quantized, None, self.device, copy_model=False)
+        if report:
+            results = compare_teachers(unwrap_model(self.teacher_model), quantized, self.val_loader, self.temp)
+            print("int8 teacher: " + ", ".join("{}: {:.4f}".format(k, v) for k, v in results.items()))
+            if self.log:
+                logger.log({"teacher_int8_" + k: v for k, v in results.items()})
+
+    def _teacher_step(self, data, label):
+        """
+        One optimizer step of the teacher on a batch, with the gradients accumulated over
+        teacher_accum_steps micro-batches. Returns the detached fp32 logits and the batch loss.
+        For internal use only.
+        """
+        slices = micro_batches(len(label), self.teacher_accum_steps)
+        outs, batch_loss = [], 0.0
+        self.optimizer_teacher.zero_grad()
+        for j, s in enumerate(slices):
+            with no_sync(self.teacher_model, j < len(slices) - 1):
+                with self.profiler.phase("teacher_forward"), self.teacher_precision.autocast():
+                    out = self.teacher_model(data[s])
+
+                if isinstance(out, tuple):
+                    out = out[0]
+                out = out.float()
+
+                with self.profiler.phase("teacher_loss"):
+                    loss = self.ce_fn(out, label[s]) * ((s.stop - s.start) / len(label))
+                with self.profiler.phase("teacher_backward"):
+                    self.teacher_precision.backward(loss)
+            outs.append(out.detach())
+            batch_loss += loss.detach()
+        with self.profiler.phase("teacher_optimizer"):
+            self.teacher_precision.optimizer_step(self.optimizer_teacher)
+        return torch.cat(outs), batch_loss
+
+    def _student_step(self, data, label, soft_targets):
+        """
+        One optimizer step of the student on a batch, with the gradients accumulated over
+        student_accum_steps micro-batches. soft_targets(s) gives the teacher outputs of the
+        micro-batch data[s], so only one micro-batch of them is alive at a time. Returns the
+        detached fp32 logits and the batch loss. For internal use only.
+        """
+        slices = micro_batches(len(label), self.student_accum_steps)
+        outs, batch_loss = [], 0.0
+        self.optimizer_student.zero_grad()
+        for j, s in enumerate(slices):
+            with no_sync(self.student_model, j < len(slices) - 1):
+                with self.profiler.phase("teacher"):
+                    teacher_out = soft_targets(s)
+                with self.profiler.phase("student_forward"), self.student_precision.autocast():
+                    student_out = self.student_model(data[s])
+
+                with self.profiler.phase("loss"):
+                    loss = self.calculate_kd_loss(to_fp32(student_out), teacher_out, label[s])
+                    loss = loss * ((s.stop - s.start) / len(label))
+
+                if isinstance(student_out, tuple):
+                    student_out = student_out[0]
+
+                with self.profiler.phase("backward"):
+                    self.student_precision.backward(loss)
+            outs.append(student_out.detach().float())
+            batch_loss += loss.detach()
+        with self.profiler.phase("optimizer"):
+            self.student_precision.optimizer_step(self.optimizer_student)
+        return torch.cat(outs), batch_loss
+
+    def _soft_targets(self, data, index, size):
+        """
+        Teacher outputs of a micro-batch, read from the teacher cache by sample index or computed
+        by the frozen teacher in chunks of at most size samples. For internal use only.
+        """
+        if self.teacher_cache is not None:
+            return self.teacher_cache.read(self.train_loader.dataset.aug, index).to(self.device)
+        return torch.cat([self.teacher(chunk) for chunk in data.split(size)])
+
+    def _best_model_tracker(self, model, name):
+        path = None
+        if self.best_weights_dir is not None:
+            os.makedirs(self.best_weights_dir, exist_ok=True)
+            path = os.path.join(self.best_weights_dir, f"best_{name}_rank{get_rank()}.pt")
+        return BestModelTracker(model, path, name)
 
     def train_teacher(
         self,
@@ -92,8 +250,7 @@ class BaseClass:
         self.teacher_model.train()
         loss_arr = []
         length_of_dataset = len(self.train_loader.dataset)
-        best_acc = 0.0
-        self.best_teacher_model_weights = deepcopy(self.teacher_model.state_dict())
+        self.best_teacher = self._best_model_tracker(self.teacher_model, "teacher")
 
         save_dir = os.path.dirname(save_model_pth)
         if not os.path.exists(save_dir):
@@ -102,45 +259,34 @@ class BaseClass:
         print("Training Teacher... ")
 
         for ep in range(epochs):
-            epoch_loss = 0.0
-            correct = 0
+            metrics = MetricAccumulator(self.device, self.log_interval)
+            set_epoch(self.train_loader, ep)
             i = 0
             # print("Epoch number:", str(i))
-            for (data, label) in self.train_loader:
+            for (data, label) in self.profiler.iterate(self.train_loader):
                 # i += 1
                 # print("The", str(i), "th iteration with label:", label)
                 # if i >= 3:
                 #     break 
-                data = data.to(self.device)
-                label = label.to(self.device)
-                out = self.teacher_model(data)
-
-                if isinstance(out, tuple):
-                    out = out[0]
-
-                pred = out.argmax(dim=1, keepdim=True)
-                correct += pred.eq(label.view_as(pred)).sum().item()
-
-                loss = self.ce_fn(out, label)
+                with self.profiler.phase("h2d"):
+                    data = data.to(self.device)
+                    label = label.to(self.device)
+                out, loss = self._teacher_step(data, label)
 
-                self.optimizer_teacher.zero_grad()
-                loss.backward()
-                self.optimizer_teacher.step()
-
-                epoch_loss += loss.item()
+                if metrics.update(out, label, loss):
+                    print("Step: {}, Loss: {}, Accuracy: {}".format(metrics.steps, *metrics.running()))
+                self.profiler.step()
 
+            epoch_loss, correct = metrics.compute()
+            self.profiler.report("teacher", self.log)
             epoch_acc = correct / length_of_dataset
 
             epoch_val_acc = self.evaluate(teacher=True)
 
-            if epoch_val_acc > best_acc:
-                best_acc = epoch_val_acc
-                self.best_teacher_model_weights = deepcopy(
-                    self.teacher_model.state_dict()
-                )
+            self.best_teacher.update(epoch_val_acc)
 
             if self.log:
-                wandb.log({"teacher_train_loss": epoch_loss, "teacher_train_acc": epoch_acc, "teacher_test_acc": epoch_val_acc, "teacher_epoch": ep})
+                logger.log({"teacher_train_loss": epoch_loss, "teacher_train_acc": epoch_acc, "teacher_test_acc": epoch_val_acc, "teacher_epoch": ep})
 
             loss_arr.append(epoch_loss)
             print(
@@ -151,9 +297,12 @@ class BaseClass:
 
             # self.post_epoch_call(ep)
 
-        self.teacher_model.load_state_dict(self.best_teacher_model_weights)
-        if save_model:
-            torch.save(self.teacher_model.state_dict(), save_model_pth)
+        self.best_teacher.restore()
+        if save_model and is_main_process():
+            self.checkpointer.save(
+                {"model": unwrap_model(self.teacher_model).state_dict(), "scaler": self.teacher_precision.state_dict()},
+                save_model_pth,
+            )
         if plot_losses:
             plt.plot(loss_arr)
 
@@ -172,61 +321,83 @@ class BaseClass:
         :param save_model (bool): True if you want to save the student model
         :param save_model_pth (str): Path where you want to save the student model
         """
-        self.teacher_model.eval()
         self.student_model.train()
         loss_arr = []
         length_of_dataset = len(self.train_loader.dataset)
-        best_acc = 0.0
-        self.best_student_model_weights = deepcopy(self.student_model.state_dict())
+        self.best_student = self._best_model_tracker(self.student_model, "student")
 
         save_dir = os.path.dirname(save_model_pth)
         if not os.path.exists(save_dir):
             os.makedirs(save_dir)
 
+        if self.teacher_cache is not None:
+            print("Validating teacher cache...")
+            self.teacher_cache.validate(self.teacher_model, self.train_loader.dataset, self.temp)
+            self.train_loader.dataset.seed = self.teacher_cache.seed
+            if self.teacher_cache.num_augs > 1 and getattr(self.train_loader, "persistent_workers", False):
+                raise ValueError(
+                    "Persistent workers keep a stale copy of the dataset and would not replay the cached "
+                    "augmentation of each epoch. Disable persistent_workers to use a teacher cache."
+                )
+
+        self.teacher.freeze()
+
+        producer = None
+        if self.producer_depth and self.teacher_cache is None:
+            configure_threads(parse_cores(self.teacher_cores), parse_cores(self.student_cores))
+            set_affinity(parse_cores(self.student_cores))
+            producer = TeacherTargetProducer(
+                self.train_loader,
+                lambda data: self._soft_targets(data, None, -(-len(data) // self.teacher_accum_steps)),
+                self.device,
+                self.producer_depth,
+                self.teacher_cores,
+            )
+
         print("Training Student...")
 
         for ep in range(epochs):
-            epoch_loss = 0.0
-            correct = 0
+            metrics = MetricAccumulator(self.device, self.log_interval)
+            set_epoch(self.train_loader, ep)
             i = 0
             print("Epoch number:", str(i))
-            for (data, label) in self.train_loader:
+            if self.teacher_cache is not None:
+                self.train_loader.dataset.aug = ep % self.teacher_cache.num_augs
+            for batch in self.profiler.iterate(producer if producer is not None else self.train_loader):
                 # i += 1
                 # print("The", str(i), "th iteration with label:", label)
                 # if i >= 3:
                 #     break 
-                data = data.to(self.device)
-                label = label.to(self.device)
-
-                student_out = self.student_model(data)
-                teacher_out = self.teacher_model(data)
-
-                loss = self.calculate_kd_loss(student_out, teacher_out, label)
-
-                if isinstance(student_out, tuple):
-                    student_out = student_out[0]
-
-                pred = student_out.argmax(dim=1, keepdim=True)
-                correct += pred.eq(label.view_as(pred)).sum().item()
-
-                self.optimizer_student.zero_grad()
-                loss.backward()
-                self.optimizer_student.step()
-
-                epoch_loss += loss.item()
-
+                if producer is not None:
+                    (data, label), teacher_out = batch
+                    student_out, loss = self._student_step(data, label, lambda s: teacher_out[s])
+                else:
+                    with self.profiler.phase("h2d"):
+                        data = batch[0].to(self.device)
+                        label = batch[1].to(self.device)
+                    index = batch[2] if self.teacher_cache is not None else None
+                    teacher_size = -(-len(label) // self.teacher_accum_steps)
+
+                    student_out, loss = self._student_step(
+                        data, label, lambda s: self._soft_targets(data[s], None if index is None else index[s], teacher_size)
+                    )
+
+                if metrics.update(student_out, label, loss):
+                    print("Step: {}, Loss: {}, Accuracy: {}".format(metrics.steps, *metrics.running()))
+                self.profiler.step()
+
+            epoch_loss, correct = metrics.compute()
+            self.profiler.report("student", self.log)
             epoch_acc = correct / length_of_dataset
+            if producer is not None:
+                print(producer.report())
 
             _, epoch_val_acc = self._evaluate_model(self.student_model, verbose=True)
 
-            if epoch_val_acc > best_acc:
-                best_acc = epoch_val_acc
-                self.best_student_model_weights = deepcopy(
-                    self.student_model.state_dict()
-                )
+            self.best_student.update(epoch_val_acc)
 
             if self.log:
-                wandb.log({"student_train_loss": epoch_loss, "student_train_acc": epoch_acc, "student_test_acc": epoch_val_acc, "student_epoch": ep})
+                logger.log({"student_train_loss": epoch_loss, "student_train_acc": epoch_acc, "student_test_acc": epoch_val_acc, "student_epoch": ep})
 
             loss_arr.append(epoch_loss)
             print(
@@ -235,9 +406,12 @@ class BaseClass:
                 )
             )
 
-        self.student_model.load_state_dict(self.best_student_model_weights)
-        if save_model:
-            torch.save(self.student_model.state_dict(), save_model_pth)
+        self.best_student.restore()
+        if save_model and is_main_process():
+            self.checkpointer.save(
+                {"model": unwrap_model(self.student_model).state_dict(), "scaler": self.student_precision.state_dict()},
+                save_model_pth,
+            )
         if plot_losses:
             plt.plot(loss_arr)
 
@@ -271,15 +445,17 @@ class BaseClass:
 
     def _evaluate_model(self, model, verbose=True):
         """
-        Evaluate the given model's accuaracy over val set.
-        For internal use only.
+        Evaluate the given model's accuaracy over val set, in eval mode; the model's
+        training mode is restored afterwards. For internal use only.
 
         :param model (nn.Module): Model to be used for evaluation
         :param verbose (bool): Display Accuracy
         """
+        model = unwrap_ddp(model)
+        training = model.training
         model.eval()
         length_of_dataset = len(self.val_loader.dataset)
-        correct = 0
+        metrics = MetricAccumulator(self.device)
         outputs = []
         print("in eval model:")
         with torch.no_grad():
@@ -297,9 +473,10 @@ class BaseClass:
                     output = output[0]
                 outputs.append(output)
 
-                pred = output.argmax(dim=1, keepdim=True)
-                correct += pred.eq(target.view_as(pred)).sum().item()
+                metrics.update(output, target)
 
+        model.train(training)
+        _, correct = metrics.compute()
         accuracy = correct / length_of_dataset
 
         if verbose:
@@ -311,12 +488,10 @@ class BaseClass:
         """
         Evaluate method for printing accuracies of the trained network
 
-        :param teacher (bool): True if you want accuracy of the teacher network
+        :param teacher (bool): True if you want accuracy of the teacher network; this is the
+            trained teacher_model, not the FrozenTeacher that produces the distillation targets
         """
-        if teacher:
-            model = deepcopy(self.teacher_model).to(self.device)
-        else:
-            model = deepcopy(self.student_model).to(self.device)
+        model = self.teacher_model if teacher else self.student_model
         _, accuracy = self._evaluate_model(model)
 
         return accuracy
@@ -0,0 +1,71 @@
+from copy import deepcopy
+
+import torch
+import torch.nn as nn
+
+from utils.precision import DTYPES
+from vit_pytorch.token_merging import set_token_merging
+
+
+class FrozenTeacher(nn.Module):
+    """
+    Inference-only view of a teacher network. The forward runs under torch.inference_mode,
+    so no autograd graph is built for the teacher, optionally in reduced precision, and
+    always returns fp32 logits that can be fed to the distillation loss. Freezing casts and
+    token-merges a copy of the teacher, so the trained model is still the one evaluated and saved.
+
+    :param model (torch.nn.Module): Teacher model
+    :param dtype (str): None/'fp32', 'fp16' or 'bf16' precision of the teacher forward
+    :param device (torch.device): Device the teacher runs on
+    :param cast_weights (bool): Cast the teacher weights to dtype when frozen; use False for a
+        teacher that is still being trained, which then runs under autocast instead
+    :param copy_model (bool): Freeze a copy of model; use False for a model that is already a
+        private copy, such as the int8 teacher
+    """
+
+    def __init__(self, model, dtype=None, device="cpu", cast_weights=True, copy_model=True):
+        super(FrozenTeacher, self).__init__()
+        # kept out of the registered submodules, so the wrapper holds one model in its state_dict
+        self.source = [model]
+        self.model = model
+        self.copy_model = copy_model
+        self.dtype = DTYPES[dtype]
+        self.cast_weights = cast_weights
+        self.frozen = False
+        if torch.device(device).type == "cpu" and self.dtype == torch.float16:
+            print("fp16 is not supported for the teacher on CPU. Using bf16 instead.")
+            self.dtype = torch.bfloat16
+        if self.dtype == torch.float32:
+            self.dtype = None
+
+    def freeze(self):
+        """
+        Replace the teacher by a copy in eval mode that does not track gradients, merges tokens
+        if configured with token_merge_r and has its weights cast; the teacher model itself is
+        left untouched. Freezing again copies the current weights of the teacher.
+        """
+        if self.copy_model:
+            self.model = deepcopy(self.source[0])
+        self.eval()
+        self.model.requires_grad_(False)
+        set_token_merging(self.model)
+        if self.cast_weights and self.dtype is not None:
+            self.model.to(self.dtype)
+        self.frozen = True
+        return self
+
+    def forward(self, data):
+        with torch.inference_mode():
+            if self.dtype is None:
+                out = self.model(data)
+            elif self.cast_weights and self.frozen:
+                out = self.model(data.to(self.dtype))
+            else:
+                with torch.autocast(data.device.type, dtype=self.dtype):
+                    out = self.model(data)
+
+            if isinstance(out, tuple):
+                out = out[0]
+
+        # copying outside inference mode gives a normal tensor the loss may save for backward
+        return out.to(torch.float32, copy=True)
@@ -0,0 +1,146 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def _reduce(per_sample, reduction, num_classes):
+    if reduction == "sum":
+        return per_sample.sum()
+    if reduction == "batchmean":
+        return per_sample.mean()
+    return per_sample.mean() / num_classes
+
+
+def sparse_soft_loss(y_pred_student, targets, temp, loss_fn, soft_loss=None):
+    """
+    Soft distillation term against top-k teacher targets without densifying them, with the
+    objective of the dense path: KL(teacher || student) for the fused 'kl' soft loss, and
+    otherwise ``loss_fn(teacher_probs, student_probs)`` in the argument order of the unfused
+    path, which for nn.KLDivLoss is sum_c s_c (log s_c - t_c). Supports nn.MSELoss and
+    nn.KLDivLoss; any other loss falls back to dense targets.
+
+    :param y_pred_student (torch.FloatTensor): Student logits, ``[B, C]``
+    :param targets (kd.teacher_cache.SparseSoftTargets): Teacher soft targets at ``temp``
+    :param temp (float): Distillation temperature
+    :param loss_fn (torch.nn.Module): Loss used for distillation
+    :param soft_loss (str): Fused soft loss of the trainer, 'kl', 'mse' or None
+    """
+    log_p = F.log_softmax(y_pred_student / temp, dim=1)
+    num_classes = log_p.size(1)
+    k = targets.indices.size(1)
+    uniform = targets.residual / max(num_classes - k, 1)
+    log_p_top = log_p.gather(1, targets.indices)
+
+    if isinstance(loss_fn, nn.MSELoss):
+        # sum_c (p_c - t_c)^2 with t_c = uniform outside the top-k, corrected on the top-k
+        p = log_p.exp()
+        p_top = log_p_top.exp()
+        per_sample = (p * p).sum(dim=1) - 2 * uniform * p.sum(dim=1) + num_classes * uniform * uniform
+        per_sample = per_sample + ((p_top - targets.values) ** 2 - (p_top - uniform.unsqueeze(1)) ** 2).sum(dim=1)
+        return _reduce(per_sample, loss_fn.reduction, num_classes)
+
+    if isinstance(loss_fn, nn.KLDivLoss) and soft_loss != "kl":
+        # nn.KLDivLoss(t, p) = sum_c p_c (log p_c - t_c), with t_c = uniform outside the top-k
+        p_top = log_p_top.exp()
+        per_sample = (log_p.exp() * log_p).sum(dim=1) - (p_top * targets.values).sum(dim=1)
+        per_sample = per_sample - uniform * (1 - p_top.sum(dim=1))
+        return _reduce(per_sample, loss_fn.reduction, num_classes)
+
+    if isinstance(loss_fn, nn.KLDivLoss):
+        # sum_c t_c (log t_c - log p_c), split into the top-k and the uniform remainder
+        per_sample = (torch.xlogy(targets.values, targets.values) - targets.values * log_p_top).sum(dim=1)
+        rest_log_p = log_p.sum(dim=1) - log_p_top.sum(dim=1)
+        per_sample = per_sample + (num_classes - k) * torch.xlogy(uniform, uniform) - uniform * rest_log_p
+        return _reduce(per_sample, loss_fn.reduction, num_classes)
+
+    return loss_fn(targets.to_dense(), log_p.exp())
+
+
+class _FusedKDLoss(torch.autograd.Function):
+    """
+    Hard-label CE plus temperature-scaled soft term computed from one shifted copy of the
+    student logits. The gradient w.r.t. the student logits is formed during forward, so the
+    only tensor kept for backward is that single ``[B, C]`` gradient.
+    """
+
+    @staticmethod
+    def forward(ctx, y_pred_student, y_pred_teacher, y_true, temp, distil_weight, soft_loss):
+        dtype = y_pred_student.dtype
+        student = y_pred_student.float()
+        batch_size, num_classes = student.shape
+
+        # shared max shift for both log-softmaxes
+        shifted = student - student.max(dim=1, keepdim=True)[0]
+        log_q = shifted / temp
+        log_q -= log_q.logsumexp(dim=1, keepdim=True)
+        log_p = shifted
+        log_p -= log_p.logsumexp(dim=1, keepdim=True)
+        log_t = F.log_softmax(y_pred_teacher.float() / temp, dim=1)
+
+        target = y_true.unsqueeze(1)
+        ce = -log_p.gather(1, target).mean()
+        # d ce / d student = (softmax(student) - onehot) / B, reusing the log_p buffer
+        grad = log_p.exp_()
+        grad.scatter_add_(1, target, -torch.ones_like(grad[:, :1]))
+        grad *= (1 - distil_weight) / batch_size
+
+        t = log_t.exp()
+        if soft_loss == "kl":
+            soft = (t * (log_t - log_q)).sum() / batch_size
+            q = log_q.exp_()
+            # T^2 * d KL / d student = T * (q - t) / B
+            grad.add_(q.sub_(t), alpha=distil_weight * temp / batch_size)
+        else:
+            q = log_q.exp_()
+            diff = q - t
+            soft = (diff * diff).mean()
+            # chain the MSE gradient through the softmax at temperature T
+            grad_q = diff.mul_(2.0 / (batch_size * num_classes))
+            grad_z = q * (grad_q - (grad_q * q).sum(dim=1, keepdim=True))
+            grad.add_(grad_z, alpha=distil_weight * temp)
+
+        ctx.dtype = dtype
+        ctx.save_for_backward(grad)
+        return (1 - distil_weight) * ce + (distil_weight * temp * temp) * soft
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        (grad,) = ctx.saved_tensors
+        return (grad * grad_output).to(ctx.dtype), None, None, None, None, None
+
+
+class DistillationLoss(nn.Module):
+    """
+    Fused distillation loss: ``(1 - w) * CE(student, y) + w * T^2 * soft(teacher, student)``
+    where the soft term is KL divergence in log space (batchmean) or MSE on the softened
+    probabilities. The teacher receives no gradient.
+
+    :param temp (float): Temperature parameter for distillation
+    :param distil_weight (float): Weight paramter for distillation loss
+    :param soft_loss (str): 'kl' or 'mse'
+    """
+
+    def __init__(self, temp=20.0, distil_weight=0.5, soft_loss="kl"):
+        super(DistillationLoss, self).__init__()
+        if soft_loss not in ("kl", "mse"):
+            raise ValueError("soft_loss must be 'kl' or 'mse', got {}".format(soft_loss))
+        self.temp = temp
+        self.distil_weight = distil_weight
+        self.soft_loss = soft_loss
+
+    def forward(self, y_pred_student, y_pred_teacher, y_true):
+        return _FusedKDLoss.apply(
+            y_pred_student, y_pred_teacher.detach(), y_true, self.temp, self.distil_weight, self.soft_loss
+        )
+
+
+def resolve_soft_loss(soft_loss, loss_fn):
+    """
+    Pick the fused soft term for a trainer: an explicit ``soft_loss`` wins, a mean-reduced
+    nn.MSELoss maps to 'mse', anything else keeps the unfused loss_fn path (None).
+    """
+    if soft_loss is not None:
+        return soft_loss
+    if isinstance(loss_fn, nn.MSELoss) and loss_fn.reduction == "mean":
+        return "mse"
+    return None
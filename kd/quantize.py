@@ -0,0 +1,64 @@
+from copy import deepcopy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+try:
+    from torch.ao import quantization
+except ImportError:
+    from torch import quantization
+
+
+def quantize_teacher(model):
+    """
+    Copy of model with every nn.Linear (to_qkv, to_out, the FeedForward MLPs and the head)
+    replaced by a dynamically quantized int8 layer with per-channel weight scales. Runs on CPU only.
+
+    :param model (torch.nn.Module): fp32 teacher
+    """
+    model = deepcopy(model).cpu().float().eval()
+    return quantization.quantize_dynamic(
+        model, {nn.Linear: quantization.per_channel_dynamic_qconfig}, dtype=torch.qint8
+    )
+
+
+@torch.inference_mode()
+def compare_teachers(reference, quantized, loader, temp=1.0, max_batches=None):
+    """
+    Compare the logits of the quantized teacher with the fp32 teacher on a loader: top-1
+    agreement, the mean KL divergence from the fp32 to the quantized soft targets at temp,
+    the largest logit difference and the accuracy of both.
+
+    :param reference (torch.nn.Module): fp32 teacher
+    :param quantized (torch.nn.Module): Quantized teacher
+    :param loader (torch.utils.data.DataLoader): Loader of (data, label) batches, e.g. the validation set
+    :param temp (float): Temperature of the soft targets
+    :param max_batches (int): Only compare this many batches
+    """
+    reference = deepcopy(reference).cpu().float().eval()
+    quantized.eval()
+    agree = correct_ref = correct_q = total = 0
+    kl, max_diff = 0.0, 0.0
+    for i, (data, label) in enumerate(loader):
+        if max_batches is not None and i >= max_batches:
+            break
+        data = data.cpu()
+        ref_out = reference(data)
+        q_out = quantized(data)
+        kl += F.kl_div(
+            F.log_softmax(q_out / temp, dim=1), F.log_softmax(ref_out / temp, dim=1), reduction="sum", log_target=True
+        ).item()
+        max_diff = max(max_diff, (ref_out - q_out).abs().max().item())
+        agree += (ref_out.argmax(dim=1) == q_out.argmax(dim=1)).sum().item()
+        correct_ref += (ref_out.argmax(dim=1) == label).sum().item()
+        correct_q += (q_out.argmax(dim=1) == label).sum().item()
+        total += len(label)
+    total = max(total, 1)
+    return {
+        "top1_agreement": agree / total,
+        "kl_divergence": kl / total,
+        "max_logit_diff": max_diff,
+        "fp32_accuracy": correct_ref / total,
+        "int8_accuracy": correct_q / total,
+    }
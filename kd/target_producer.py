@@ -0,0 +1,137 @@
+import contextlib
+import os
+import queue
+import threading
+import time
+
+import torch
+
+
+def parse_cores(cores):
+    """
+    CPU cores from a list of ids or a string like '0-7,16'; None keeps the current affinity
+    """
+    if cores is None or isinstance(cores, (list, tuple)):
+        return cores
+    if isinstance(cores, int):
+        return [cores]
+    result = []
+    for part in str(cores).split(','):
+        start, _, end = part.partition('-')
+        result.extend(range(int(start), int(end or start) + 1))
+    return result
+
+
+def configure_threads(*core_sets):
+    """
+    Size the intra-op thread pool once, before the teacher and student threads start, to the
+    smallest of the given core sets. The pool size is process-wide, so it cannot be set per thread.
+    """
+    sizes = [len(cores) for cores in core_sets if cores]
+    if sizes:
+        torch.set_num_threads(min(sizes))
+
+
+def set_affinity(cores):
+    """
+    Best-effort pinning of the calling OS thread to cores (Linux only). Threads it creates
+    afterwards inherit the mask, but intra-op workers that already exist keep theirs, so the
+    teacher and student are not guaranteed to stay on disjoint cores.
+    """
+    if not cores:
+        return
+    if not hasattr(os, 'sched_setaffinity'):
+        print('CPU affinity is not supported on this platform. Ignoring the core sets.')
+        return
+    os.sched_setaffinity(0, cores)
+
+
+class TeacherTargetProducer:
+    """
+    Runs the teacher in a background thread, one batch ahead of the student. Batches from loader
+    are moved to device, soft_targets computes their teacher outputs (on a separate CUDA stream
+    on GPUs) and ``((data, label), teacher_out)`` is put in a bounded queue that iterating the
+    producer consumes. Time the student spends waiting for the queue (the teacher is the
+    bottleneck) and the teacher spends waiting on the full queue (the student is) is accumulated
+    in student_wait and teacher_wait.
+
+    :param loader (torch.utils.data.DataLoader): Loader of (data, label) batches
+    :param soft_targets (callable): Maps a batch of data on device to the teacher outputs
+    :param device (torch.device): Device of the teacher
+    :param depth (int): Batches the producer may run ahead
+    :param cores (list or str): CPU cores the producer thread is pinned to (best effort), e.g. '0-7';
+        None to share all
+    """
+
+    def __init__(self, loader, soft_targets, device, depth=2, cores=None):
+        self.loader = loader
+        self.soft_targets = soft_targets
+        self.device = torch.device(device)
+        self.depth = max(depth, 1)
+        self.cores = parse_cores(cores)
+        self.student_wait = 0.0
+        self.teacher_wait = 0.0
+        self.batches = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.queue = queue.Queue(self.depth)
+        self.stop = threading.Event()
+        self.student_wait, self.teacher_wait, self.batches = 0.0, 0.0, 0
+        thread = threading.Thread(target=self._produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = self.queue.get()
+                self.student_wait += time.perf_counter() - start
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                batch, teacher_out, event = item
+                if event is not None:
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(event)
+                    for tensor in batch + [teacher_out]:
+                        tensor.record_stream(stream)
+                self.batches += 1
+                yield batch, teacher_out
+        finally:
+            self.stop.set()
+            thread.join()
+
+    def _produce(self):
+        set_affinity(self.cores)
+        stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        try:
+            for data, label in self.loader:
+                if self.stop.is_set():
+                    return
+                with torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+                    batch = [data.to(self.device, non_blocking=True), label.to(self.device, non_blocking=True)]
+                    teacher_out = self.soft_targets(batch[0])
+                    event = torch.cuda.Event() if stream is not None else None
+                    if event is not None:
+                        event.record(stream)
+                self._put((batch, teacher_out, event))
+            self._put(None)
+        except BaseException as e:
+            self._put(e)
+
+    def _put(self, item):
+        start = time.perf_counter()
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self.teacher_wait += time.perf_counter() - start
+
+    def report(self):
+        return "Teacher producer: student waited {:.2f}s, teacher waited {:.2f}s over {} batches".format(
+            self.student_wait, self.teacher_wait, self.batches
+        )
@@ -0,0 +1,251 @@
+import hashlib
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from utils.dataset import SAMPLE_SEED_VERSION
+
+
+def fingerprint_model(model):
+    """
+    Hash of every tensor in the model's state dict, independent of wrapper prefixes
+
+    :param model (torch.nn.Module): Model to fingerprint
+    """
+    h = hashlib.sha256()
+    for value in model.state_dict().values():
+        if not torch.is_tensor(value):
+            continue
+        value = value.detach().cpu()
+        if value.is_floating_point():
+            value = value.to(torch.float32)
+        h.update(str(tuple(value.shape)).encode())
+        h.update(value.contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+def fingerprint_transform(dataset):
+    """
+    Hash of the transform pipeline built by utils.dataset.make_transforms
+
+    :param dataset (torch.utils.data.Dataset): Dataset whose transform is fingerprinted
+    """
+    return hashlib.sha256(repr(dataset.transform).encode()).hexdigest()
+
+
+class SparseSoftTargets(namedtuple("SparseSoftTargets", ["indices", "values", "residual", "num_classes"])):
+    """
+    Teacher soft targets at temperature T stored as the top-k classes plus the probability
+    mass left over, which is spread uniformly over the remaining classes.
+
+    :param indices (torch.LongTensor): Top-k class indices, ``[B, k]``
+    :param values (torch.FloatTensor): Top-k probabilities, ``[B, k]``
+    :param residual (torch.FloatTensor): Probability mass outside the top-k, ``[B]``
+    :param num_classes (int): Number of classes of the dense distribution
+    """
+
+    def to(self, device):
+        return self._replace(
+            indices=self.indices.to(device),
+            values=self.values.to(device),
+            residual=self.residual.to(device),
+        )
+
+    def to_dense(self):
+        other = max(self.num_classes - self.indices.size(1), 1)
+        dense = (self.residual / other).unsqueeze(1).repeat(1, self.num_classes)
+        return dense.scatter_(1, self.indices, self.values)
+
+
+def encode_topk(logits, k, temp, bits=32):
+    """
+    Compress teacher logits into top-k probabilities at temperature ``temp``.
+    Returns ``(indices, values, scale, residual)``; with 8 bits the values are uint8
+    relative to the per-row ``scale`` (the largest probability), otherwise scale is None.
+
+    :param logits (torch.FloatTensor): Teacher logits, ``[B, C]``
+    :param k (int): Number of classes kept per sample
+    :param temp (float): Distillation temperature
+    :param bits (int): 32, 16 or 8 bits per stored value
+    """
+    probs = F.softmax(logits.float() / temp, dim=1)
+    values, indices = probs.topk(k, dim=1)
+    scale = None
+    if bits == 8:
+        scale = values[:, 0].clamp(min=1e-12)
+        values = torch.round(values / scale.unsqueeze(1) * 255).to(torch.uint8)
+    elif bits == 16:
+        values = values.half()
+    elif bits != 32:
+        raise ValueError("bits must be 32, 16 or 8, got {}".format(bits))
+    residual = (1 - decode_values(values, scale).sum(dim=1)).clamp(min=0)
+    return indices, values, scale, residual
+
+
+def decode_values(values, scale=None):
+    if scale is None:
+        return values.float()
+    return values.float() * (scale.float() / 255).unsqueeze(1)
+
+
+class TeacherCache:
+    """
+    Memory-mapped on-disk store of teacher outputs keyed by augmentation and dataset index.
+    The cache directory holds ``meta.json`` and ``labels.npy`` plus, depending on the format:
+
+    - ``dense``: ``logits.npy`` of shape ``[num_augs, num_samples, num_classes]``
+    - ``topk``: ``indices.npy``/``values.npy`` of shape ``[num_augs, num_samples, k]`` with
+      ``residual.npy`` (and ``scale.npy`` for 8 bits) of shape ``[num_augs, num_samples]``
+
+    :param path (str): Directory of the cache
+    :param mode (str): 'r' to read an existing cache, 'r+' to fill it
+    """
+
+    def __init__(self, path, mode="r"):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.meta.setdefault("format", "dense")
+        self.meta.setdefault("bits", 32)
+        if self.format == "dense":
+            names = ["logits"]
+        else:
+            names = ["indices", "values", "residual"] + (["scale"] if self.meta["bits"] == 8 else [])
+        self.arrays = {
+            name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mode) for name in names
+        }
+        self.labels = np.load(os.path.join(path, "labels.npy"), mmap_mode=mode)
+
+    @classmethod
+    def create(cls, path, num_samples, num_classes, num_augs, seed, teacher_fingerprint, transform_fingerprint,
+               format="dense", k=None, bits=32, temp=None):
+        """
+        Allocate an empty cache on disk and open it for writing
+        """
+        os.makedirs(path, exist_ok=True)
+
+        def allocate(name, dtype, shape):
+            np.lib.format.open_memmap(os.path.join(path, name + ".npy"), mode="w+", dtype=dtype, shape=shape)
+
+        if format == "dense":
+            if bits not in (32, 16):
+                raise ValueError("dense caches store 32 or 16 bits, got {}".format(bits))
+            allocate("logits", np.float32 if bits == 32 else np.float16, (num_augs, num_samples, num_classes))
+        elif format == "topk":
+            if not k or temp is None:
+                raise ValueError("topk caches need k and temp")
+            value_dtype = {32: np.float32, 16: np.float16, 8: np.uint8}[bits]
+            allocate("indices", np.int16 if num_classes <= np.iinfo(np.int16).max else np.int32,
+                     (num_augs, num_samples, k))
+            allocate("values", value_dtype, (num_augs, num_samples, k))
+            allocate("residual", np.float32, (num_augs, num_samples))
+            if bits == 8:
+                allocate("scale", np.float32, (num_augs, num_samples))
+        else:
+            raise ValueError("Unknown teacher cache format: {}".format(format))
+        allocate("labels", np.int64, (num_samples,))
+        meta = {
+            "num_samples": num_samples,
+            "num_classes": num_classes,
+            "num_augs": num_augs,
+            "seed": seed,
+            "sample_seed_version": SAMPLE_SEED_VERSION,
+            "teacher": teacher_fingerprint,
+            "transform": transform_fingerprint,
+            "format": format,
+            "k": k,
+            "bits": bits,
+            "temp": temp,
+            "complete": False,
+        }
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+        return cls(path, mode="r+")
+
+    @property
+    def format(self):
+        return self.meta["format"]
+
+    @property
+    def num_augs(self):
+        return self.meta["num_augs"]
+
+    @property
+    def seed(self):
+        return self.meta["seed"]
+
+    def write(self, aug, index, logits, label):
+        index = index.cpu().numpy()
+        if self.format == "dense":
+            self.arrays["logits"][aug, index] = logits.detach().float().cpu().numpy()
+        else:
+            indices, values, scale, residual = encode_topk(
+                logits.detach(), self.meta["k"], self.meta["temp"], self.meta["bits"]
+            )
+            self.arrays["indices"][aug, index] = indices.cpu().numpy()
+            self.arrays["values"][aug, index] = values.cpu().numpy()
+            self.arrays["residual"][aug, index] = residual.cpu().numpy()
+            if scale is not None:
+                self.arrays["scale"][aug, index] = scale.cpu().numpy()
+        self.labels[index] = label.cpu().numpy()
+
+    def read(self, aug, index):
+        """
+        Teacher outputs for a batch: dense logits, or SparseSoftTargets for topk caches
+
+        :param aug (int): Augmentation the batch was drawn with
+        :param index (torch.LongTensor): Dataset indices of the batch
+        """
+        index = index.cpu().numpy()
+        if self.format == "dense":
+            return torch.from_numpy(self.arrays["logits"][aug, index]).float()
+        scale = torch.from_numpy(self.arrays["scale"][aug, index]) if "scale" in self.arrays else None
+        return SparseSoftTargets(
+            indices=torch.from_numpy(self.arrays["indices"][aug, index].astype(np.int64)),
+            values=decode_values(torch.from_numpy(self.arrays["values"][aug, index]), scale),
+            residual=torch.from_numpy(self.arrays["residual"][aug, index]),
+            num_classes=self.meta["num_classes"],
+        )
+
+    def finalize(self):
+        for array in self.arrays.values():
+            array.flush()
+        self.labels.flush()
+        self.meta["complete"] = True
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump(self.meta, f, indent=2)
+
+    def validate(self, teacher_model, dataset, temp=None):
+        """
+        Raise if the cache was not produced by this teacher and transform pipeline
+
+        :param teacher_model (torch.nn.Module): Teacher the cache is supposed to replace
+        :param dataset (utils.dataset.SeededDataset): Training dataset served to the student
+        :param temp (float): Distillation temperature, checked against topk caches
+        """
+        if not self.meta["complete"]:
+            raise ValueError("Teacher cache at {} is incomplete.".format(self.path))
+        if len(dataset) != self.meta["num_samples"]:
+            raise ValueError(
+                "Teacher cache at {} holds {} samples, dataset has {}.".format(
+                    self.path, self.meta["num_samples"], len(dataset)
+                )
+            )
+        if self.format == "topk" and temp is not None and float(temp) != float(self.meta["temp"]):
+            raise ValueError(
+                "Teacher cache at {} stores soft targets at temperature {}, not {}.".format(
+                    self.path, self.meta["temp"], temp
+                )
+            )
+        if self.meta.get("sample_seed_version") != SAMPLE_SEED_VERSION:
+            raise ValueError(
+                "Teacher cache at {} was built with a different augmentation seeding; rebuild it.".format(self.path)
+            )
+        if fingerprint_transform(dataset) != self.meta["transform"]:
+            raise ValueError("Teacher cache at {} was built with different transforms.".format(self.path))
+        if fingerprint_model(teacher_model) != self.meta["teacher"]:
+            raise ValueError("Teacher cache at {} was built from a different teacher checkpoint.".format(self.path))
@@ -2,6 +2,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from kd import BaseClass
+from kd.losses import DistillationLoss, resolve_soft_loss, sparse_soft_loss
+from kd.teacher_cache import SparseSoftTargets
 
 
 class VanillaKD(BaseClass):
@@ -21,6 +23,22 @@ class VanillaKD(BaseClass):
     :param device (str): Device used for training; 'cpu' for cpu and 'cuda' for gpu
     :param log (bool): True if logging required
     :param logdir (str): Directory for storing logs
+    :param teacher_cache (str): Directory of a precomputed teacher cache, see cache_teacher.py
+    :param soft_loss (str): 'kl' or 'mse' to use the fused distillation loss; by default a
+        mean-reduced nn.MSELoss loss_fn is fused as 'mse' and other loss_fns are left unfused
+    :param teacher_dtype (str): None/'fp32', 'fp16' or 'bf16' precision of the teacher forward
+    :param log_interval (int): Print running loss and accuracy every log_interval steps
+    :param teacher_precision (str): None/'fp32', 'fp16' or 'bf16' precision of teacher training
+    :param student_precision (str): None/'fp32', 'fp16' or 'bf16' precision of student training
+    :param teacher_accum_steps (int): Micro-batches per batch for the teacher
+    :param student_accum_steps (int): Micro-batches per batch for the student
+    :param producer_depth (int): Batches the background teacher may run ahead; 0 to run it inline
+    :param teacher_cores (list or str): CPU cores of the teacher producer thread
+    :param student_cores (list or str): CPU cores of the student thread
+    :param async_checkpoint (bool): Write the final checkpoints on a background thread
+    :param best_weights_dir (str): Keep the best weights in this directory instead of CPU memory
+    :param profiler (utils.profiler.StepProfiler): Per-phase step timers
+    :param log_path (str): Log file receiving the checkpoint stall times
     """
 
     def __init__(
@@ -37,6 +55,21 @@ class VanillaKD(BaseClass):
         device="cpu",
         log=False,
         logdir="./Experiments",
+        teacher_cache=None,
+        soft_loss=None,
+        teacher_dtype=None,
+        log_interval=0,
+        teacher_precision=None,
+        student_precision=None,
+        teacher_accum_steps=1,
+        student_accum_steps=1,
+        producer_depth=0,
+        teacher_cores=None,
+        student_cores=None,
+        async_checkpoint=True,
+        best_weights_dir=None,
+        profiler=None,
+        log_path=None,
     ):
         super(VanillaKD, self).__init__(
             teacher_model,
@@ -51,23 +84,48 @@ class VanillaKD(BaseClass):
             device,
             log,
             logdir,
+            teacher_cache,
+            teacher_dtype=teacher_dtype,
+            log_interval=log_interval,
+            teacher_precision=teacher_precision,
+            student_precision=student_precision,
+            teacher_accum_steps=teacher_accum_steps,
+            student_accum_steps=student_accum_steps,
+            producer_depth=producer_depth,
+            teacher_cores=teacher_cores,
+            student_cores=student_cores,
+            async_checkpoint=async_checkpoint,
+            best_weights_dir=best_weights_dir,
+            profiler=profiler,
+            log_path=log_path,
         )
+        self.soft_loss = resolve_soft_loss(soft_loss, loss_fn)
+        self.kd_loss = None
+        if self.soft_loss is not None:
+            self.kd_loss = DistillationLoss(temp, distil_weight, self.soft_loss)
+            if self.soft_loss == "kl":
+                self.loss_fn = nn.KLDivLoss(reduction="batchmean").to(self.device)
 
     def calculate_kd_loss(self, y_pred_student, y_pred_teacher, y_true):
         """
         Function used for calculating the KD loss during distillation
 
         :param y_pred_student (torch.FloatTensor): Prediction made by the student model
-        :param y_pred_teacher (torch.FloatTensor): Prediction made by the teacher model
+        :param y_pred_teacher (torch.FloatTensor or SparseSoftTargets): Prediction made by the teacher
+            model, or top-k soft targets read from a teacher cache
         :param y_true (torch.FloatTensor): Original label
         """
 
-        soft_teacher_out = F.softmax(y_pred_teacher / self.temp, dim=1)
-        soft_student_out = F.softmax(y_pred_student / self.temp, dim=1)
+        if isinstance(y_pred_teacher, SparseSoftTargets):
+            soft_loss = sparse_soft_loss(y_pred_student, y_pred_teacher, self.temp, self.loss_fn, self.soft_loss)
+        elif self.kd_loss is not None:
+            return self.kd_loss(y_pred_student, y_pred_teacher, y_true)
+        else:
+            soft_teacher_out = F.softmax(y_pred_teacher / self.temp, dim=1)
+            soft_student_out = F.softmax(y_pred_student / self.temp, dim=1)
+            soft_loss = self.loss_fn(soft_teacher_out, soft_student_out)
 
         loss = (1 - self.distil_weight) * F.cross_entropy(y_pred_student, y_true)
-        loss += (self.distil_weight * self.temp * self.temp) * self.loss_fn(
-            soft_teacher_out, soft_student_out
-        )
+        loss += (self.distil_weight * self.temp * self.temp) * soft_loss
 
         return loss
\ No newline at end of file
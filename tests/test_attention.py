@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+from vit_pytorch import SimpleViT, ViT
+
+# fp32 tolerance of the fused kernel against the einops attention
+RTOL, ATOL = 1e-5, 1e-5
+
+MODELS = {
+    'vit': (ViT, dict(image_size=32, patch_size=8, num_classes=10, dim=64, depth=2, heads=4, mlp_dim=128, dim_head=16)),
+    'simple_vit': (SimpleViT, dict(image_size=32, patch_size=8, num_classes=10, dim=64, depth=2, heads=4, mlp_dim=128,
+                                   dim_head=16)),
+}
+
+
+def forward_backward(model, data):
+    data = data.clone().requires_grad_()
+    out = model(data)
+    out.sum().backward()
+    return out, data.grad, {name: p.grad for name, p in model.named_parameters()}
+
+
+# train mode without dropout, and eval mode with dropout configured but switched off
+@pytest.mark.parametrize('dropout,training', [(0., True), (0.1, False)])
+@pytest.mark.parametrize('name', sorted(MODELS))
+def test_sdpa_matches_einops(name, dropout, training):
+    cls, args = MODELS[name]
+    if cls is ViT:
+        args = dict(args, dropout=dropout, emb_dropout=dropout)
+    torch.manual_seed(0)
+    reference = cls(**args, attn_impl='einops').train(training)
+    fused = cls(**args, attn_impl='sdpa').train(training)
+    fused.load_state_dict(reference.state_dict())
+    data = torch.randn(2, 3, 32, 32)
+
+    out1, data_grad1, grads1 = forward_backward(reference, data)
+    out2, data_grad2, grads2 = forward_backward(fused, data)
+
+    torch.testing.assert_close(out2, out1, rtol=RTOL, atol=ATOL)
+    torch.testing.assert_close(data_grad2, data_grad1, rtol=RTOL, atol=ATOL)
+    for param, grad in grads1.items():
+        torch.testing.assert_close(grads2[param], grad, rtol=RTOL, atol=ATOL)
@@ -0,0 +1,24 @@
+import argparse
+import glob
+import json
+import os
+
+from benchmarks import suite
+
+CONFIGS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'configs')
+
+
+def test_suite_runs_on_all_shipped_configs(tmp_path):
+    output = str(tmp_path / 'bench.json')
+    # 64 is not a multiple of the patch size 14 of the huge configs
+    args = argparse.Namespace(output=output, only=None, configs=CONFIGS, image_size=64, num_classes=10,
+                              batch_size=2, samples=8, workers=0, threads=0, iters=1, depth=1)
+    suite.run(args)
+
+    with open(output, 'r') as f:
+        names = {r['name'] for r in json.load(f)['results']}
+    for path in glob.glob(os.path.join(CONFIGS, 'vit', '*.yaml')):
+        assert 'models/{}/fwd_bwd'.format(os.path.splitext(os.path.basename(path))[0]) in names
+    for path in glob.glob(os.path.join(CONFIGS, 'dataset', '*.yaml')):
+        assert 'loaders/{}/train'.format(os.path.splitext(os.path.basename(path))[0]) in names
+    assert {'kd/vanilla_kd/student_step', 'kd/co_vanilla_kd/fused_step', 'checkpoint/save', 'checkpoint/load'} <= names
@@ -0,0 +1,19 @@
+import os
+
+import torch
+
+from utils.checkpoint import CheckpointWriter
+
+
+def test_retention_prunes_checkpoints_from_before_a_resume(tmp_path):
+    # a previous session left epoch_1..epoch_10 behind
+    for epoch in range(1, 11):
+        torch.save({'epoch': epoch}, tmp_path / f'epoch_{epoch}.pth')
+
+    writer = CheckpointWriter(keep=3, blocking=True)
+    writer.save({'epoch': torch.tensor(11)}, os.path.join(tmp_path, 'epoch_11.pth'),
+                latest=os.path.join(tmp_path, 'epoch_latest.pth'))
+    writer.close()
+
+    assert sorted(os.listdir(tmp_path)) == ['epoch_10.pth', 'epoch_11.pth', 'epoch_9.pth', 'epoch_latest.pth']
+    assert torch.load(tmp_path / 'epoch_latest.pth')['epoch'] == 11
@@ -0,0 +1,37 @@
+import torch
+
+from kd.frozen_teacher import FrozenTeacher
+
+
+def make_teacher():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.ReLU(), torch.nn.Linear(16, 4)).train()
+
+
+def test_freeze_leaves_the_trained_teacher_untouched():
+    teacher_model = make_teacher()
+    state = {k: v.clone() for k, v in teacher_model.state_dict().items()}
+
+    frozen = FrozenTeacher(teacher_model, 'bf16', 'cpu').freeze()
+    data = torch.randn(3, 8)
+
+    assert frozen.model is not teacher_model
+    assert next(frozen.model.parameters()).dtype == torch.bfloat16
+    assert frozen(data).dtype == torch.float32
+    # the trained teacher is still fp32, trainable and in its own mode, so it can be evaluated and saved
+    assert teacher_model.training
+    assert all(p.requires_grad and p.dtype == torch.float32 for p in teacher_model.parameters())
+    for k, v in teacher_model.state_dict().items():
+        torch.testing.assert_close(v, state[k], rtol=0, atol=0)
+    teacher_model.eval()
+    teacher_model(data)
+
+
+def test_freeze_copies_the_current_weights():
+    teacher_model = make_teacher()
+    frozen = FrozenTeacher(teacher_model).freeze()
+    with torch.no_grad():
+        teacher_model[0].weight.add_(1.0)
+    data = torch.randn(3, 8)
+    assert not torch.allclose(frozen(data), teacher_model.eval()(data))
+    torch.testing.assert_close(frozen.freeze()(data), teacher_model(data))
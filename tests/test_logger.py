@@ -0,0 +1,34 @@
+import pytest
+
+from utils.logger import MetricsLogger
+
+
+class FailingBackend:
+    def __init__(self):
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+
+    def flush(self):
+        raise OSError('disk full')
+
+    def close(self):
+        pass
+
+
+def test_backend_errors_reach_the_training_thread(tmp_path):
+    backend = FailingBackend()
+    metrics = MetricsLogger([backend], str(tmp_path / 'log.txt'), queue_size=4)
+    metrics.log({'loss': 1.0})
+    metrics.thread.join(timeout=0.5)
+    # the writer keeps running, so later records are still written and close does not hang
+    assert metrics.thread.is_alive()
+    with pytest.raises(OSError, match='disk full'):
+        metrics.log({'loss': 0.5})
+    metrics.write_text('epoch 1')
+    with pytest.raises(OSError, match='disk full'):
+        metrics.close()
+    assert not metrics.thread.is_alive()
+    assert [r['metrics'] for r in backend.records] == [{'loss': 1.0}]
+    assert (tmp_path / 'log.txt').read_text() == 'epoch 1\n'
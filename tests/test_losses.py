@@ -0,0 +1,35 @@
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from kd.losses import sparse_soft_loss
+from kd.teacher_cache import SparseSoftTargets, decode_values, encode_topk
+
+TEMP = 4.0
+
+
+def full_topk(teacher, temp):
+    indices, values, scale, residual = encode_topk(teacher, teacher.size(1), temp)
+    return SparseSoftTargets(indices, decode_values(values, scale), residual, teacher.size(1))
+
+
+@pytest.mark.parametrize('loss_fn', [nn.KLDivLoss(), nn.KLDivLoss(reduction='batchmean'), nn.MSELoss()],
+                         ids=['kl_mean', 'kl_batchmean', 'mse'])
+def test_sparse_matches_unfused_dense_path_at_full_k(loss_fn):
+    torch.manual_seed(0)
+    student, teacher = torch.randn(6, 10), torch.randn(6, 10)
+    # the unfused dense path of VanillaKD.calculate_kd_loss
+    dense = loss_fn(F.softmax(teacher / TEMP, dim=1), F.softmax(student / TEMP, dim=1))
+    sparse = sparse_soft_loss(student, full_topk(teacher, TEMP), TEMP, loss_fn)
+    torch.testing.assert_close(sparse, dense, rtol=1e-5, atol=1e-6)
+
+
+def test_sparse_matches_fused_kl_at_full_k():
+    torch.manual_seed(0)
+    student, teacher = torch.randn(6, 10), torch.randn(6, 10)
+    # the fused 'kl' soft term, KL(teacher || student)
+    dense = F.kl_div(F.log_softmax(student / TEMP, dim=1), F.log_softmax(teacher / TEMP, dim=1),
+                     reduction='batchmean', log_target=True)
+    sparse = sparse_soft_loss(student, full_topk(teacher, TEMP), TEMP, nn.KLDivLoss(reduction='batchmean'), 'kl')
+    torch.testing.assert_close(sparse, dense, rtol=1e-5, atol=1e-6)
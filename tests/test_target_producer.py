@@ -0,0 +1,40 @@
+import pytest
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from kd.target_producer import TeacherTargetProducer
+
+
+def make_loader():
+    generator = torch.Generator().manual_seed(0)
+    dataset = TensorDataset(torch.randn(40, 8, generator=generator), torch.randint(4, (40,), generator=generator))
+    return DataLoader(dataset, batch_size=6)
+
+
+@pytest.mark.parametrize('depth', [1, 3])
+def test_producer_matches_inline_teacher(depth):
+    torch.manual_seed(0)
+    teacher = torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.ReLU(), torch.nn.Linear(16, 4)).eval()
+    loader = make_loader()
+
+    @torch.inference_mode()
+    def soft_targets(data):
+        return teacher(data)
+
+    expected = [(data, label, soft_targets(data)) for data, label in loader]
+    producer = TeacherTargetProducer(loader, soft_targets, 'cpu', depth)
+    produced = list(producer)
+
+    assert len(produced) == len(expected) == producer.batches
+    for ((data, label), teacher_out), (ref_data, ref_label, ref_out) in zip(produced, expected):
+        torch.testing.assert_close(data, ref_data, rtol=0, atol=0)
+        torch.testing.assert_close(label, ref_label, rtol=0, atol=0)
+        torch.testing.assert_close(teacher_out, ref_out, rtol=0, atol=0)
+
+
+def test_producer_raises_teacher_errors():
+    def soft_targets(data):
+        raise ValueError('teacher failed')
+
+    with pytest.raises(ValueError, match='teacher failed'):
+        list(TeacherTargetProducer(make_loader(), soft_targets, 'cpu'))
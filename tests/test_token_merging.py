@@ -0,0 +1,48 @@
+import pytest
+import torch
+
+from torch.utils.data import DataLoader, TensorDataset
+
+from kd.frozen_teacher import FrozenTeacher
+from kd.vanilla_kd import VanillaKD
+from vit_pytorch import SimpleViT, ViT
+
+ARGS = dict(image_size=32, patch_size=4, num_classes=10, dim=32, depth=2, heads=2, mlp_dim=64, dim_head=16)
+
+
+@pytest.mark.parametrize('cls', [ViT, SimpleViT])
+def test_eval_forward_is_exact_until_frozen(cls):
+    torch.manual_seed(0)
+    reference = cls(**ARGS).eval()
+    merging = cls(**ARGS, token_merge_r=8).eval()
+    merging.load_state_dict(reference.state_dict())
+    data = torch.randn(2, 3, 32, 32)
+
+    with torch.no_grad():
+        torch.testing.assert_close(merging(data), reference(data))
+
+    teacher = FrozenTeacher(merging).freeze()
+    assert not merging.transformer.merge_tokens
+    x, size = teacher.model.transformer(torch.randn(2, 64 + (cls is ViT), 32), return_size=True)
+    assert x.shape[1] == 64 + (cls is ViT) - 2 * 8
+    assert torch.all(size.sum(dim=1) == 64 + (cls is ViT))
+    assert teacher(data).shape == (2, 10)
+
+
+def test_teacher_evaluation_stays_exact_after_freeze():
+    torch.manual_seed(0)
+    teacher = ViT(**ARGS, token_merge_r=8)
+    student = SimpleViT(**ARGS)
+    loader = DataLoader(TensorDataset(torch.randn(8, 3, 32, 32), torch.randint(10, (8,))), batch_size=4)
+    distiller = VanillaKD(teacher, student, loader, loader, torch.optim.Adam(teacher.parameters()),
+                          torch.optim.Adam(student.parameters()), teacher_dtype='bf16', async_checkpoint=False)
+    before, _ = distiller._evaluate_model(distiller.teacher_model, verbose=False)
+    accuracy = distiller.evaluate(teacher=True)
+
+    distiller.teacher.freeze()
+    after, _ = distiller._evaluate_model(distiller.teacher_model, verbose=False)
+
+    assert distiller.teacher.model.transformer.merge_tokens
+    for out_before, out_after in zip(before, after):
+        torch.testing.assert_close(out_after, out_before, rtol=0, atol=0)
+    assert distiller.evaluate(teacher=True) == accuracy
@@ -1,37 +1,37 @@
 # Created by George Chang at 4/12/24
 import argparse
 import os.path
-import wandb
 import yaml
 from utils.kd_util import prepare
-from utils import parse
+from utils import logger, parse
+from utils.tuner import apply_tuned
+from utils.profiler import StepProfiler
+from utils.distributed import barrier, init_distributed, is_distributed, is_main_process
 import shutil
 from kd.vanilla_kd import VanillaKD
 
 def main(config, gpus):
-    # init wandb
-    if config['resume']:
-        with open(os.path.join(config['output_dir'], 'wandb.txt'), 'r') as f:
-            wandb_id = f.read().strip()
-        run = wandb.init(config=config, project=config['dataset']['type'], name=config['experiment'], resume="allow", id=wandb_id)
-    else:
-        run = wandb.init(config=config, project=config['dataset']['type'], name=config['experiment'], resume="allow")
-        with open(os.path.join(config['output_dir'], 'wandb.txt'), 'w') as f:
-            f.write(run.id)
+    # init the metrics logger; only rank 0 logs and writes to the experiment directory
+    logger.init(config, config['output_dir'], config['dataset']['type'], config['experiment'], bool(config['resume']))
 
-    with open(os.path.join(config['output_dir'], 'config.yaml'), 'w') as f:
-        yaml.dump(config, f)
+    if is_main_process():
+        with open(os.path.join(config['output_dir'], 'config.yaml'), 'w') as f:
+            yaml.dump(config, f)
 
-    teacher_model, student_model, train_loader, test_loader, teacher_optimizer, student_optimizer = prepare(config, gpus)
+    teacher_model, student_model, train_loader, test_loader, teacher_optimizer, student_optimizer = prepare(config, gpus, train_teacher=False)
 
-    distiller = VanillaKD(teacher_model, student_model, train_loader, test_loader, teacher_optimizer, student_optimizer, **config['kd_model']['args'])
+    log_path = os.path.join(config['output_dir'], 'log.txt')
+    profiler = StepProfiler.from_config(config.get('profile'), log_path)
+    distiller = VanillaKD(teacher_model, student_model, train_loader, test_loader, teacher_optimizer, student_optimizer, profiler=profiler, log_path=log_path, **config['kd_model']['args'])
 
-    distiller.load_teacher(config['teacher_model_path'])
+    distiller.load_teacher(config['teacher_model_path'], config.get('teacher_quantize', False))
     # Code Switch for modelB to self train teacher model
     #distiller.train_teacher(epochs=2, plot_losses=True, save_model=True)    # Train the teacher network
     
     distiller.train_student(epochs=config['epochs'], plot_losses=False, save_model_pth=os.path.join(config['output_dir'], 'checkpoints', 'epoch_latest.pth'), save_model=True)    # Train the student network
     distiller.evaluate(teacher=False)
+    distiller.checkpointer.close()
+    logger.finish()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -50,14 +50,23 @@ if __name__ == '__main__':
 
     config = {**kd_config, **data_config}
     config = parse(config, args.set)
+    gpus = list(map(int, args.gpus.split(',')))
+    init_distributed(config.get('distributed'), gpus)
     output_root = os.path.join(config['output_dir'], config['experiment'])
+    config = apply_tuned(config, output_root)
     if os.path.exists(output_root) and not config['resume']:
         if not args.force:
+            if is_distributed():
+                print(f'Experiment {config["experiment"]} already exists. Use --force to overwrite.')
+                exit()
             print(f'Experiment {config["experiment"]} already exists. Enter y to overwrite.')
             choice = input()
             if choice != 'y':
                 exit()
-        shutil.rmtree(output_root)
-    os.makedirs(os.path.join(output_root, 'checkpoints'), exist_ok=True)
+        if is_main_process():
+            shutil.rmtree(output_root)
+    if is_main_process():
+        os.makedirs(os.path.join(output_root, 'checkpoints'), exist_ok=True)
+    barrier()
     config['output_dir'] = output_root
-    main(config, list(map(int, args.gpus.split(','))))
+    main(config, gpus)
@@ -2,102 +2,111 @@
 import argparse
 import os
 
-import wandb
 import yaml
 from utils.vit_util import prepare
-from utils import parse
+from utils import logger, parse
+from utils.tuner import apply_tuned
+from utils.distributed import barrier, init_distributed, is_distributed, is_main_process, set_epoch, unwrap_ddp, unwrap_model
+from utils.checkpoint import CheckpointWriter
+from utils.metrics import MetricAccumulator
+from utils.precision import PrecisionPolicy
+from utils.profiler import StepProfiler
 import torch.nn as nn
 import torch
 from tqdm import tqdm
 import shutil
 
 
-def train(train_loader, model, optimizer, scheduler, scaler, criterion, epoch, device):
+def train(train_loader, model, optimizer, scheduler, precision, criterion, epoch, device, log_interval=50,
+          profiler=None):
     model.train()
-    total_loss = 0
-    phar = tqdm(train_loader, desc=f'Epoch {epoch}')
-    correct = 0
+    set_epoch(train_loader, epoch)
+    metrics = MetricAccumulator(device, log_interval)
+    profiler = profiler or StepProfiler()
+    phar = tqdm(profiler.iterate(train_loader), desc=f'Epoch {epoch}', total=len(train_loader))
     for data, target in phar:
-        data, target = data.to(device), target.to(device)
+        with profiler.phase('h2d'):
+            data, target = data.to(device), target.to(device)
         optimizer.zero_grad()
-        with torch.cuda.amp.autocast(enabled=scaler.is_enabled()):
+        with profiler.phase('forward'), precision.autocast():
             pred = model(data)
-            loss = criterion(pred, target)
-        scaler.scale(loss).backward()
-        scaler.step(optimizer)
-        scaler.update()
-        total_loss += loss.item()
-        curr_correct = (pred.argmax(1) == target).sum().item()
-        correct += curr_correct
-        phar.set_postfix(loss=loss.item(), auc=curr_correct / len(data))
+        with profiler.phase('loss'):
+            loss = criterion(pred.float(), target)
+        with profiler.phase('backward'):
+            precision.backward(loss)
+        with profiler.phase('optimizer'):
+            precision.optimizer_step(optimizer)
+        if metrics.update(pred, target, loss):
+            running_loss, running_acc = metrics.running()
+            phar.set_postfix(loss=running_loss, acc=running_acc)
+        profiler.step()
     scheduler.step()
-    return total_loss / len(train_loader), correct / len(train_loader.dataset)
+    profiler.report('train')
+    return metrics.running()
 
 
 def evaluate(test_loader, model, criterion, device):
+    model = unwrap_ddp(model)
     model.eval()
-    total_loss = 0
-    correct = 0
+    metrics = MetricAccumulator(device)
     with torch.no_grad():
         for data, target in test_loader:
             data, target = data.to(device), target.to(device)
             pred = model(data)
             loss = criterion(pred, target)
-            total_loss += loss.item()
-            correct += (pred.argmax(1) == target).sum().item()
-    return total_loss / len(test_loader), correct / len(test_loader.dataset)
+            metrics.update(pred, target, loss)
+    return metrics.running()
 
 
-def main(config, gpus, mixed_precision=False):
+def main(config, gpus, precision=None):
     train_loader, test_loader, model, optimizer, scheduler, device = prepare(config, gpus)
 
-    # init wandb
-    if config['resume']:
-        with open(os.path.join(config['output_dir'], 'wandb.txt'), 'r') as f:
-            wandb_id = f.read().strip()
-        run = wandb.init(config=config, project=config['dataset']['type'], name=config['experiment'], resume="allow",
-                         id=wandb_id)
-    else:
-        run = wandb.init(config=config, project=config['dataset']['type'], name=config['experiment'], resume="allow")
-        with open(os.path.join(config['output_dir'], 'wandb.txt'), 'w') as f:
-            f.write(run.id)
+    # init the metrics logger; only rank 0 logs and writes to the experiment directory
+    logger.init(config, config['output_dir'], config['dataset']['type'], config['experiment'], bool(config['resume']))
 
-    with open(os.path.join(config['output_dir'], 'config.yaml'), 'w') as f:
-        yaml.dump(config, f)
+    if is_main_process():
+        with open(os.path.join(config['output_dir'], 'config.yaml'), 'w') as f:
+            yaml.dump(config, f)
 
     criterion = nn.CrossEntropyLoss()
     start = 1 if not config['resume'] else config['resume'] + 1
-    scaler = torch.cuda.amp.GradScaler(enabled=mixed_precision)
+    precision = PrecisionPolicy(precision, device)
+    if config['resume']:
+        state = torch.load(os.path.join(config['output_dir'], 'checkpoints', f'epoch_{config["resume"]}.pth'),
+                           map_location='cpu')
+        precision.load_state_dict(state.get('scaler'))
+    profiler = StepProfiler.from_config(config.get('profile'), os.path.join(config['output_dir'], 'log.txt'))
+    checkpoint_config = config.get('checkpoint') or {}
+    writer = CheckpointWriter(keep=checkpoint_config.get('keep'), blocking=not checkpoint_config.get('async', True),
+                              log_path=os.path.join(config['output_dir'], 'log.txt'))
     # train your model
     for epoch in range(start, config['epochs'] + 1):
         lr = scheduler.get_last_lr()[0]
         # train your model
-        train_loss, train_acc = train(train_loader, model, optimizer, scheduler, scaler, criterion, epoch, device)
+        train_loss, train_acc = train(train_loader, model, optimizer, scheduler, precision, criterion, epoch, device,
+                                      config.get('log_interval', 50), profiler)
         # validate your model
         test_loss, test_acc = evaluate(test_loader, model, criterion, device)
         # log your results
-        with open(os.path.join(config['output_dir'], 'log.txt'), 'a') as f:
-            f.write(
-                f'Epoch {epoch}: train_loss: {train_loss}, train_acc: {train_acc}, test_loss: {test_loss}, test_acc: {test_acc}, lr: {lr}\n')
-        wandb.log({'epoch': epoch, 'train_loss': train_loss, 'train_acc': train_acc, 'test_loss': test_loss,
-                   'test_acc': test_acc, 'lr': lr})
+        logger.write_text(os.path.join(config['output_dir'], 'log.txt'),
+                          f'Epoch {epoch}: train_loss: {train_loss}, train_acc: {train_acc}, test_loss: {test_loss}, test_acc: {test_acc}, lr: {lr}')
+        logger.log({'epoch': epoch, 'train_loss': train_loss, 'train_acc': train_acc, 'test_loss': test_loss,
+                    'test_acc': test_acc, 'lr': lr})
         # save your model
-        if epoch % config['save_interval'] == 0:
+        if epoch % config['save_interval'] == 0 and is_main_process():
             output_path = os.path.join(config['output_dir'], 'checkpoints', f'epoch_{epoch}.pth')
-            if isinstance(model, nn.DataParallel):
-                model_state = model.module.state_dict()
-            else:
-                model_state = model.state_dict()
+            model_state = unwrap_model(model).state_dict()
             state = {
                 'model': model_state,
                 'optimizer': optimizer.state_dict(),
-                'scheduler': scheduler.state_dict()
+                'scheduler': scheduler.state_dict(),
+                'scaler': precision.state_dict()
             }
-            torch.save(state, output_path)
-            output_path = os.path.join(config['output_dir'], 'checkpoints', 'epoch_latest.pth')
-            torch.save(state, output_path)
+            latest_path = os.path.join(config['output_dir'], 'checkpoints', 'epoch_latest.pth')
+            writer.save(state, output_path, latest=latest_path)
             # wandb.save(output_path)
-    run.finish()
+    writer.close()
+    logger.finish()
 
 
 if __name__ == '__main__':
@@ -108,7 +117,9 @@ if __name__ == '__main__':
                         help='path to the dataset configuration file')
     parser.add_argument('--set', type=str, nargs='+', default=[], help='override configuration file')
     parser.add_argument('--gpus', type=str, default='0', help='gpus to use')
-    parser.add_argument('--mixed', action='store_true', help='enable mixed precision training')
+    parser.add_argument('--mixed', action='store_true', help='enable mixed precision training, same as --precision fp16')
+    parser.add_argument('--precision', type=str, default=None, choices=['fp32', 'fp16', 'bf16'],
+                        help='training precision; fp16 uses a gradient scaler, bf16 also works on CPU')
     parser.add_argument('--force', action='store_true', help='overwrite existing experiment')
     args = parser.parse_args()
 
@@ -120,14 +131,23 @@ if __name__ == '__main__':
 
     config = {**model_config, **data_config}
     config = parse(config, args.set)
+    gpus = list(map(int, args.gpus.split(',')))
+    init_distributed(config.get('distributed'), gpus)
     output_root = os.path.join(config['output_dir'], config['experiment'])
+    config = apply_tuned(config, output_root)
     if os.path.exists(output_root) and not config['resume']:
         if not args.force:
+            if is_distributed():
+                print(f'Experiment {config["experiment"]} already exists. Use --force to overwrite.')
+                exit()
             print(f'Experiment {config["experiment"]} already exists. Enter y to overwrite.')
             choice = input()
             if choice != 'y':
                 exit()
-        shutil.rmtree(output_root)
-    os.makedirs(os.path.join(output_root, 'checkpoints'), exist_ok=True)
+        if is_main_process():
+            shutil.rmtree(output_root)
+    if is_main_process():
+        os.makedirs(os.path.join(output_root, 'checkpoints'), exist_ok=True)
+    barrier()
     config['output_dir'] = output_root
-    main(config, list(map(int, args.gpus.split(','))), args.mixed)
+    main(config, gpus, args.precision or ('fp16' if args.mixed else None))
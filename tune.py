@@ -0,0 +1,72 @@
+import argparse
+import os
+
+import torch
+import yaml
+
+from utils import parse
+from utils.dataset import make_collate, make_dataset
+from utils.distributed import get_device
+from utils.tuner import loader_candidates, make_train_step, probe_batch_size, sweep_loader, uses_teacher_cache, write_tuned
+
+
+def main(config, gpus, args):
+    output_root = os.path.join(config['output_dir'], config['experiment'])
+    transforms_config = config['dataset']['train']['transforms']
+    train_dataset = make_dataset(config['dataset'], 'train', transforms_config)
+    num_classes = len(train_dataset.classes)
+    device = get_device(gpus)
+
+    print('Probing the batch size...')
+    factory = make_train_step(config, num_classes, device)
+    batch_size, probes = probe_batch_size(factory, device, args.memory_budget, args.start_batch_size,
+                                          args.max_batch_size)
+    del factory
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+    print('Sweeping the train loader...')
+    workers = sorted({w for w in args.workers if w <= (os.cpu_count() or 1)})
+    candidates = loader_candidates(workers, args.prefetch_factors, not uses_teacher_cache(config))
+    loader, loader_rate, _ = sweep_loader(train_dataset, batch_size, candidates,
+                                          make_collate(transforms_config), pin_memory=device.type == 'cuda',
+                                          batches=args.batches)
+
+    step_rate = dict((b, rate) for b, rate, _ in probes)[batch_size]
+    tuned = {
+        # batch_size is global, as in the configs; each of world_size processes gets the probed batch
+        'batch_size': batch_size * args.world_size,
+        'loader': loader,
+        'step_samples_per_sec': round(step_rate, 1),
+        'loader_samples_per_sec': round(loader_rate, 1),
+    }
+    path = write_tuned(output_root, config, tuned)
+    print(f'Tuned settings written to {path}:')
+    print(yaml.dump(tuned))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='configs/kd/vkd.yaml',
+                        help='path to a vit, vkd or ckd configuration file')
+    parser.add_argument('--data', type=str, default='configs/dataset/cifar10.yaml', help='path to the dataset configuration file')
+    parser.add_argument('--set', type=str, nargs='+', default=[], help='override configuration file')
+    parser.add_argument('--gpus', type=str, default='0', help='gpu to probe on')
+    parser.add_argument('--world-size', type=int, default=1, help='processes the experiment is launched with')
+    parser.add_argument('--memory-budget', type=float, default=0.9, help='fraction of GPU memory a step may use')
+    parser.add_argument('--start-batch-size', type=int, default=8, help='first probed batch size')
+    parser.add_argument('--max-batch-size', type=int, default=4096, help='largest probed batch size')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2, 4, 8, 16], help='loader worker counts to sweep')
+    parser.add_argument('--prefetch-factors', type=int, nargs='+', default=[2, 4, 8], help='prefetch factors to sweep')
+    parser.add_argument('--batches', type=int, default=20, help='batches per loader pass')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        model_config = yaml.load(f, Loader=yaml.FullLoader)
+
+    with open(args.data, 'r') as f:
+        data_config = yaml.load(f, Loader=yaml.FullLoader)
+
+    config = {**model_config, **data_config}
+    config = parse(config, args.set)
+    main(config, list(map(int, args.gpus.split(','))), args)
@@ -0,0 +1,132 @@
+import torch
+import torch.nn.functional as F
+from torch.utils.data.dataloader import default_collate
+
+
+def pair(t):
+    return tuple(t) if isinstance(t, (list, tuple)) else (t, t)
+
+
+class BatchRandomCrop:
+    """
+    RandomCrop over a ``[B, C, H, W]`` batch with an independent offset per sample, done as
+    two gathers instead of B separate crops
+    """
+
+    def __init__(self, size, padding=None, fill=0):
+        self.size = pair(size)
+        if padding is None or isinstance(padding, int):
+            padding = [padding or 0] * 4
+        elif len(padding) == 2:
+            padding = [padding[0], padding[1], padding[0], padding[1]]
+        # torchvision order is (left, top, right, bottom), F.pad wants (left, right, top, bottom)
+        self.padding = (padding[0], padding[2], padding[1], padding[3])
+        self.fill = fill
+
+    def __call__(self, x):
+        if any(self.padding):
+            x = F.pad(x, self.padding, value=self.fill)
+        b, c, h, w = x.shape
+        th, tw = self.size
+        top = torch.randint(0, h - th + 1, (b, 1))
+        left = torch.randint(0, w - tw + 1, (b, 1))
+        rows = (top + torch.arange(th)).to(x.device)
+        cols = (left + torch.arange(tw)).to(x.device)
+        x = x.gather(2, rows[:, None, :, None].expand(b, c, th, w))
+        return x.gather(3, cols[:, None, None, :].expand(b, c, th, tw))
+
+    def __repr__(self):
+        return '{}(size={}, padding={})'.format(self.__class__.__name__, self.size, self.padding)
+
+
+class BatchRandomHorizontalFlip:
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, x):
+        flip = (torch.rand(x.size(0)) < self.p).to(x.device)
+        return torch.where(flip[:, None, None, None], x.flip(3), x)
+
+    def __repr__(self):
+        return '{}(p={})'.format(self.__class__.__name__, self.p)
+
+
+class BatchNormalize:
+    def __init__(self, mean, std, inplace=False):
+        self.mean = torch.tensor(mean, dtype=torch.float32)[None, :, None, None]
+        self.std = torch.tensor(std, dtype=torch.float32)[None, :, None, None]
+
+    def __call__(self, x):
+        x = to_float(x)
+        return (x - self.mean.to(x.device)) / self.std.to(x.device)
+
+    def __repr__(self):
+        return '{}(mean={}, std={})'.format(self.__class__.__name__, self.mean.flatten().tolist(),
+                                            self.std.flatten().tolist())
+
+
+def to_float(x):
+    if x.dtype == torch.uint8:
+        return x.float().div_(255)
+    return x
+
+
+BATCH_TRANSFORMS = {
+    'RandomCrop': BatchRandomCrop,
+    'RandomHorizontalFlip': BatchRandomHorizontalFlip,
+    'Normalize': BatchNormalize,
+}
+
+
+class BatchCompose:
+    """
+    Applies batch transforms in order; uint8 batches leave as float in [0, 1]
+    """
+
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, x):
+        for transform in self.transforms:
+            x = transform(x)
+        return to_float(x)
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, ', '.join(repr(t) for t in self.transforms))
+
+
+def split_batch_transforms(config):
+    """
+    Split a transforms list into the per-sample part and the trailing entries marked
+    ``batch: True``, which run on the collated batch
+    """
+    n = len(config)
+    while n > 0 and config[n - 1].get('batch', False):
+        n -= 1
+    if any(transform.get('batch', False) for transform in config[:n]):
+        raise ValueError('Transforms marked batch: True must come last in the transforms list')
+    return config[:n], config[n:]
+
+
+def make_batch_transforms(config):
+    transforms_list = []
+    for transform in config:
+        if transform['type'] not in BATCH_TRANSFORMS:
+            raise ValueError('{} has no batch implementation, supported: {}'.format(
+                transform['type'], ', '.join(BATCH_TRANSFORMS)))
+        transforms_list.append(BATCH_TRANSFORMS[transform['type']](**transform.get('args', {})))
+    return BatchCompose(transforms_list)
+
+
+class BatchCollate:
+    """
+    collate_fn that stacks the samples and then applies the batch transforms, inside the
+    DataLoader workers when there are any
+    """
+
+    def __init__(self, transform):
+        self.transform = transform
+
+    def __call__(self, batch):
+        data, target = default_collate(batch)
+        return self.transform(data), target
@@ -0,0 +1,212 @@
+import copy
+import os
+import re
+import shutil
+import threading
+import time
+
+import torch
+
+from . import logger
+
+
+def atomic_save(state, path):
+    """
+    torch.save to a temporary file in the same directory, fsync it and rename it over path, so
+    a preempted write never leaves a truncated checkpoint behind
+    """
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def atomic_link(src, dst):
+    """
+    Point dst at the contents of src with a hard link, replacing dst atomically; copies where
+    the filesystem has no hard links
+    """
+    tmp = f'{dst}.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class CheckpointWriter:
+    """
+    Saves checkpoints off the training thread. ``save`` snapshots every tensor of the state into
+    reusable (pinned, when CUDA is available) CPU buffers and returns; a background thread
+    serializes the snapshot with atomic_save, hard-links the ``latest`` alias to it and removes
+    all but the ``keep`` most recent checkpoints named like it (epoch_3.pth counts epoch_*.pth),
+    including those already on disk from before a resume. The time training is blocked (the
+    snapshot and waiting for the previous write) is printed and accumulated in ``stall``.
+
+    :param keep (int): Checkpoints to keep, not counting the latest alias; None keeps all
+    :param blocking (bool): Write on the calling thread instead
+    :param log_path (str): Log file receiving the stall and write times
+    """
+
+    def __init__(self, keep=None, blocking=False, log_path=None):
+        self.keep = keep
+        self.blocking = blocking
+        self.log_path = log_path
+        self.pin_memory = torch.cuda.is_available()
+        self.buffers = {}
+        self.history = {}
+        self.stall = 0.0
+        self.thread = None
+        self.error = None
+
+    def save(self, state, path, latest=None):
+        """
+        Save state to path and, if given, make latest an alias of it
+
+        :param state (dict): Checkpoint, e.g. {'model': state_dict, 'optimizer': ...}
+        :param path (str): Checkpoint file
+        :param latest (str): Alias updated to the new checkpoint, e.g. epoch_latest.pth
+        """
+        start = time.perf_counter()
+        self.wait()
+        snapshot = self._snapshot(state, ())
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        stall = time.perf_counter() - start
+        self.stall += stall
+        if self.blocking:
+            self._write(snapshot, path, latest, stall)
+        else:
+            self.thread = threading.Thread(target=self._run, args=(snapshot, path, latest, stall))
+            self.thread.start()
+
+    def wait(self):
+        """
+        Block until the pending write is on disk and raise its error, if any
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        self.wait()
+        self.buffers.clear()
+
+    def _snapshot(self, value, key):
+        if isinstance(value, torch.Tensor):
+            buffer = self.buffers.get(key)
+            if buffer is None or buffer.shape != value.shape or buffer.dtype != value.dtype:
+                buffer = torch.empty(value.shape, dtype=value.dtype, pin_memory=self.pin_memory)
+                self.buffers[key] = buffer
+            buffer.copy_(value.detach(), non_blocking=self.pin_memory)
+            return buffer
+        if isinstance(value, dict):
+            return type(value)((k, self._snapshot(v, key + (k,))) for k, v in value.items())
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._snapshot(v, key + (i,)) for i, v in enumerate(value))
+        return copy.deepcopy(value)
+
+    def _run(self, snapshot, path, latest, stall):
+        try:
+            self._write(snapshot, path, latest, stall)
+        except BaseException as e:
+            self.error = e
+
+    def _write(self, snapshot, path, latest, stall):
+        start = time.perf_counter()
+        atomic_save(snapshot, path)
+        if latest is not None:
+            atomic_link(path, latest)
+        history = self._history(path)
+        if path not in history:
+            history.append(path)
+        while self.keep is not None and len(history) > self.keep:
+            old = history.pop(0)
+            if os.path.exists(old):
+                os.remove(old)
+        msg = 'Checkpoint {}: training stalled {:.3f}s, written in {:.2f}s'.format(
+            os.path.basename(path), stall, time.perf_counter() - start)
+        print(msg)
+        if self.log_path is not None:
+            logger.write_text(self.log_path, msg)
+
+    def _history(self, path):
+        # checkpoints sharing path's name up to its numbers, seeded from disk the first time and
+        # ordered by those numbers, so a resumed run also prunes the files of the previous session
+        directory, name = os.path.split(path)
+        pattern = ''.join(r'\d+' if part.isdigit() else re.escape(part) for part in re.split(r'(\d+)', name))
+        key = (os.path.abspath(directory), pattern)
+        if key not in self.history:
+            existing = [f for f in os.listdir(directory or '.') if re.fullmatch(pattern, f)]
+            existing.sort(key=lambda f: [int(n) for n in re.findall(r'\d+', f)])
+            self.history[key] = [os.path.join(directory, f) for f in existing]
+        return self.history[key]
+
+
+class BestModelTracker:
+    """
+    Keeps the weights of the best model seen so far without a second copy on the training
+    device: a CPU shadow of the state_dict, allocated once (pinned when CUDA is available) and
+    overwritten in place on every improvement, or a file written with atomic_save when path is
+    given. The weights at construction are the initial best, with score 0.
+
+    :param model (torch.nn.Module): Model whose weights are tracked
+    :param path (str): Stream the best weights to this file instead of keeping them in memory
+    :param name (str): Name of the model in the memory report
+    """
+
+    def __init__(self, model, path=None, name='model'):
+        self.model = model
+        self.path = path
+        self.best = 0.0
+        self.shadow = None
+        state = model.state_dict()
+        self.nbytes = sum(t.numel() * t.element_size() for t in state.values() if isinstance(t, torch.Tensor))
+        self.device = next((t.device for t in state.values() if isinstance(t, torch.Tensor)), torch.device('cpu'))
+        if path is None:
+            pin_memory = torch.cuda.is_available()
+            self.shadow = {k: torch.empty(v.shape, dtype=v.dtype, pin_memory=pin_memory) if isinstance(v, torch.Tensor)
+                           else v for k, v in state.items()}
+        self._copy(state)
+        where = self.path or 'CPU memory'
+        print('Best {} weights ({:.1f} MB) kept in {} instead of a copy on {}'.format(
+            name, self.nbytes / 2 ** 20, where, self.device))
+
+    def update(self, score):
+        """
+        Record the current weights if score beats the best so far; returns True if it did
+        """
+        if score <= self.best:
+            return False
+        self.best = score
+        self._copy(self.model.state_dict())
+        return True
+
+    def restore(self):
+        """
+        Load the best weights back into the model
+        """
+        if self.shadow is not None:
+            self.model.load_state_dict(self.shadow)
+        else:
+            self.model.load_state_dict(torch.load(self.path, map_location='cpu'))
+
+    def _copy(self, state):
+        if self.shadow is None:
+            atomic_save({k: v.detach().cpu() if isinstance(v, torch.Tensor) else v for k, v in state.items()},
+                        self.path)
+            return
+        for k, v in state.items():
+            if isinstance(v, torch.Tensor):
+                self.shadow[k].copy_(v.detach(), non_blocking=self.shadow[k].is_pinned())
+            else:
+                self.shadow[k] = copy.deepcopy(v)
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
@@ -0,0 +1,84 @@
+import os
+import time
+import types
+
+import torch
+
+from . import logger
+
+MODES = {'default', 'reduce-overhead', 'max-autotune', 'max-autotune-no-cudagraphs'}
+
+
+def enable_compile_cache(cache_dir):
+    """
+    Keep the inductor/triton artifacts and, where the torch version supports it, the compiled FX
+    and autograd graphs in cache_dir, so later runs (and resumes) load them instead of recompiling
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', cache_dir)
+    os.environ.setdefault('TRITON_CACHE_DIR', os.path.join(cache_dir, 'triton'))
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except (ImportError, AttributeError):
+        pass
+    try:
+        import torch._functorch.config as functorch_config
+        if hasattr(functorch_config, 'enable_autograd_cache'):
+            functorch_config.enable_autograd_cache = True
+    except ImportError:
+        pass
+
+
+class StepTimer:
+    """
+    Times the first calls of a compiled forward: the first one includes compilation, the
+    following ones give the steady-state step time. Logged once, after ``steps`` calls.
+    """
+
+    def __init__(self, fn, name, path, steps=10):
+        self.fn = fn
+        self.name = name
+        self.path = path
+        self.steps = steps
+        self.times = []
+
+    def __call__(self, *args, **kwargs):
+        if len(self.times) > self.steps:
+            return self.fn(*args, **kwargs)
+        start = time.perf_counter()
+        out = self.fn(*args, **kwargs)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.times.append(time.perf_counter() - start)
+        if len(self.times) == self.steps + 1:
+            steady = sorted(self.times[1:])[len(self.times[1:]) // 2]
+            msg = f'{self.name} compile: first call {self.times[0]:.2f}s, steady-state forward {steady * 1e3:.2f}ms'
+            print(msg)
+            logger.write_text(self.path, msg)
+        return out
+
+
+def compile_model(model, mode, cache_dir, path, name='model'):
+    """
+    Compile the forward of model in place with torch.compile. The module itself is kept, so
+    state_dict keys, checkpoints and deepcopy are unaffected; graphs that fail to compile run eagerly.
+
+    :param model (torch.nn.Module): Model to compile
+    :param mode (str): torch.compile mode, or True for 'default'
+    :param cache_dir (str): Directory of the on-disk compile cache
+    :param path (str): Log file receiving the compile timings
+    :param name (str): Name of the model in the log
+    """
+    if not hasattr(torch, 'compile'):
+        print(f'torch.compile is not available in torch {torch.__version__}. Running {name} eagerly.')
+        return model
+    mode = 'default' if mode is True else mode
+    if mode not in MODES:
+        raise ValueError(f'Unknown compile mode {mode}, expected one of {sorted(MODES)}')
+    enable_compile_cache(cache_dir)
+    torch._dynamo.config.suppress_errors = True
+    forward = torch.compile(type(model).forward, mode=mode)
+    # bound to the instance, so a deepcopy of the model calls the compiled forward with the copy
+    model.forward = types.MethodType(StepTimer(forward, name, path), model)
+    return model
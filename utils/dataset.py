@@ -1,7 +1,24 @@
 # Created by Baole Fang at 4/2/24
-from torch.utils.data import DataLoader
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+from torch.utils.data.distributed import DistributedSampler
 from torchvision import transforms, datasets
 
+from .batch_transforms import BatchCollate, make_batch_transforms, split_batch_transforms
+from .distributed import ShardSampler, get_rank, get_world_size, is_distributed
+
+# transforms whose output only depends on the input image, so their result can be cached
+DETERMINISTIC_TRANSFORMS = {'ToTensor', 'PILToTensor', 'Resize', 'CenterCrop', 'Grayscale'}
+# version of sample_seed, stored with teacher caches so a change of the scheme invalidates them
+SAMPLE_SEED_VERSION = 1
+# transforms that work on uint8 tensors; the cached images are converted to float before any other
+UINT8_TRANSFORMS = {'RandomCrop', 'RandomHorizontalFlip', 'RandomVerticalFlip', 'CenterCrop', 'Pad'}
+
 
 def make_transforms(config):
     transforms_list = []
@@ -15,17 +32,281 @@ def make_transforms(config):
     return transforms.Compose(transforms_list)
 
 
-def make_datasets(config):
-    train_transforms = make_transforms(config['train']['transforms'])
-    test_transforms = make_transforms(config['train']['transforms'])
+def sample_seed(seed, aug, index):
+    """
+    Seed of one augmented view, an explicit integer mix of (seed, aug, index) so it does not
+    depend on the interpreter version like hash() does
+    """
+    return ((seed * 1000003 + aug) * 2147483647 + index) & (2 ** 63 - 1)
+
+
+class SeededDataset(Dataset):
+    """
+    Wraps a dataset so every sample is returned together with its index and its random
+    transforms are replayed deterministically from (seed, aug, index). Used to key
+    cached teacher outputs by the exact augmented view the teacher saw.
+
+    :param dataset (torch.utils.data.Dataset): Dataset to wrap
+    :param seed (int): Base seed of the augmentation stream
+    """
+
+    def __init__(self, dataset, seed=0):
+        self.dataset = dataset
+        self.seed = seed
+        self.aug = 0
+
+    @property
+    def classes(self):
+        return self.dataset.classes
+
+    @property
+    def transform(self):
+        return self.dataset.transform
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(sample_seed(self.seed, self.aug, index))
+            data, label = self.dataset[index]
+        return data, label, index
+
+
+def split_transforms(config):
+    """
+    Split a transforms list into its deterministic prefix and the random tail
+    """
+    n = 0
+    while n < len(config) and config[n]['type'] in DETERMINISTIC_TRANSFORMS:
+        n += 1
+    return config[:n], config[n:]
+
+
+def cache_path(cache_dir, key, prefix):
+    digest = hashlib.sha256(json.dumps({**key, 'prefix': prefix}, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, '{}-{}'.format(key['type'], digest))
+
+
+def materialize(dataset, prefix, num_workers=0, path=None):
+    """
+    Apply the deterministic transforms in prefix to every sample once and stack the results as
+    uint8. Returns in-memory arrays, or writes them to ``path.npy``/``path.targets.npy`` when
+    path is given.
+    """
+    print('Materializing {} samples{}'.format(len(dataset), ' to {}.npy'.format(path) if path else ''))
+    if path is not None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+    dataset.transform = make_transforms(prefix)
+    loader = DataLoader(dataset, batch_size=256, shuffle=False, num_workers=num_workers)
+    images, targets, start = None, np.empty(len(dataset), dtype=np.int64), 0
+    for data, target in loader:
+        if not torch.is_tensor(data):
+            raise ValueError('The cached transform prefix must produce tensors, got {}'.format(prefix))
+        if data.dtype != torch.uint8:
+            data = (data * 255).round_().clamp_(0, 255).to(torch.uint8)
+        if images is None:
+            shape = (len(dataset),) + tuple(data.shape[1:])
+            if path is None:
+                images = np.empty(shape, dtype=np.uint8)
+            else:
+                images = np.lib.format.open_memmap(tmp + '.npy', mode='w+', dtype=np.uint8, shape=shape)
+        images[start:start + len(data)] = data.numpy()
+        targets[start:start + len(data)] = target.numpy()
+        start += len(data)
+    dataset.transform = None
+    if path is None:
+        return images, targets
+    images.flush()
+    del images
+    # publish atomically: the images file appears last and only when complete
+    np.save(tmp + '.targets.npy', targets)
+    os.replace(tmp + '.targets.npy', path + '.targets.npy')
+    os.replace(tmp + '.npy', path + '.npy')
+
+
+class CachedDataset(Dataset):
+    """
+    Dataset whose deterministic transform prefix (decode, ToTensor, Resize) is applied once and
+    stored as a uint8 ``.npy`` file in cache_dir. Samples are read from a read-only memory map,
+    so concurrent runs on one node that point at the same cache_dir (e.g. under /dev/shm) share
+    the same pages, and only the random tail of the pipeline runs per sample.
+
+    :param dataset (torch.utils.data.Dataset): Dataset built without a transform
+    :param transforms_config (list): Transforms list from the dataset config
+    :param cache_dir (str): Directory of the cache files
+    :param key (dict): Description of the dataset (type, args) identifying the cache
+    :param num_workers (int): Loader workers used to build the cache
+    :param convert (bool): Convert samples to float; False leaves uint8 samples for batch transforms
+    """
+
+    def __init__(self, dataset, transforms_config, cache_dir, key, num_workers=0, convert=True):
+        prefix, tail = split_transforms(transforms_config)
+        n = 0
+        while n < len(tail) and tail[n]['type'] in UINT8_TRANSFORMS:
+            n += 1
+        to_float = [{'type': 'ConvertImageDtype', 'args': {'dtype': torch.float32}}] if convert or n < len(tail) else []
+        self.tail = make_transforms(tail[:n] + to_float + tail[n:])
+        # the effective pipeline, used to fingerprint the dataset
+        self.transform = make_transforms(
+            prefix + [{'type': 'ConvertImageDtype', 'args': {'dtype': torch.uint8}}] + tail[:n] + to_float + tail[n:]
+        )
+        self.classes = dataset.classes
+
+        self.path = cache_path(cache_dir, key, prefix)
+        if not os.path.exists(self.path + '.npy'):
+            materialize(dataset, prefix, num_workers, self.path)
+        self.images = np.load(self.path + '.npy', mmap_mode='r')
+        self.targets = np.load(self.path + '.targets.npy')
+
+    def __getstate__(self):
+        # workers reopen the memory map instead of receiving a pickled copy of the images
+        state = self.__dict__.copy()
+        state['images'] = None
+        return state
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        if self.images is None:
+            self.images = np.load(self.path + '.npy', mmap_mode='r')
+        image = torch.from_numpy(np.array(self.images[index]))
+        return self.tail(image), int(self.targets[index])
+
+
+class PrecomputedDataset(Dataset):
+    """
+    Evaluation split whose transforms are all deterministic, applied once up front. The images
+    are kept as one contiguous uint8 array (memory-mapped from cache_dir when given, e.g. for
+    ImageNet) and only the trailing Normalize runs, per batch, when served by a TensorLoader.
+
+    :param dataset (torch.utils.data.Dataset): Dataset built without a transform
+    :param transforms_config (list): Transforms list from the dataset config
+    :param cache_dir (str): Directory of the cache files; None keeps the images in memory
+    :param key (dict): Description of the dataset (type, args) identifying the cache
+    :param num_workers (int): Loader workers used to build the images
+    """
+
+    def __init__(self, dataset, transforms_config, cache_dir=None, key=None, num_workers=0):
+        prefix, tail = split_transforms(transforms_config)
+        if any(transform['type'] != 'Normalize' for transform in tail):
+            raise ValueError('Precomputing needs deterministic transforms, got {}'.format(
+                [transform['type'] for transform in tail]))
+        self.normalize = make_batch_transforms(tail)
+        self.transform = make_transforms(
+            prefix + [{'type': 'ConvertImageDtype', 'args': {'dtype': torch.uint8}},
+                      {'type': 'ConvertImageDtype', 'args': {'dtype': torch.float32}}] + tail
+        )
+        self.classes = dataset.classes
+
+        if cache_dir:
+            path = cache_path(cache_dir, key, prefix)
+            if not os.path.exists(path + '.npy'):
+                materialize(dataset, prefix, num_workers, path)
+            self.images = np.load(path + '.npy', mmap_mode='r')
+            self.targets = torch.from_numpy(np.load(path + '.targets.npy'))
+        else:
+            self.images, targets = materialize(dataset, prefix, num_workers)
+            self.targets = torch.from_numpy(targets)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        data, target = self.batch(index, index + 1)
+        return data[0], int(target[0])
+
+    def batch(self, start, end):
+        images = self.images[start:end]
+        if isinstance(images, np.memmap):
+            images = np.array(images)
+        return self.normalize(torch.from_numpy(images)), self.targets[start:end]
+
+
+class TensorLoader:
+    """
+    Serves a PrecomputedDataset in order by slicing, without sampler, collate or worker processes.
+    Under DistributedDataParallel every rank serves its own contiguous shard.
+
+    :param dataset (PrecomputedDataset): Dataset to serve
+    :param batch_size (int): Batch size
+    :param pin_memory (bool): Return batches in pinned memory
+    """
+
+    def __init__(self, dataset, batch_size, pin_memory=False, **kwargs):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        rank, world_size = get_rank(), get_world_size()
+        self.start = len(dataset) * rank // world_size
+        self.end = len(dataset) * (rank + 1) // world_size
+
+    def __len__(self):
+        return (self.end - self.start + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        for start in range(self.start, self.end, self.batch_size):
+            data, target = self.dataset.batch(start, min(start + self.batch_size, self.end))
+            if self.pin_memory:
+                data, target = data.pin_memory(), target.pin_memory()
+            yield data, target
+
+
+def make_dataset(config, split, transforms_config):
     func = getattr(datasets, config['type'])
-    train_dataset = func(transform=train_transforms, **config['train']['args'])
-    test_dataset = func(transform=test_transforms, **config['test']['args'])
+    args = {k: v for k, v in config[split]['args'].items() if k != 'download'}
+    key = {'type': config['type'], 'args': args}
+    num_workers = config[split]['loader'].get('num_workers', 0)
+    if config[split].get('precompute'):
+        return PrecomputedDataset(func(**config[split]['args']), transforms_config, config.get('cache_dir'),
+                                  key, num_workers)
+    transforms_config, batch_config = split_batch_transforms(transforms_config)
+    if config.get('cache_dir'):
+        return CachedDataset(func(**config[split]['args']), transforms_config, config['cache_dir'], key,
+                             num_workers, convert=not batch_config)
+    return func(transform=make_transforms(transforms_config), **config[split]['args'])
+
+
+def make_datasets(config):
+    train_dataset = make_dataset(config, 'train', config['train']['transforms'])
+    test_dataset = make_dataset(config, 'test', config['test']['transforms'])
     return train_dataset, test_dataset
 
 
-def make_dataloaders(config, batch_size):
+def make_collate(transforms_config):
+    _, batch_config = split_batch_transforms(transforms_config)
+    if batch_config:
+        return BatchCollate(make_batch_transforms(batch_config))
+    return None
+
+
+def make_dataloaders(config, batch_size, indexed=False):
     train_dataset, test_dataset = make_datasets(config)
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, **config['train']['loader'])
-    test_loader = DataLoader(test_dataset, batch_size=batch_size, **config['test']['loader'])
+    train_collate = make_collate(config['train']['transforms'])
+    test_collate = make_collate(config['test']['transforms'])
+    if indexed:
+        if train_collate is not None:
+            raise ValueError('Batch transforms are not replayed per sample; disable them to use a teacher cache')
+        train_dataset = SeededDataset(train_dataset)
+    if is_distributed():
+        # batch_size stays the global batch size, split over the processes
+        batch_size = max(batch_size // get_world_size(), 1)
+        train_args = {k: v for k, v in config['train']['loader'].items() if k != 'shuffle'}
+        test_args = {k: v for k, v in config['test']['loader'].items() if k != 'shuffle'}
+        train_sampler = DistributedSampler(train_dataset, shuffle=config['train']['loader'].get('shuffle', False))
+        train_loader = DataLoader(train_dataset, batch_size=batch_size, sampler=train_sampler,
+                                  collate_fn=train_collate, **train_args)
+        if config['test'].get('precompute'):
+            test_loader = TensorLoader(test_dataset, batch_size, **test_args)
+        else:
+            test_loader = DataLoader(test_dataset, batch_size=batch_size, sampler=ShardSampler(test_dataset),
+                                     collate_fn=test_collate, **test_args)
+        return train_loader, test_loader
+    train_loader = DataLoader(train_dataset, batch_size=batch_size, collate_fn=train_collate, **config['train']['loader'])
+    if config['test'].get('precompute'):
+        test_loader = TensorLoader(test_dataset, batch_size, **config['test']['loader'])
+    else:
+        test_loader = DataLoader(test_dataset, batch_size=batch_size, collate_fn=test_collate, **config['test']['loader'])
     return train_loader, test_loader
@@ -0,0 +1,135 @@
+import builtins
+import contextlib
+import os
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DataParallel, DistributedDataParallel
+from torch.utils.data import Sampler
+
+# DistributedDataParallel arguments that can be set in the `distributed` config block
+DDP_ARGS = {'bucket_cap_mb', 'gradient_as_bucket_view', 'static_graph', 'find_unused_parameters', 'broadcast_buffers'}
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def init_distributed(config, gpus):
+    """
+    Join the process group when launched with torchrun (WORLD_SIZE > 1). Every process uses
+    gpus[LOCAL_RANK] when CUDA is available, otherwise the CPU with the gloo backend. Only
+    rank 0 prints; pass force=True to print from every rank.
+
+    :param config (dict): The `distributed` config block
+    :param gpus (list): GPUs of this node
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1 or is_distributed():
+        return is_distributed()
+    config = config or {}
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if torch.cuda.is_available():
+        torch.cuda.set_device(gpus[local_rank % len(gpus)])
+    backend = config.get('backend') or ('nccl' if torch.cuda.is_available() else 'gloo')
+    dist.init_process_group(backend)
+
+    main_process = is_main_process()
+    builtin_print = builtins.print
+
+    def print(*args, force=False, **kwargs):
+        if main_process or force:
+            builtin_print(*args, **kwargs)
+
+    builtins.print = print
+    return True
+
+
+def get_device(gpus):
+    if is_distributed():
+        return torch.device('cuda', torch.cuda.current_device()) if torch.cuda.is_available() else torch.device('cpu')
+    if torch.cuda.is_available():
+        return torch.device(f'cuda:{gpus[0]}')
+    return torch.device('mps') if torch.backends.mps.is_available() else torch.device('cpu')
+
+
+def wrap_ddp(model, device, config):
+    args = {k: v for k, v in (config or {}).items() if k in DDP_ARGS and v is not None}
+    device_ids = [device] if torch.device(device).type == 'cuda' else None
+    return DistributedDataParallel(model, device_ids=device_ids, **args)
+
+
+def unwrap_model(model):
+    if isinstance(model, (DataParallel, DistributedDataParallel)):
+        return model.module
+    return model
+
+
+def unwrap_ddp(model):
+    """
+    The module inside DistributedDataParallel, for forwards that must not take part in its
+    collectives (evaluation, soft targets); DataParallel is kept
+    """
+    if isinstance(model, DistributedDataParallel):
+        return model.module
+    return model
+
+
+def no_sync(model, skip):
+    """
+    Skip the DistributedDataParallel gradient all-reduce of the backward passes in this context,
+    e.g. for all but the last micro-batch of an accumulated step
+    """
+    if skip and isinstance(model, DistributedDataParallel):
+        return model.no_sync()
+    return contextlib.nullcontext()
+
+
+def micro_batches(batch_size, accum_steps):
+    """
+    Slices that split a batch into accum_steps micro-batches
+    """
+    size = -(-batch_size // max(accum_steps, 1))
+    return [slice(start, min(start + size, batch_size)) for start in range(0, batch_size, size)]
+
+
+def set_epoch(loader, epoch):
+    """
+    Reshuffle a DistributedSampler for the given epoch
+    """
+    if hasattr(getattr(loader, 'sampler', None), 'set_epoch'):
+        loader.sampler.set_epoch(epoch)
+
+
+class ShardSampler(Sampler):
+    """
+    Every world_size-th index starting at rank, without the padding DistributedSampler adds, so
+    sharded evaluation counts each sample exactly once
+    """
+
+    def __init__(self, dataset):
+        self.length = len(dataset)
+        self.rank = get_rank()
+        self.world_size = get_world_size()
+
+    def __iter__(self):
+        return iter(range(self.rank, self.length, self.world_size))
+
+    def __len__(self):
+        return len(range(self.rank, self.length, self.world_size))
@@ -0,0 +1,273 @@
+"""
+Buffered metrics logging. ``init`` starts a MetricsLogger for the experiment; ``log`` and
+``write_text`` only put records in a bounded queue, which a background thread writes to the
+configured backends (wandb, JSONL, CSV) and to log.txt. Configured by the `logger` block:
+
+    logger:
+      backends: [wandb, jsonl]
+      offline: False
+      queue_size: 10000
+
+With offline, wandb is never contacted and the metrics go to metrics.jsonl, which can be sent
+to wandb later with
+
+    python -m utils.logger replay save/<experiment>
+"""
+import argparse
+import csv
+import json
+import os
+import queue
+import threading
+import time
+
+from .distributed import is_main_process
+
+_active = None
+
+
+class JSONLBackend:
+    """
+    One JSON object per log call, with its wall time and step
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'a')
+
+    def write(self, record):
+        self.file.write(json.dumps(record, default=float) + '\n')
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CSVBackend:
+    """
+    Long format (time, step, key, value), so calls logging different keys share one file
+    """
+
+    def __init__(self, path):
+        new = not os.path.exists(path)
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if new:
+            self.writer.writerow(['time', 'step', 'key', 'value'])
+
+    def write(self, record):
+        for key, value in record['metrics'].items():
+            self.writer.writerow([record['time'], record['step'], key, value])
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class WandbBackend:
+    """
+    wandb run of the experiment; the run id is kept in wandb.txt so resumed runs continue it
+    """
+
+    def __init__(self, output_dir, config, project, name, resume=False):
+        import wandb
+
+        self.wandb = wandb
+        id_path = os.path.join(output_dir, 'wandb.txt')
+        run_id = None
+        if resume and os.path.exists(id_path):
+            with open(id_path, 'r') as f:
+                run_id = f.read().strip()
+        self.run = wandb.init(config=config, project=project, name=name, resume='allow', id=run_id)
+        with open(id_path, 'w') as f:
+            f.write(self.run.id)
+
+    def write(self, record):
+        if record['step'] is None:
+            self.wandb.log(record['metrics'])
+        else:
+            self.wandb.log(record['metrics'], step=record['step'])
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.run.finish()
+
+
+BACKENDS = {'jsonl': 'metrics.jsonl', 'csv': 'metrics.csv', 'wandb': None}
+
+
+class MetricsLogger:
+    """
+    Writes metrics and log.txt lines on a background thread. log() never blocks: when the
+    queue is full the record is dropped and counted in ``dropped``. Lines for log.txt wait for
+    room instead, as they are rare and should not be lost. An error of a backend or of log.txt
+    does not stop the thread; it is kept and raised by the next log, write_text or close.
+
+    :param backends (list): Objects with write(record), flush() and close()
+    :param text_path (str): log.txt of the experiment
+    :param queue_size (int): Records buffered before log() drops them
+    """
+
+    def __init__(self, backends, text_path=None, queue_size=10000):
+        self.backends = backends
+        self.text_path = text_path
+        self.text = open(text_path, 'a') if text_path is not None else None
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def log(self, metrics, step=None):
+        self._raise()
+        try:
+            self.queue.put_nowait(('metrics', {'time': time.time(), 'step': step, 'metrics': dict(metrics)}))
+        except queue.Full:
+            self.dropped += 1
+
+    def write_text(self, msg):
+        self._raise()
+        self.queue.put(('text', msg))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        for backend in self.backends:
+            self._guard(backend.close)
+        if self.text is not None:
+            self._guard(self.text.close)
+        if self.dropped:
+            print(f'Metrics logger dropped {self.dropped} records because its queue was full')
+        self._raise()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _guard(self, fn, *args):
+        # keep the first error for the training thread instead of ending the writer thread
+        try:
+            fn(*args)
+        except Exception as e:
+            print(f'Metrics logger failed: {type(e).__name__}: {e}')
+            if self.error is None:
+                self.error = e
+
+    def _run(self):
+        while True:
+            items = [self.queue.get()]
+            # drain what is already queued, so backends and files are flushed once per batch
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for item in items:
+                if item is None:
+                    self._flush()
+                    return
+                kind, payload = item
+                if kind == 'text':
+                    if self.text is not None:
+                        self._guard(self.text.write, f'{payload}\n')
+                    continue
+                for backend in self.backends:
+                    self._guard(backend.write, payload)
+            self._flush()
+
+    def _flush(self):
+        for backend in self.backends:
+            self._guard(backend.flush)
+        if self.text is not None:
+            self._guard(self.text.flush)
+
+
+def init(config, output_dir, project, name, resume=False):
+    """
+    Start the logger of an experiment from its `logger` config block. Only the main process
+    logs; other ranks get a logger without backends.
+    """
+    global _active
+    logger_config = config.get('logger') or {}
+    names = list(logger_config.get('backends', ['wandb', 'jsonl']))
+    if not is_main_process():
+        _active = MetricsLogger([], queue_size=logger_config.get('queue_size', 10000))
+        return _active
+    if logger_config.get('offline') and 'wandb' in names:
+        names = [n for n in names if n != 'wandb'] + ([] if 'jsonl' in names else ['jsonl'])
+    with open(os.path.join(output_dir, 'run.json'), 'w') as f:
+        json.dump({'project': project, 'name': name, 'config': config}, f, default=str)
+    backends = []
+    for backend in names:
+        if backend not in BACKENDS:
+            raise ValueError(f'Unknown logger backend {backend}, expected one of {sorted(BACKENDS)}')
+        if backend == 'wandb':
+            backends.append(WandbBackend(output_dir, config, project, name, resume))
+        elif backend == 'jsonl':
+            backends.append(JSONLBackend(os.path.join(output_dir, BACKENDS[backend])))
+        else:
+            backends.append(CSVBackend(os.path.join(output_dir, BACKENDS[backend])))
+    _active = MetricsLogger(backends, os.path.join(output_dir, 'log.txt'), logger_config.get('queue_size', 10000))
+    return _active
+
+
+def log(metrics, step=None):
+    """
+    Queue metrics for the active logger; a no-op before init
+    """
+    if _active is not None:
+        _active.log(metrics, step)
+
+
+def write_text(path, msg):
+    """
+    Append a line to a log file on the main process, through the active logger when it owns path
+    """
+    if not is_main_process():
+        return
+    if _active is not None and _active.text_path is not None and os.path.abspath(path) == os.path.abspath(_active.text_path):
+        _active.write_text(msg)
+        return
+    with open(path, 'a') as f:
+        f.write(f'{msg}\n')
+
+
+def finish():
+    global _active
+    if _active is not None:
+        _active.close()
+        _active = None
+
+
+def replay(output_dir, project=None):
+    """
+    Send the metrics.jsonl of an offline run to a new wandb run
+    """
+    import wandb
+
+    with open(os.path.join(output_dir, 'run.json'), 'r') as f:
+        run = json.load(f)
+    backend = WandbBackend(output_dir, run['config'], project or run['project'], run['name'])
+    count = 0
+    with open(os.path.join(output_dir, BACKENDS['jsonl']), 'r') as f:
+        for line in f:
+            backend.write(json.loads(line))
+            count += 1
+    backend.close()
+    print(f'Replayed {count} records to wandb run {backend.run.id}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    replay_parser = subparsers.add_parser('replay', help='send an offline run to wandb')
+    replay_parser.add_argument('output_dir', type=str, help='experiment directory with run.json and metrics.jsonl')
+    replay_parser.add_argument('--project', type=str, default=None, help='wandb project, defaults to the original one')
+    args = parser.parse_args()
+    replay(args.output_dir, args.project)
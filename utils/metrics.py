@@ -0,0 +1,67 @@
+import torch
+import torch.distributed as dist
+
+from .distributed import is_distributed
+
+
+class MetricAccumulator:
+    """
+    Running loss sum and correct-prediction count kept as tensors on the training device,
+    so a step never waits on the device. Values reach the host only through compute(),
+    which callers invoke at the logging interval or at the end of the epoch. Under
+    DistributedDataParallel the values are summed over all ranks, so every rank must call it.
+
+    :param device (torch.device): Device the model outputs live on
+    :param log_interval (int): Steps between host syncs signalled by update; 0 for epoch end only
+    """
+
+    def __init__(self, device, log_interval=0):
+        self.device = device
+        self.log_interval = log_interval
+        self.reset()
+
+    def reset(self):
+        self.loss = torch.zeros((), device=self.device)
+        self.correct = torch.zeros((), dtype=torch.long, device=self.device)
+        self.steps = 0
+        self.samples = 0
+
+    def update(self, output, target, loss=None):
+        """
+        Accumulate one batch; returns True when this step is on the logging interval
+
+        :param output (torch.Tensor): Logits of the batch
+        :param target (torch.Tensor): Labels of the batch
+        :param loss (torch.Tensor): Loss of the batch
+        """
+        if loss is not None:
+            self.loss += loss.detach().float()
+        self.correct += (output.argmax(dim=1) == target).sum()
+        self.steps += 1
+        self.samples += target.size(0)
+        return self.log_interval > 0 and self.steps % self.log_interval == 0
+
+    def _reduce(self):
+        stats = torch.stack([
+            self.loss.double(),
+            self.correct.double(),
+            torch.tensor(self.steps, dtype=torch.float64, device=self.device),
+            torch.tensor(self.samples, dtype=torch.float64, device=self.device),
+        ])
+        if is_distributed():
+            dist.all_reduce(stats)
+        return stats.tolist()
+
+    def compute(self):
+        """
+        Loss sum and correct count as Python numbers; synchronizes with the device
+        """
+        loss, correct, _, _ = self._reduce()
+        return loss, int(correct)
+
+    def running(self):
+        """
+        Mean loss per step and accuracy so far; synchronizes with the device
+        """
+        loss, correct, steps, samples = self._reduce()
+        return loss / max(steps, 1), correct / max(samples, 1)
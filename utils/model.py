@@ -1,9 +1,15 @@
 # Created by Baole Fang at 4/2/24
 # Modified by George Chang at 4/13/24
+import os
+
 import vit_pytorch
 from torch.nn.parallel import DataParallel
 
-def make_model(config, gpus, state, device, path, model_name=''):
+from .compile import compile_model
+from . import logger
+from .distributed import is_distributed, wrap_ddp
+
+def make_model(config, gpus, state, device, path, model_name='', ddp=None):
     model = getattr(vit_pytorch, config['type'])(**config['args'])
     parameters = sum(p.numel() for p in model.parameters())
     if model_name == '' or model_name == 'student':
@@ -13,14 +19,21 @@ def make_model(config, gpus, state, device, path, model_name=''):
         config[f'{model_name}_parameters'] = parameters
         msg = f'{model_name} parameters: {parameters:,}'
     print(msg)
-    with open(path, 'a') as f:
-        f.write(f'{msg}\n')
-    if len(gpus) > 1:
-        model = DataParallel(model, device_ids=gpus, output_device=device)
-    if state:
-        if len(gpus) > 1:
-            model.module.load_state_dict(state['model'])
+    logger.write_text(path, msg)
+    if config.get('compile'):
+        if len(gpus) > 1 and not is_distributed():
+            print(f'Compiling is not supported with DataParallel. Running {model_name or "model"} eagerly.')
         else:
-            model.load_state_dict(state['model'])
-    return model.to(device)
+            cache_dir = config.get('compile_cache') or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(path))), 'compile_cache')
+            model = compile_model(model, config['compile'], cache_dir, path, model_name or 'model')
+    if state:
+        model.load_state_dict(state['model'])
+    model = model.to(device)
+    # ddp holds the DistributedDataParallel settings; None keeps a model that is not trained unwrapped
+    if is_distributed():
+        if ddp is not None:
+            model = wrap_ddp(model, device, ddp)
+    elif len(gpus) > 1:
+        model = DataParallel(model, device_ids=gpus, output_device=device)
+    return model
 
@@ -0,0 +1,75 @@
+import contextlib
+
+import torch
+
+DTYPES = {
+    None: None,
+    "fp32": torch.float32,
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+}
+
+
+def make_grad_scaler(enabled):
+    if hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler("cuda", enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def to_fp32(out):
+    """
+    Cast model outputs (a tensor or a tuple whose first entry is the logits) to fp32
+    """
+    if isinstance(out, tuple):
+        return (out[0].float(),) + out[1:]
+    return out.float()
+
+
+class PrecisionPolicy:
+    """
+    Precision of a training forward/backward: fp32, fp16 autocast with a GradScaler, or bf16
+    autocast (on CUDA or CPU). fp16 falls back to bf16 on CPU, where there is no scaler.
+
+    :param precision (str): None/'fp32', 'fp16' or 'bf16'
+    :param device (torch.device): Device the model is trained on
+    :param name (str): Name used in fallback messages
+    """
+
+    def __init__(self, precision=None, device="cpu", name="model"):
+        self.device_type = torch.device(device).type
+        self.dtype = DTYPES[precision]
+        if self.device_type != "cuda" and self.dtype == torch.float16:
+            print(f"fp16 is not supported for the {name} on {self.device_type}. Using bf16 instead.")
+            self.dtype = torch.bfloat16
+        if self.device_type == "cuda" and self.dtype == torch.bfloat16 and not torch.cuda.is_bf16_supported():
+            print(f"bf16 is not supported for the {name} on this GPU. Using fp16 instead.")
+            self.dtype = torch.float16
+        if self.dtype == torch.float32:
+            self.dtype = None
+        self.scaler = make_grad_scaler(self.dtype == torch.float16)
+
+    def autocast(self):
+        if self.dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device_type, dtype=self.dtype)
+
+    def backward(self, loss):
+        self.scaler.scale(loss).backward()
+
+    def optimizer_step(self, optimizer):
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+    def step(self, loss, optimizer):
+        """
+        Backward through the (scaled) loss and step the optimizer
+        """
+        self.backward(loss)
+        self.optimizer_step(optimizer)
+
+    def state_dict(self):
+        return self.scaler.state_dict()
+
+    def load_state_dict(self, state_dict):
+        if state_dict:
+            self.scaler.load_state_dict(state_dict)
@@ -0,0 +1,156 @@
+import contextlib
+import time
+
+import torch
+
+from . import logger
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+class StepProfiler:
+    """
+    Opt-in timers for the phases of a training step (data wait, host-to-device copy, teacher,
+    forward, loss, backward, optimizer). Each phase is summed over a step, and report() prints
+    the per-step mean and percentiles accumulated since the last report to stdout, log_path and
+    the metrics logger. The CUDA device is synchronized at phase boundaries, so enabling the
+    timers slows training slightly. With trace_dir, a torch.profiler trace of trace_steps steps starting at
+    step trace_start is written there for TensorBoard, with the phases as labelled ranges.
+    Disabled, every method is a no-op.
+
+    :param enabled (bool): Time the phases
+    :param log_path (str): Log file receiving the reports
+    :param trace_dir (str): Directory of the torch.profiler trace; None to not trace
+    :param trace_start (int): First traced step
+    :param trace_steps (int): Number of traced steps
+    """
+
+    def __init__(self, enabled=False, log_path=None, trace_dir=None, trace_start=10, trace_steps=5):
+        self.enabled = enabled
+        self.log_path = log_path
+        self.sync = torch.cuda.is_available()
+        self.times = {}
+        self.current = {}
+        self.last = None
+        self.trace = None
+        self.trace_end = trace_start + trace_steps
+        self.global_step = 0
+        if trace_dir is not None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=max(trace_start - 1, 0), warmup=min(trace_start, 1),
+                                                 active=trace_steps, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+                record_shapes=True,
+            )
+            self.trace.start()
+            print(f'Tracing steps {trace_start} to {self.trace_end - 1} into {trace_dir}')
+
+    @classmethod
+    def from_config(cls, config, log_path=None):
+        """
+        Profiler from the `profile` config block; None gives a disabled profiler
+        """
+        return cls(**(config or {}), log_path=log_path)
+
+    @property
+    def active(self):
+        return self.enabled or self.trace is not None
+
+    def phase(self, name):
+        """
+        Context timing one phase of the current step
+        """
+        if not self.active:
+            return contextlib.nullcontext()
+        return self._phase(name)
+
+    @contextlib.contextmanager
+    def _phase(self, name):
+        with torch.profiler.record_function(name) if self.trace is not None else contextlib.nullcontext():
+            if not self.enabled:
+                yield
+                return
+            if self.sync:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            yield
+            if self.sync:
+                torch.cuda.synchronize()
+            self.current[name] = self.current.get(name, 0.0) + time.perf_counter() - start
+
+    def iterate(self, loader):
+        """
+        Iterate loader, timing the wait for each batch as the 'data' phase
+        """
+        if not self.active:
+            yield from loader
+            return
+        iterator = iter(loader)
+        while True:
+            with self.phase('data'):
+                batch = next(iterator, None)
+            if batch is None:
+                return
+            yield batch
+
+    def step(self):
+        """
+        End the current step
+        """
+        if self.enabled:
+            now = time.perf_counter()
+            if self.last is not None:
+                self.current['step'] = now - self.last
+            self.last = now
+            for name, elapsed in self.current.items():
+                self.times.setdefault(name, []).append(elapsed)
+            self.current = {}
+        if self.trace is not None:
+            self.trace.step()
+            self.global_step += 1
+            if self.global_step >= self.trace_end:
+                self.trace.stop()
+                self.trace = None
+
+    def summary(self):
+        """
+        Mean, p50, p90 and p99 of every phase in milliseconds per step
+        """
+        return {
+            name: {
+                'mean': sum(values) / len(values) * 1e3,
+                'p50': percentile(values, 50) * 1e3,
+                'p90': percentile(values, 90) * 1e3,
+                'p99': percentile(values, 99) * 1e3,
+            }
+            for name, values in self.times.items()
+        }
+
+    def report(self, tag, log=True):
+        """
+        Print, log and reset the timings accumulated since the last report
+
+        :param tag (str): Prefix of the report and of the metric keys, e.g. 'student'
+        :param log (bool): Also send to the metrics logger
+        """
+        if not self.enabled or not self.times:
+            return
+        summary = self.summary()
+        steps = max(len(values) for values in self.times.values())
+        msg = '{} profile over {} steps (ms mean/p50/p90/p99): {}'.format(tag, steps, ', '.join(
+            '{} {:.2f}/{:.2f}/{:.2f}/{:.2f}'.format(name, s['mean'], s['p50'], s['p90'], s['p99'])
+            for name, s in summary.items()))
+        print(msg)
+        if self.log_path is not None:
+            logger.write_text(self.log_path, msg)
+        if log:
+            logger.log({f'profile/{tag}_{name}_{k}_ms': v for name, s in summary.items() for k, v in s.items()})
+        self.times = {}
+        self.last = None
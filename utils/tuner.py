@@ -0,0 +1,209 @@
+import itertools
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+import yaml
+from torch.utils.data import DataLoader
+
+import vit_pytorch
+from .precision import PrecisionPolicy
+
+
+def is_oom(error):
+    return isinstance(error, RuntimeError) and 'out of memory' in str(error).lower()
+
+
+def make_train_step(config, num_classes, device):
+    """
+    Factory of one synthetic training step per batch size for the models of a vit, kd or ckd
+    config: ViT training, a frozen teacher forward plus student training, or teacher and
+    student training
+    """
+    def build(model_config):
+        args = dict(model_config['args'], num_classes=num_classes)
+        return getattr(vit_pytorch, model_config['type'])(**args).to(device).train()
+
+    kd_args = (config.get('kd_model') or {}).get('args', {})
+    if 'model' in config:
+        models = [(build(config['model']), PrecisionPolicy(None, device), True)]
+        image_size = config['model']['args']['image_size']
+    else:
+        teacher = build(config['teacher_model'])
+        trained = 'student_start' in config
+        if not trained:
+            teacher.eval().requires_grad_(False)
+        teacher_dtype = kd_args.get('teacher_precision') if trained else kd_args.get('teacher_dtype')
+        models = [
+            (teacher, PrecisionPolicy(teacher_dtype, device, 'teacher'), trained),
+            (build(config['student_model']), PrecisionPolicy(kd_args.get('student_precision'), device, 'student'), True),
+        ]
+        image_size = config['student_model']['args']['image_size']
+    optimizers = [torch.optim.Adam(model.parameters(), lr=1e-5) if trained else None for model, _, trained in models]
+
+    def factory(batch_size):
+        data = torch.randn(batch_size, 3, image_size, image_size, device=device)
+        label = torch.randint(num_classes, (batch_size,), device=device)
+
+        def step():
+            target = None
+            for (model, precision, trained), optimizer in zip(models, optimizers):
+                if not trained:
+                    with torch.no_grad(), precision.autocast():
+                        target = model(data).float()
+                    continue
+                optimizer.zero_grad(set_to_none=True)
+                with precision.autocast():
+                    out = model(data).float()
+                loss = F.cross_entropy(out, label)
+                if target is not None:
+                    loss = loss + F.mse_loss(out, target)
+                precision.step(loss, optimizer)
+                target = out.detach()
+
+        return step
+
+    return factory
+
+
+def probe_batch_size(factory, device, memory_budget=0.9, start=8, max_batch_size=4096, iters=3):
+    """
+    Double the batch size from start until a step runs out of memory or, on CUDA, its peak
+    memory exceeds memory_budget of the device. Returns the largest batch size that fits and
+    the (batch size, samples/s, peak bytes) of every probe. Without CUDA there is no memory
+    limit to find, so the probe stops once doubling improves throughput by less than 5%.
+    """
+    device = torch.device(device)
+    cuda = device.type == 'cuda'
+    total = torch.cuda.get_device_properties(device).total_memory if cuda else None
+    probes = []
+    batch_size = start
+    while batch_size <= max_batch_size:
+        try:
+            step = factory(batch_size)
+            if cuda:
+                torch.cuda.reset_peak_memory_stats(device)
+            step()
+            if cuda:
+                torch.cuda.synchronize(device)
+            begin = time.perf_counter()
+            for _ in range(iters):
+                step()
+            if cuda:
+                torch.cuda.synchronize(device)
+            rate = batch_size * iters / (time.perf_counter() - begin)
+            peak = torch.cuda.max_memory_allocated(device) if cuda else None
+        except RuntimeError as e:
+            if not is_oom(e):
+                raise
+            print(f'batch size {batch_size}: out of memory')
+            break
+        finally:
+            step = None
+            if cuda:
+                torch.cuda.empty_cache()
+        print('batch size {}: {:.1f} samples/s{}'.format(
+            batch_size, rate, '' if peak is None else ', peak {:.2f} GB'.format(peak / 2 ** 30)))
+        if cuda and peak > memory_budget * total:
+            break
+        if not cuda and probes and rate < probes[-1][1] * 1.05:
+            probes.append((batch_size, rate, peak))
+            break
+        probes.append((batch_size, rate, peak))
+        batch_size *= 2
+    if not probes:
+        raise RuntimeError(f'Batch size {start} does not fit in memory')
+    if cuda:
+        return probes[-1][0], probes
+    return max(probes, key=lambda p: p[1])[0], probes
+
+
+def uses_teacher_cache(config):
+    """
+    Persistent workers keep a stale copy of the dataset, so they would not see the augmentation
+    that a teacher cache sets on it every epoch
+    """
+    return bool(((config.get('kd_model') or {}).get('args') or {}).get('teacher_cache'))
+
+
+def loader_candidates(workers, prefetch_factors, persistent_workers=True):
+    """
+    DataLoader settings to sweep; prefetch_factor and persistent_workers only apply with workers
+
+    :param persistent_workers (bool): Also try persistent workers
+    """
+    candidates = []
+    for num_workers in workers:
+        if num_workers == 0:
+            candidates.append({'num_workers': 0})
+            continue
+        persistent_options = [False, True] if persistent_workers else [False]
+        for prefetch_factor, persistent in itertools.product(prefetch_factors, persistent_options):
+            candidates.append({'num_workers': num_workers, 'prefetch_factor': prefetch_factor,
+                               'persistent_workers': persistent})
+    return candidates
+
+
+def sweep_loader(dataset, batch_size, candidates, collate_fn=None, pin_memory=False, batches=20, epochs=2):
+    """
+    Samples per second of each DataLoader setting over `epochs` passes of `batches` batches,
+    so worker start-up is paid per pass unless the workers persist. Returns the fastest
+    setting, preferring fewer workers among those within 5% of it, its samples per second and
+    all measurements.
+    """
+    results = []
+    for candidate in candidates:
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, collate_fn=collate_fn,
+                            pin_memory=pin_memory, **candidate)
+        samples = 0
+        begin = time.perf_counter()
+        for _ in range(epochs):
+            for i, (data, *_) in enumerate(loader):
+                samples += len(data)
+                if i + 1 >= batches:
+                    break
+        rate = samples / (time.perf_counter() - begin)
+        del loader
+        print('{}: {:.1f} samples/s'.format(candidate, rate))
+        results.append((candidate, rate))
+    best = max(rate for _, rate in results)
+    chosen, rate = min(((c, rate) for c, rate in results if rate >= 0.95 * best), key=lambda r: r[0]['num_workers'])
+    return dict(chosen, pin_memory=pin_memory), rate, results
+
+
+def write_tuned(output_root, config, tuned):
+    """
+    Store tuned in the `tuned` block of the experiment's config.yaml, creating it from config
+    """
+    path = os.path.join(output_root, 'config.yaml')
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            config = yaml.load(f, Loader=yaml.FullLoader)
+    config['tuned'] = tuned
+    os.makedirs(output_root, exist_ok=True)
+    with open(path, 'w') as f:
+        yaml.dump(config, f)
+    return path
+
+
+def apply_tuned(config, output_root):
+    """
+    Use the batch size and train loader settings of the `tuned` block in the experiment's
+    config.yaml, if tune.py wrote one. Called before the experiment directory is replaced.
+    """
+    path = os.path.join(output_root, 'config.yaml')
+    if not os.path.exists(path):
+        return config
+    with open(path, 'r') as f:
+        tuned = (yaml.load(f, Loader=yaml.FullLoader) or {}).get('tuned')
+    if not tuned:
+        return config
+    loader = dict(tuned['loader'])
+    if uses_teacher_cache(config) and loader.pop('persistent_workers', False):
+        print('Not using the tuned persistent workers: they would not follow the teacher cache augmentation')
+    config['tuned'] = tuned
+    config['batch_size'] = tuned['batch_size']
+    config['dataset']['train']['loader'].update(loader)
+    print(f'Using the tuned batch size {tuned["batch_size"]} and train loader settings {loader}')
+    return config
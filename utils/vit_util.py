@@ -2,6 +2,7 @@
 import os.path
 
 from .dataset import make_dataloaders
+from .distributed import get_device
 from .model import make_model
 from .optimizer import make_optimizer
 from .scheduler import make_scheduler
@@ -12,11 +13,12 @@ def prepare(config, gpus):
     n_classes = len(train_loader.dataset.classes)
     config['model']['args']['num_classes'] = n_classes
     if config['resume']:
-        state = torch.load(os.path.join(config['output_dir'], 'checkpoints', f'epoch_{config["resume"]}.pth'))
+        state = torch.load(os.path.join(config['output_dir'], 'checkpoints', f'epoch_{config["resume"]}.pth'), map_location='cpu')
     else:
         state = None
-    device = torch.device(f'cuda:{gpus[0]}')
-    model = make_model(config['model'], gpus, state, device, os.path.join(config['output_dir'], 'log.txt'))
+    device = get_device(gpus)
+    model = make_model(config['model'], gpus, state, device, os.path.join(config['output_dir'], 'log.txt'),
+                       ddp=config.get('distributed') or {})
     optimizer = make_optimizer(config['optimizer'], model, state)
     scheduler = make_scheduler(config['scheduler'], optimizer, state)
     return train_loader, test_loader, model, optimizer, scheduler, device
@@ -0,0 +1,66 @@
+import torch
+
+# token merging (ToMe, https://arxiv.org/abs/2210.09461): between attention and feedforward,
+# the r most similar tokens of one half are averaged into their best match in the other half
+
+def set_token_merging(model, enabled = True):
+    # merging changes the outputs, so eval-mode forwards stay exact unless it is turned on explicitly
+    for module in model.modules():
+        if hasattr(module, 'merge_tokens'):
+            module.merge_tokens = enabled
+    return model
+
+def bipartite_soft_matching(metric, r, protect_first = False):
+    # metric: (b, n, d) similarity features, the attention keys averaged over heads
+    protected = int(protect_first)
+    t = metric.shape[1]
+    r = min(r, (t - protected) // 2)
+    if r <= 0:
+        return None
+
+    with torch.no_grad():
+        metric = metric / metric.norm(dim = -1, keepdim = True)
+        a, b = metric[..., ::2, :], metric[..., 1::2, :]
+        scores = a @ b.transpose(-1, -2)
+
+        if protect_first:
+            scores[..., 0, :] = -float('inf')
+
+        node_max, node_idx = scores.max(dim = -1)
+        edge_idx = node_max.argsort(dim = -1, descending = True)[..., None]
+
+        unm_idx = edge_idx[..., r:, :]
+        src_idx = edge_idx[..., :r, :]
+        dst_idx = node_idx[..., None].gather(dim = -2, index = src_idx)
+
+        if protect_first:
+            # keep the cls token at index 0
+            unm_idx = unm_idx.sort(dim = 1)[0]
+
+    def merge(x, mode = 'sum'):
+        src, dst = x[..., ::2, :], x[..., 1::2, :]
+        n, t1, c = src.shape
+        unm = src.gather(dim = -2, index = unm_idx.expand(n, t1 - r, c))
+        src = src.gather(dim = -2, index = src_idx.expand(n, r, c))
+        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce = mode)
+        return torch.cat([unm, dst], dim = 1)
+
+    return merge
+
+def merge_wavg(merge, x, size = None):
+    # size: (b, n, 1) number of patches each token holds, so merged tokens are size-weighted means
+    if size is None:
+        size = torch.ones_like(x[..., :1])
+
+    x = merge(x * size, mode = 'sum')
+    size = merge(size, mode = 'sum')
+    return x / size, size
+
+def size_bias(size, dtype):
+    # proportional attention: a token holding s patches counts as s keys
+    return None if size is None else size.log()[:, None, None, :, 0].to(dtype)
+
+def weighted_mean(x, size = None):
+    if size is None:
+        return x.mean(dim = 1)
+    return (x * size).sum(dim = 1) / size.sum(dim = 1)
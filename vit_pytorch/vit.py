@@ -1,16 +1,41 @@
 import torch
+import torch.nn.functional as F
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 
 from einops import rearrange, repeat
 from einops.layers.torch import Rearrange
 
+from vit_pytorch.token_merging import bipartite_soft_matching, merge_wavg, size_bias, weighted_mean
+
 # helpers
 
 def pair(t):
     return t if isinstance(t, tuple) else (t, t)
 
+def residual_block(attn, ff, x):
+    x = attn(x) + x
+    return ff(x) + x
+
 # classes
 
+class PatchDropout(nn.Module):
+    # keeps a random subset of the patch tokens of every image, in training only
+    def __init__(self, prob):
+        super().__init__()
+        assert 0 <= prob < 1., 'patch dropout probability must be in [0, 1)'
+        self.prob = prob
+
+    def forward(self, x):
+        if not self.training or self.prob == 0.:
+            return x
+
+        b, n, _ = x.shape
+        num_keep = max(1, int(n * (1 - self.prob)))
+        keep_indices = torch.randn(b, n, device = x.device).topk(num_keep, dim = -1).indices
+        batch_indices = torch.arange(b, device = x.device)[:, None]
+        return x[batch_indices, keep_indices]
+
 class FeedForward(nn.Module):
     def __init__(self, dim, hidden_dim, dropout = 0.):
         super().__init__()
@@ -27,12 +52,13 @@ class FeedForward(nn.Module):
         return self.net(x)
 
 class Attention(nn.Module):
-    def __init__(self, dim, heads = 8, dim_head = 64, dropout = 0.):
+    def __init__(self, dim, heads = 8, dim_head = 64, dropout = 0., attn_impl = 'einops'):
         super().__init__()
         inner_dim = dim_head *  heads
         project_out = not (heads == 1 and dim_head == dim)
 
         self.heads = heads
+        self.attn_impl = attn_impl if hasattr(F, 'scaled_dot_product_attention') else 'einops'
         self.scale = dim_head ** -0.5
 
         self.norm = nn.LayerNorm(dim)
@@ -47,41 +73,91 @@ class Attention(nn.Module):
             nn.Dropout(dropout)
         ) if project_out else nn.Identity()
 
-    def forward(self, x):
+    def forward(self, x, size = None, return_metric = False):
+        # size: patches held by each merged token; return_metric also returns the keys averaged over heads
         x = self.norm(x)
 
+        if self.attn_impl == 'sdpa':
+            out, k = self.sdpa(x, self.dropout.p if self.training else 0., size)
+            out = self.to_out(out)
+            return (out, k.mean(dim = 1)) if return_metric else out
+
         qkv = self.to_qkv(x).chunk(3, dim = -1)
         q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h = self.heads), qkv)
 
         dots = torch.matmul(q, k.transpose(-1, -2)) * self.scale
+        if size is not None:
+            dots = dots + size_bias(size, dots.dtype)
 
         attn = self.attend(dots)
         attn = self.dropout(attn)
 
         out = torch.matmul(attn, v)
         out = rearrange(out, 'b h n d -> b n (h d)')
-        return self.to_out(out)
+        out = self.to_out(out)
+        return (out, k.mean(dim = 1)) if return_metric else out
+
+    def sdpa(self, x, dropout_p = 0., size = None):
+        # split qkv and heads as views of the projection, one fused attention kernel
+        b, n, _ = x.shape
+        q, k, v = self.to_qkv(x).view(b, n, 3, self.heads, -1).permute(2, 0, 3, 1, 4).unbind(0)
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask = size_bias(size, q.dtype), dropout_p = dropout_p)
+        return out.transpose(1, 2).reshape(b, n, -1), k
 
 class Transformer(nn.Module):
-    def __init__(self, dim, depth, heads, dim_head, mlp_dim, dropout = 0.):
+    def __init__(self, dim, depth, heads, dim_head, mlp_dim, dropout = 0., attn_impl = 'einops', checkpoint = None, token_merge_r = 0, protect_first = False):
         super().__init__()
+        assert checkpoint in {None, False, True, 'all', 'attn'} or isinstance(checkpoint, int), 'checkpoint must be None, all, attn or a block interval'
+        self.checkpoint = checkpoint
+        self.token_merge_r = token_merge_r
+        self.protect_first = protect_first
+        # only the frozen teacher turns merging on, see set_token_merging
+        self.merge_tokens = False
         self.norm = nn.LayerNorm(dim)
         self.layers = nn.ModuleList([])
         for _ in range(depth):
             self.layers.append(nn.ModuleList([
-                Attention(dim, heads = heads, dim_head = dim_head, dropout = dropout),
+                Attention(dim, heads = heads, dim_head = dim_head, dropout = dropout, attn_impl = attn_impl),
                 FeedForward(dim, mlp_dim, dropout = dropout)
             ]))
 
-    def forward(self, x):
+    def forward(self, x, return_size = False):
+        # return_size also returns the patches held by each token, None when nothing was merged
+        size = None
+        if self.merge_tokens and self.token_merge_r and not self.training:
+            x, size = self.merged_forward(x)
+            x = self.norm(x)
+            return (x, size) if return_size else x
+
+        # checkpointed activations are recomputed in backward, so only training needs it
+        policy = self.checkpoint if self.training and torch.is_grad_enabled() else None
+        for i, (attn, ff) in enumerate(self.layers):
+            if policy == 'attn':
+                x = checkpoint(attn, x, use_reentrant = False) + x
+                x = ff(x) + x
+            elif policy and (policy in (True, 'all') or i % policy == 0):
+                x = checkpoint(residual_block, attn, ff, x, use_reentrant = False)
+            else:
+                x = attn(x) + x
+                x = ff(x) + x
+
+        x = self.norm(x)
+        return (x, size) if return_size else x
+
+    def merged_forward(self, x):
+        # inference only: merge token_merge_r tokens after the attention of every block
+        size = None
         for attn, ff in self.layers:
-            x = attn(x) + x
+            out, metric = attn(x, size = size, return_metric = True)
+            x = out + x
+            merge = bipartite_soft_matching(metric, self.token_merge_r, self.protect_first)
+            if merge is not None:
+                x, size = merge_wavg(merge, x, size)
             x = ff(x) + x
-
-        return self.norm(x)
+        return x, size
 
 class ViT(nn.Module):
-    def __init__(self, *, image_size, patch_size, num_classes, dim, depth, heads, mlp_dim, pool = 'cls', channels = 3, dim_head = 64, dropout = 0., emb_dropout = 0.):
+    def __init__(self, *, image_size, patch_size, num_classes, dim, depth, heads, mlp_dim, pool = 'cls', channels = 3, dim_head = 64, dropout = 0., emb_dropout = 0., attn_impl = 'einops', checkpoint = None, patch_dropout = 0., token_merge_r = 0):
         super().__init__()
         image_height, image_width = pair(image_size)
         patch_height, patch_width = pair(patch_size)
@@ -101,9 +177,11 @@ class ViT(nn.Module):
 
         self.pos_embedding = nn.Parameter(torch.randn(1, num_patches + 1, dim))
         self.cls_token = nn.Parameter(torch.randn(1, 1, dim))
+        self.patch_dropout = PatchDropout(patch_dropout)
         self.dropout = nn.Dropout(emb_dropout)
 
-        self.transformer = Transformer(dim, depth, heads, dim_head, mlp_dim, dropout)
+        # the cls token is never merged
+        self.transformer = Transformer(dim, depth, heads, dim_head, mlp_dim, dropout, attn_impl, checkpoint, token_merge_r, protect_first = True)
 
         self.pool = pool
         self.to_latent = nn.Identity()
@@ -114,14 +192,17 @@ class ViT(nn.Module):
         x = self.to_patch_embedding(img)
         b, n, _ = x.shape
 
-        cls_tokens = repeat(self.cls_token, '1 1 d -> b 1 d', b = b)
+        # patch tokens are dropped after their positional embedding; the cls token is always kept
+        x += self.pos_embedding[:, 1:(n + 1)]
+        x = self.patch_dropout(x)
+
+        cls_tokens = repeat(self.cls_token + self.pos_embedding[:, :1], '1 1 d -> b 1 d', b = b)
         x = torch.cat((cls_tokens, x), dim=1)
-        x += self.pos_embedding[:, :(n + 1)]
         x = self.dropout(x)
 
-        x = self.transformer(x)
+        x, size = self.transformer(x, return_size = True)
 
-        x = x.mean(dim = 1) if self.pool == 'mean' else x[:, 0]
+        x = weighted_mean(x, size) if self.pool == 'mean' else x[:, 0]
 
         x = self.to_latent(x)
         return self.mlp_head(x)